@@ -0,0 +1,94 @@
+import fcntl
+import glob
+import json
+import logging
+import os
+import shutil
+import sqlite3
+
+"""
+Checkpoint of a gulcalc event batch so that a worker killed midway can resume on retry. The working directory is a
+persistent directory keyed by the analysis inputs and the event batch, and a manifest (checkpoint.json) records the
+completed stages:
+    rf_input: the RF input database is built (number of rows)
+    engine: the engine completed, every partial loss of the event_batches table is available
+The manifest does not record which event_batches rows an interrupted engine completed: the engine cannot resume (it
+has no parameter for the batches already computed), so it is run again from scratch once its partial losses are
+removed and the event_batches table emptied. Only one worker may use a checkpoint at a time (flock on
+checkpoint.lock).
+"""
+
+MANIFEST_FILENAME = "checkpoint.json"
+LOCK_FILENAME = "checkpoint.lock"
+MANIFEST_VERSION = 1
+STAGE_RF_INPUT = "rf_input"
+STAGE_ENGINE = "engine"
+
+
+class Checkpoint(object):
+    """Persistent working directory and manifest of an event batch"""
+
+    def __init__(self, checkpoint_root, event_batch, key):
+        self.working_dir = os.path.join(checkpoint_root, "gulcalc_{0}_{1}".format(event_batch, key[:16]))
+        os.makedirs(self.working_dir, exist_ok=True)
+        self._lock = open(os.path.join(self.working_dir, LOCK_FILENAME), "w")
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        self._manifest_fp = os.path.join(self.working_dir, MANIFEST_FILENAME)
+        self.manifest = None
+        if os.path.isfile(self._manifest_fp):
+            try:
+                with open(self._manifest_fp) as f:
+                    self.manifest = json.load(f)
+            except ValueError:
+                logging.warning("Invalid checkpoint manifest " + self._manifest_fp + ", starting from scratch")
+        if self.manifest is None or self.manifest.get("version") != MANIFEST_VERSION \
+                or self.manifest.get("key") != key:
+            self.manifest = {"version": MANIFEST_VERSION, "key": key, "stages": {}, "attempts": 0}
+        self.manifest["attempts"] = self.manifest["attempts"] + 1
+        self.save()
+
+    def save(self):
+        tmp_fp = self._manifest_fp + ".tmp"
+        with open(tmp_fp, "w") as f:
+            json.dump(self.manifest, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fp, self._manifest_fp)
+
+    def get_stage(self, stage):
+        """Returns the information recorded when the stage completed or None"""
+        return self.manifest["stages"].get(stage)
+
+    def complete_stage(self, stage, **info):
+        self.manifest["stages"][stage] = info
+        self.save()
+
+    def discard_partial_losses(self, db_fp):
+        """Removes the partial losses left by an interrupted engine and empties the event_batches table, otherwise the
+        engine run again would find stale partial losses and batch ids
+
+        :param db_fp: path to the sqlite database containing the event_batches table
+        :return: number of partial loss files removed
+        """
+        partial_loss_fps = glob.glob(os.path.join(self.working_dir, "oasis_loss_*"))
+        for partial_loss_fp in partial_loss_fps:
+            os.remove(partial_loss_fp)
+        con = sqlite3.connect(db_fp)
+        try:
+            cur = con.cursor()
+            cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='event_batches'")
+            if cur.fetchone() is not None:
+                cur.execute("DELETE FROM event_batches")
+                con.commit()
+        finally:
+            con.close()
+        return len(partial_loss_fps)
+
+    def close(self, success):
+        """Releases the checkpoint, its directory is removed once the event batch succeeded"""
+        if self._lock is None:
+            return
+        if success:
+            shutil.rmtree(self.working_dir, ignore_errors=True)
+        self._lock.close()
+        self._lock = None
@@ -0,0 +1,165 @@
+import mmap
+import os
+import sqlite3
+import struct
+import numpy as np
+
+"""
+Flat columnar result format for partial losses, an alternative to the oasis_loss_{batch_id}.db sqlite databases.
+A file oasis_loss_{batch_id}.rfl holds a 32 bytes header followed by four little-endian columns of num_rows values:
+    header: magic (8s), version (uint32), flags (uint32), num_rows (uint64), reserved (uint64)
+    columns: event_id (uint32), loc_id (uint32), sample_id (int32), loss (float32)
+The file is read through mmap and the columns are exposed as zero-copy numpy views.
+"""
+
+COLUMNAR_LOSS_MAGIC = b"RFLOSS\x00\x00"
+COLUMNAR_LOSS_VERSION = 1
+COLUMNAR_LOSS_EXTENSION = ".rfl"
+COLUMNAR_LOSS_HEADER = struct.Struct("<8sIIQQ")
+COLUMNAR_LOSS_COLUMNS = [("event_id", np.dtype("<u4")), ("loc_id", np.dtype("<u4")), ("sample_id", np.dtype("<i4")),
+                         ("loss", np.dtype("<f4"))]
+# flags
+FLAG_SORTED = 1
+
+
+def write_columnar_loss(fp, event_ids, loc_ids, sample_ids, losses, is_sorted=False):
+    """Writes partial losses in the columnar result format
+
+    :param fp: path of the file to write
+    :param event_ids: array like of event ids
+    :param loc_ids: array like of loc ids (item or coverage ids)
+    :param sample_ids: array like of sample ids
+    :param losses: array like of losses
+    :param is_sorted: set when the rows are already ordered by event_id, loc_id, sample_id
+    :return: number of rows written
+    """
+    columns = [np.ascontiguousarray(values, dtype=dtype) for values, (_, dtype)
+               in zip([event_ids, loc_ids, sample_ids, losses], COLUMNAR_LOSS_COLUMNS)]
+    num_rows = len(columns[0])
+    if any(len(column) != num_rows for column in columns):
+        raise ValueError("all columns must have the same number of rows")
+    tmp_fp = fp + ".tmp"
+    with open(tmp_fp, "wb") as f:
+        f.write(COLUMNAR_LOSS_HEADER.pack(COLUMNAR_LOSS_MAGIC, COLUMNAR_LOSS_VERSION,
+                                          FLAG_SORTED if is_sorted else 0, num_rows, 0))
+        for column in columns:
+            f.write(memoryview(column).cast('B'))
+    # the file only appears under its final name once it is complete
+    os.replace(tmp_fp, fp)
+    return num_rows
+
+
+def read_columnar_loss(fp):
+    """Maps a columnar partial loss into memory
+
+    :param fp: path of the columnar loss file
+    :return: a tuple (dictionary of zero-copy numpy column views, True if the rows are sorted)
+    """
+    with open(fp, "rb") as f:
+        header = f.read(COLUMNAR_LOSS_HEADER.size)
+        if len(header) < COLUMNAR_LOSS_HEADER.size:
+            raise ValueError("Invalid columnar loss file " + fp)
+        magic, version, flags, num_rows, _ = COLUMNAR_LOSS_HEADER.unpack(header)
+        if not magic == COLUMNAR_LOSS_MAGIC or version > COLUMNAR_LOSS_VERSION:
+            raise ValueError("Unsupported columnar loss file " + fp)
+        if num_rows == 0:
+            return dict((name, np.zeros(0, dtype=dtype)) for name, dtype in COLUMNAR_LOSS_COLUMNS), True
+        expected_size = COLUMNAR_LOSS_HEADER.size + num_rows * sum(dtype.itemsize for _, dtype
+                                                                   in COLUMNAR_LOSS_COLUMNS)
+        if os.fstat(f.fileno()).st_size < expected_size:
+            raise ValueError("Truncated columnar loss file " + fp)
+        # the views keep a reference to the map which is released once they are garbage collected
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    columns = {}
+    offset = COLUMNAR_LOSS_HEADER.size
+    for name, dtype in COLUMNAR_LOSS_COLUMNS:
+        columns[name] = np.frombuffer(buffer, dtype=dtype, count=num_rows, offset=offset)
+        offset = offset + num_rows * dtype.itemsize
+    return columns, bool(flags & FLAG_SORTED)
+
+
+def sqlite_to_columnar_loss(db_fp, fp):
+    """Converts a sqlite partial loss (oasis_loss table) into the columnar result format
+
+    :param db_fp: path to the oasis_loss_{batch_id}.db partial loss
+    :param fp: path of the columnar loss file to write
+    :return: number of rows written
+    """
+    con = sqlite3.connect(db_fp)
+    try:
+        rows = con.execute("SELECT event_id, loc_id, sample_id, loss FROM oasis_loss "
+                           "ORDER BY event_id, loc_id, sample_id").fetchall()
+    finally:
+        con.close()
+    columns = np.array(rows, dtype=[(name, dtype) for name, dtype in COLUMNAR_LOSS_COLUMNS]) if rows else None
+    if columns is None:
+        return write_columnar_loss(fp, [], [], [], [], is_sorted=True)
+    return write_columnar_loss(fp, columns["event_id"], columns["loc_id"], columns["sample_id"], columns["loss"],
+                               is_sorted=True)
+
+
+def generate_columnar_losses(working_dir, db_fp, num_partial, num_events, num_locs, num_samples,
+                             zero_loss_fraction=0.0, is_sorted=True, seed=1):
+    """Local stand-in for the engine: registers num_partial batches in the event_batches table of db_fp and writes
+    a synthetic oasis_loss_{batch_id}.rfl for each of them
+
+    :param working_dir: directory where the partial losses are written
+    :param db_fp: path to the sqlite database receiving the event_batches table
+    :param num_partial: number of partial losses
+    :param num_events: number of events per partial loss
+    :param num_locs: number of items (or coverages)
+    :param num_samples: number of samples, the special samples -3 (tiv) and -1 (mean) are added
+    :param zero_loss_fraction: fraction of the losses set to zero
+    :param is_sorted: if False, rows are shuffled
+    :param seed: random seed
+    :return: total number of rows written
+    """
+    rng = np.random.default_rng(seed)
+    con = sqlite3.connect(db_fp)
+    con.execute("CREATE TABLE IF NOT EXISTS event_batches (batch_id INTEGER);")
+    con.execute("DELETE FROM event_batches;")
+    con.executemany("INSERT INTO event_batches VALUES (?);", [(i,) for i in range(num_partial)])
+    con.commit()
+    con.close()
+
+    sample_ids = np.array([-3, -1] + list(range(1, num_samples + 1)), dtype=np.int32)
+    num_rows = 0
+    for batch_id in range(num_partial):
+        event_ids = np.arange(batch_id * num_events + 1, (batch_id + 1) * num_events + 1, dtype=np.uint32)
+        event_col = np.repeat(event_ids, num_locs * len(sample_ids))
+        loc_col = np.tile(np.repeat(np.arange(1, num_locs + 1, dtype=np.uint32), len(sample_ids)), num_events)
+        sample_col = np.tile(sample_ids, num_events * num_locs)
+        loss_col = rng.uniform(0, 1e6, len(event_col)).astype(np.float32)
+        loss_col[rng.random(len(event_col)) < zero_loss_fraction] = 0
+        if not is_sorted:
+            order = rng.permutation(len(event_col))
+            event_col, loc_col, sample_col, loss_col = event_col[order], loc_col[order], sample_col[order], \
+                loss_col[order]
+        fp = os.path.join(working_dir, "oasis_loss_{0}{1}".format(batch_id, COLUMNAR_LOSS_EXTENSION))
+        num_rows = num_rows + write_columnar_loss(fp, event_col, loc_col, sample_col, loss_col, is_sorted)
+    return num_rows
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Columnar partial loss utility.')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser("convert", help="convert an oasis_loss_N.db into the columnar format")
+    convert_parser.add_argument("db_fp")
+    convert_parser.add_argument("fp")
+    generate_parser = subparsers.add_parser("generate", help="generate synthetic columnar partial losses")
+    generate_parser.add_argument("working_dir")
+    generate_parser.add_argument("db_fp")
+    generate_parser.add_argument("--partials", type=int, default=4)
+    generate_parser.add_argument("--events", type=int, default=100)
+    generate_parser.add_argument("--locs", type=int, default=1000)
+    generate_parser.add_argument("--samples", type=int, default=10)
+    generate_parser.add_argument("--zero-loss-fraction", type=float, default=0.0)
+    generate_parser.add_argument("--unsorted", action="store_true")
+    args = parser.parse_args()
+    if args.command == "convert":
+        print(sqlite_to_columnar_loss(args.db_fp, args.fp))
+    else:
+        print(generate_columnar_losses(args.working_dir, args.db_fp, args.partials, args.events, args.locs,
+                                       args.samples, args.zero_loss_fraction, not args.unsorted))
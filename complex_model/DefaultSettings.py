@@ -2,6 +2,7 @@
 import os
 import json
 import pathlib
+import tempfile
 
 
 COUNTRY_CODE = "au"
@@ -16,6 +17,20 @@ DEFAULT_RF_PERIL_ID = 2
 DEFAULT_SEED = 1
 BASE_DB_NAME = 'riskfrontiersdbAUS_v2_6.db'
 DEFAULT_HAILAUS_DB = 'riskfrontiersdbHAILAUS_v2_6'
+# partial losses are streamed while the engine runs only once it flags them complete in event_batches (the engine
+# does not flag them today, see GulcalcToBin.iter_completed_batch_ids), they are otherwise streamed once it exited
+DEFAULT_PIPELINED_STREAMING = False
+DEFAULT_CONVERSION_POOL_SIZE = 1
+DEFAULT_LIVE_TRANSPORT = False
+DEFAULT_CHECKPOINT_DIRECTORY = None
+DEFAULT_INPUT_CACHE_DIRECTORY = None
+DEFAULT_INPUT_CACHE_BUDGET_MB = 10240
+DEFAULT_INPUT_CHUNK_SIZE = 100000
+DEFAULT_KEYS_POOL_SIZE = 1
+DEFAULT_KEYS_CHUNK_SIZE = 50000
+DEFAULT_POSTCODE_CACHE_SIZE = 100000
+DEFAULT_GNAF_INDEX_DIRECTORY = os.path.join(tempfile.gettempdir(), "rf_gnaf_index")
+DEFAULT_POSTCODE_SNAPSHOT_DIRECTORY = os.path.join(tempfile.gettempdir(), "rf_postcode_snapshot")
 
 
 # oasis file paths
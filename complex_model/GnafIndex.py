@@ -0,0 +1,133 @@
+import fcntl
+import glob
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import numpy as np
+
+"""
+Compact index of the GNAF addresses supported by the model (rf_address table). The address ids are stored once per
+model data version as a sorted array of fixed width byte strings (numpy .npy file) that is memory mapped by the keys
+lookup processes and probed with a binary search, instead of loading millions of python strings in a set.
+    index_dir/rf_address_{db_key}_{key}.npy: the sorted address ids, db_key identifies the database path and key
+        its version
+    index_dir/rf_address_{db_key}_{key}.lock: lock held while the index is built
+The indexes of the previous versions of a database are removed once its current index is built.
+"""
+
+GNAF_INDEX_VERSION = 1
+FETCH_SIZE = 100000
+
+
+def get_gnaf_index_fp(index_dir, db_fp):
+    """Returns the path of the index of the database, keyed by its path, size and modification time
+
+    :param index_dir: directory containing the indexes
+    :param db_fp: path to the database containing the rf_address table
+    :return: path to the index file
+    """
+    stat = os.stat(db_fp)
+    db_key = hashlib.sha1(os.path.realpath(db_fp).encode("utf-8")).hexdigest()
+    key = hashlib.sha1("{0}\x00{1}\x00{2}".format(stat.st_size, stat.st_mtime_ns,
+                                                  GNAF_INDEX_VERSION).encode("utf-8")).hexdigest()
+    return os.path.join(index_dir, "rf_address_{0}_{1}.npy".format(db_key[:16], key[:16]))
+
+
+def prune_stale_gnaf_indexes(index_fp):
+    """Removes the indexes and locks left by the previous versions of the database of index_fp
+
+    :param index_fp: path to the current index file
+    :return: number of files removed
+    """
+    current = index_fp[:-len(".npy")]
+    removed = 0
+    for fp in glob.glob(glob.escape(index_fp[:index_fp.rindex("_") + 1]) + "*"):
+        name, extension = os.path.splitext(fp)
+        if not name == current and extension in (".npy", ".lock"):
+            try:
+                os.remove(fp)
+                removed = removed + 1
+            except OSError:
+                pass  # removed by another process
+    return removed
+
+
+def build_gnaf_index(db_fp, index_fp):
+    """Writes the sorted and unique address ids of the rf_address table into index_fp
+
+    :param db_fp: path to the database containing the rf_address table
+    :param index_fp: path to the index file
+    :return: number of addresses
+    """
+    start = time.time()
+    con = sqlite3.connect("file:" + db_fp + "?mode=ro", uri=True)
+    try:
+        cur = con.execute("SELECT address_id FROM rf_address WHERE NOT address_id IS NULL;")
+        chunks = []
+        rows = cur.fetchmany(FETCH_SIZE)
+        while rows:
+            chunks.append(np.array([address_id.encode("utf-8") for address_id, in rows], dtype=np.bytes_))
+            rows = cur.fetchmany(FETCH_SIZE)
+    finally:
+        con.close()
+    width = max([chunk.dtype.itemsize for chunk in chunks] + [1])
+    addresses = np.unique(np.concatenate([chunk.astype("S{0}".format(width)) for chunk in chunks])
+                          if chunks else np.empty(0, dtype="S1"))
+    tmp_fp = index_fp + ".tmp"
+    with open(tmp_fp, "wb") as f:
+        np.save(f, addresses)
+    os.replace(tmp_fp, index_fp)
+    logging.info("COMPLETED: GNAF index of {0} addresses built in {1} in {2:.2f}s"
+                 .format(len(addresses), index_fp, time.time() - start))
+    return len(addresses)
+
+
+class GnafIndex(object):
+    """Read-only set of address ids backed by a memory mapped sorted array"""
+
+    def __init__(self, addresses):
+        self._addresses = addresses
+
+    @classmethod
+    def load(cls, db_fp, index_dir):
+        """Loads the index of the database, building it first if it does not exist yet
+
+        :param db_fp: path to the database containing the rf_address table
+        :param index_dir: directory containing the indexes
+        :return: GnafIndex
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        index_fp = get_gnaf_index_fp(index_dir, db_fp)
+        if not os.path.isfile(index_fp):
+            with open(index_fp[:-len(".npy")] + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not os.path.isfile(index_fp):
+                    build_gnaf_index(db_fp, index_fp)
+                    prune_stale_gnaf_indexes(index_fp)
+        return cls(np.load(index_fp, mmap_mode="r"))
+
+    def __len__(self):
+        return len(self._addresses)
+
+    def __contains__(self, address_id):
+        return bool(self.contains([address_id])[0])
+
+    def contains(self, address_ids):
+        """Batch membership of address ids, values that are not strings are not found
+
+        :param address_ids: iterable of address ids
+        :return: array of booleans
+        """
+        width = self._addresses.dtype.itemsize
+        probes = [address_id.encode("utf-8") if isinstance(address_id, str) else None for address_id in address_ids]
+        valid = np.array([probe is not None and 0 < len(probe) <= width for probe in probes], dtype=bool)
+        found = np.zeros(len(probes), dtype=bool)
+        if not valid.any() or len(self._addresses) == 0:
+            return found
+        values = np.array([probe for probe, is_valid in zip(probes, valid) if is_valid], dtype="S{0}".format(width))
+        positions = np.searchsorted(self._addresses, values)
+        positions[positions == len(self._addresses)] = 0
+        found[valid] = self._addresses[positions] == values
+        return found
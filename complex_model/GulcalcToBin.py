@@ -1,8 +1,21 @@
 import struct
 import sqlite3
 import os
+import io
+import glob
+import math
+import tempfile
 import logging
+import multiprocessing
+import threading
+from collections import deque
+from queue import Queue
+import numpy as np
+import psutil
 import complex_model.DefaultSettings as DS
+from complex_model.ColumnarLoss import read_columnar_loss, COLUMNAR_LOSS_EXTENSION
+from complex_model.LossTransport import iter_live_losses
+from complex_model.RFException import ArgumentOutOfRangeException
 import time
 
 """
@@ -20,10 +33,39 @@ logging.basicConfig(level=logging.DEBUG if _DEBUG else logging.INFO,
 
 SUPPORTED_GUL_STREAMS = {"item": (1, 1), "coverage": (1, 2), "loss": (2, 1)}
 DEFAULT_GUL_STREAM = SUPPORTED_GUL_STREAMS["loss"]
+DEFAULT_FETCH_SIZE = 100000
+DEFAULT_POLL_INTERVAL = 1.0
+# seconds a read of the main database waits for the engine to release its lock
+DEFAULT_BUSY_TIMEOUT = 30.0
+# column of the event_batches table an engine sets once the partial loss of a batch is complete, the partial losses
+# of an engine which does not set it are only streamed once the engine exited
+EVENT_BATCH_COMPLETED_COLUMN = "completed"
+# fraction of the available memory the conversion workers and the ordered writer may hold in encoded buffers
+CONVERSION_MEMORY_FRACTION = 0.5
+# encoded gulcalc bytes (8 bytes per sample plus headers/separators) are assumed no larger than the sqlite file
+DEFAULT_PARTIAL_LOSS_SIZE = 2**30
+# a 16 bytes columnar row encodes into at most 24 bytes (a group header, the sample and a separator)
+COLUMNAR_ENCODED_SIZE_RATIO = 1.5
+# number of encoded chunks each output writer thread may buffer when fanning out to several streams
+DEFAULT_MAX_PENDING_CHUNKS = 16
+
+# fraction of the available memory a single conversion may use to sort a partial loss in memory
+SORT_MEMORY_FRACTION = 0.25
+# memory needed per row to sort in memory: the loaded rows, the lexsort permutation and the sorted copy
+SORT_BYTES_PER_ROW = 80
+
+LOSS_COLUMNS = "event_id, loc_id, sample_id, loss"
+LOSS_ORDER = "event_id, loc_id, sample_id"
+
+# columnar layout of a chunk fetched from the oasis_loss table
+LOSS_ROW_DTYPE = np.dtype([("event_id", np.int64), ("loc_id", np.int64), ("sample_id", np.int64),
+                           ("loss", np.float64)])
+# every record of the gulcalc stream (event/item header, sidx/loss sample, 0/0 separator) is 8 bytes wide
+GUL_RECORD_DTYPE = np.dtype([("first", np.uint32), ("second", np.uint32)])
 
 
 def gulcalc_sqlite_fp_to_bin(working_dir, db_fp, output, num_sample, stream_id=DEFAULT_GUL_STREAM,
-                             oasis_event_batch=None):
+                             oasis_event_batch=None, is_engine_running=None, pool_size=1, loss_threshold=None):
     """This transforms a sqlite result table (rf format) into oasis loss binary stream
 
     :param working_dir: working directory
@@ -32,28 +74,39 @@ def gulcalc_sqlite_fp_to_bin(working_dir, db_fp, output, num_sample, stream_id=D
     :param num_sample: number of samples in result
     :param stream_id: item, coverage or loss stream id
     :param oasis_event_batch: event batch id attached to this process
+    :param is_engine_running: optional callable returning True while the engine is still generating partial losses.
+        When set, each partial loss is streamed as soon as it is complete (pipelined mode)
+    :param pool_size: number of processes used to encode partial losses in parallel, capped by available memory
+    :param loss_threshold: optional threshold, samples with a zero loss or a loss below it are not streamed
     :return: OASIS compliant item or coverage binary stream
     """
-    start = time.time()
-    logging.info("STARTED: Transforming sqlite losses into gulcalc item/loss binary stream for oasis_event_batch "
-                 + str(oasis_event_batch))
-    gulcalc_create_header(output, num_sample, stream_id)
+    gulcalc_sqlite_fp_to_bins(working_dir, db_fp, [(output, stream_id)], num_sample, oasis_event_batch,
+                              is_engine_running, pool_size, loss_threshold)
 
-    con = sqlite3.connect(db_fp)
-    cur = con.cursor()
-    cur.execute("SELECT count(*) FROM event_batches")
-    num_partial = cur.fetchone()[0]
-    cur.execute("SELECT batch_id FROM event_batches ORDER BY batch_id")
-    add_first_separator = False
-    rc = 0
-    for batch_id in cur.fetchall():
-        logging.info("RUNNING: Streaming partial loss " + str(1 + int(batch_id[0])) + "/" + str(num_partial)
-                     + " for oasis_event_batch " + str(oasis_event_batch))
-        batch_res_fp = os.path.join(working_dir, "oasis_loss_{0}.db".format(batch_id[0]))
-        batch_res_con = sqlite3.connect(batch_res_fp)
-        rc = rc + gulcalc_sqlite_to_bin(batch_res_con, output, add_first_separator)
-        add_first_separator = True
-    con.close()
+
+def gulcalc_sqlite_fp_to_bins(working_dir, db_fp, outputs, num_sample, oasis_event_batch=None,
+                              is_engine_running=None, pool_size=1, loss_threshold=None):
+    """This transforms a sqlite result table (rf format) into one or several oasis loss binary streams in a single
+    pass: the partial losses are queried and encoded once and the records are fanned out to every output.
+
+    :param working_dir: working directory
+    :param db_fp: path to the sqlite database
+    :param outputs: list of (output, stream_id) where output is a distinct output stream
+    :param num_sample: number of samples in result
+    :param oasis_event_batch: event batch id attached to this process
+    :param is_engine_running: see gulcalc_sqlite_fp_to_bin
+    :param pool_size: see gulcalc_sqlite_fp_to_bin
+    :param loss_threshold: see gulcalc_sqlite_fp_to_bin
+    :return: OASIS compliant item and/or coverage binary streams
+    """
+    start = time.time()
+    logging.info("STARTED: Transforming sqlite losses into " + str(len(outputs))
+                 + " gulcalc item/loss binary stream(s) for oasis_event_batch " + str(oasis_event_batch))
+    for output, stream_id in outputs:
+        gulcalc_create_header(output, num_sample, stream_id)
+    with GulStreamWriter([output for output, _ in outputs]) as output:
+        rc = _gulcalc_partial_losses_to_bin(working_dir, db_fp, output, oasis_event_batch, is_engine_running,
+                                            pool_size, loss_threshold)
 
     hours, rem = divmod(time.time() - start, 3600)
     minutes, seconds = divmod(rem, 60)
@@ -62,7 +115,350 @@ def gulcalc_sqlite_fp_to_bin(working_dir, db_fp, output, num_sample, stream_id=D
                  + str(oasis_event_batch) + ": " + str(rc) + " rows were streamed in " + exec_time)
 
 
-def cursor_iterator(cursor, batchsize=100000):
+def gulcalc_live_to_bins(working_dir, db_fp, fd, outputs, num_sample, oasis_event_batch=None, wait_for_engine=None,
+                         pool_size=1, loss_threshold=None):
+    """This transforms the losses sent by the engine through the live transport (see LossTransport) into one or
+    several oasis loss binary streams. If the engine did not use the transport but registered partial losses, they
+    are streamed instead.
+
+    :param working_dir: working directory
+    :param db_fp: path to the sqlite database
+    :param fd: consumer end of the loss pipe
+    :param outputs: list of (output, stream_id) where output is a distinct output stream
+    :param num_sample: number of samples in result
+    :param oasis_event_batch: event batch id attached to this process
+    :param wait_for_engine: optional callable called at the end of the live stream, waits for the engine to exit and
+        raises if it failed
+    :param pool_size: see gulcalc_sqlite_fp_to_bin
+    :param loss_threshold: see gulcalc_sqlite_fp_to_bin
+    :return: number of rows streamed
+    """
+    start = time.time()
+    logging.info("STARTED: Transforming live losses into " + str(len(outputs))
+                 + " gulcalc item/loss binary stream(s) for oasis_event_batch " + str(oasis_event_batch))
+    for output, stream_id in outputs:
+        gulcalc_create_header(output, num_sample, stream_id)
+    with GulStreamWriter([output for output, _ in outputs]) as output:
+        rc = gulcalc_losses_to_bin(iter_live_loss_chunks(fd, loss_threshold), output, False)
+        if wait_for_engine is not None:
+            wait_for_engine()
+        if rc == 0 and has_event_batches(db_fp):
+            logging.warning("RUNNING: No live losses received, streaming partial losses for oasis_event_batch "
+                            + str(oasis_event_batch))
+            rc = _gulcalc_partial_losses_to_bin(working_dir, db_fp, output, oasis_event_batch, None, pool_size,
+                                                loss_threshold)
+
+    hours, rem = divmod(time.time() - start, 3600)
+    minutes, seconds = divmod(rem, 60)
+    exec_time = "{:0>2}:{:0>2}:{:05.2f}".format(int(hours), int(minutes), seconds)
+    logging.info("COMPLETED: Successfully generated live losses as gulcalc binary stream for event batch "
+                 + str(oasis_event_batch) + ": " + str(rc) + " rows were streamed in " + exec_time)
+    return rc
+
+
+def _gulcalc_partial_losses_to_bin(working_dir, db_fp, output, oasis_event_batch, is_engine_running, pool_size,
+                                   loss_threshold=None):
+    if is_engine_running is None:
+        batch_ids = get_event_batch_ids(db_fp)
+        num_partial = str(len(batch_ids))
+    else:
+        num_partial = "?"
+        logging.info("RUNNING: Streaming partial losses while the engine is running for oasis_event_batch "
+                     + str(oasis_event_batch))
+        batch_ids = iter_completed_batch_ids(db_fp, is_engine_running)
+    pool_size = cap_pool_size_by_memory(pool_size, working_dir)
+    if pool_size > 1:
+        logging.info("RUNNING: Encoding partial losses with " + str(pool_size) + " processes for oasis_event_batch "
+                     + str(oasis_event_batch))
+        rc = gulcalc_parallel_partial_losses_to_bin(working_dir, batch_ids, output, pool_size, num_partial,
+                                                    oasis_event_batch, loss_threshold)
+    else:
+        add_first_separator = False
+        rc = 0
+        for batch_id in batch_ids:
+            logging.info("RUNNING: Streaming partial loss " + str(1 + int(batch_id)) + "/" + num_partial
+                         + " for oasis_event_batch " + str(oasis_event_batch))
+            batch_rc = gulcalc_partial_loss_to_bin(get_partial_loss_fp(working_dir, batch_id), output,
+                                                   add_first_separator, loss_threshold=loss_threshold)
+            # a partial loss with no streamed row must not be followed by a separator
+            add_first_separator = add_first_separator or batch_rc > 0
+            rc = rc + batch_rc
+    return rc
+
+
+class GulStreamWriter(object):
+    """Forwards encoded gulcalc records to one or several output streams. With several outputs each one is written
+    by its own thread through a bounded queue, so that a slow consumer does not stall the other streams until its
+    buffer is full.
+    """
+
+    def __init__(self, outputs, max_pending=DEFAULT_MAX_PENDING_CHUNKS):
+        if not outputs:
+            raise ArgumentOutOfRangeException("At least one output stream is required")
+        self._outputs = outputs
+        self._queues = []
+        self._threads = []
+        self._errors = []
+        if len(outputs) > 1:
+            for output in outputs:
+                queue = Queue(maxsize=max_pending)
+                thread = threading.Thread(target=self._run, args=(output, queue), daemon=True)
+                thread.start()
+                self._queues.append(queue)
+                self._threads.append(thread)
+
+    def _run(self, output, queue):
+        while True:
+            data = queue.get()
+            if data is None:
+                return
+            if self._errors:
+                continue  # keep draining so that the producer is never blocked
+            try:
+                output.write(data)
+            except Exception as e:
+                self._errors.append(e)
+
+    def _raise_errors(self):
+        if self._errors:
+            raise self._errors[0]
+
+    def write(self, data):
+        if not self._queues:
+            return self._outputs[0].write(data)
+        self._raise_errors()
+        for queue in self._queues:
+            queue.put(data)
+        return len(data)
+
+    def close(self, raise_errors=True):
+        for queue in self._queues:
+            queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._queues = []
+        self._threads = []
+        if raise_errors:
+            self._raise_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(raise_errors=exc_type is None)
+
+
+def cap_pool_size_by_memory(pool_size, working_dir):
+    """Caps the number of conversion processes so that the encoded buffers held by the workers and the ordered
+    writer (up to two per process) fit in a fraction of the available memory
+
+    :param pool_size: requested number of processes
+    :param working_dir: working directory containing the partial losses
+    :return: number of processes to use
+    """
+    pool_size = min(max(1, int(pool_size)), multiprocessing.cpu_count())
+    if pool_size == 1:
+        return 1
+    partial_loss_sizes = [get_encoded_size_bound(fp) for fp in get_partial_loss_fps(working_dir)]
+    buffer_size = max(partial_loss_sizes) if partial_loss_sizes else DEFAULT_PARTIAL_LOSS_SIZE
+    memory_budget = psutil.virtual_memory().available * CONVERSION_MEMORY_FRACTION
+    return int(max(1, min(pool_size, memory_budget // (2 * max(1, buffer_size)))))
+
+
+def get_partial_loss_fps(working_dir):
+    """Returns the partial losses of the working directory, resolved as get_partial_loss_fp does"""
+    batch_ids = set()
+    for fp in glob.glob(os.path.join(working_dir, "oasis_loss_*")):
+        batch_id, extension = os.path.splitext(os.path.basename(fp)[len("oasis_loss_"):])
+        if extension in (".db", COLUMNAR_LOSS_EXTENSION) and batch_id.isdigit():
+            batch_ids.add(int(batch_id))
+    return [get_partial_loss_fp(working_dir, batch_id) for batch_id in sorted(batch_ids)]
+
+
+def get_encoded_size_bound(batch_res_fp):
+    """Returns an upper bound of the size of a partial loss once encoded into a gulcalc byte buffer"""
+    size = os.path.getsize(batch_res_fp)
+    if batch_res_fp.endswith(COLUMNAR_LOSS_EXTENSION):
+        return int(size * COLUMNAR_ENCODED_SIZE_RATIO)
+    return size
+
+
+def encode_partial_loss(batch_res_fp, sort_memory=None, loss_threshold=None):
+    """Encodes a partial loss database into an in memory gulcalc byte buffer (process pool worker). The buffer does
+    not start with a separator: the writer adds it when the buffer follows streamed rows.
+
+    :param batch_res_fp: path to the partial loss database
+    :param sort_memory: see gulcalc_sqlite_to_bin
+    :param loss_threshold: see gulcalc_sqlite_to_bin
+    :return: a tuple (number of rows, encoded bytes)
+    """
+    output = io.BytesIO()
+    rc = gulcalc_partial_loss_to_bin(batch_res_fp, output, False, sort_memory=sort_memory,
+                                     loss_threshold=loss_threshold)
+    return rc, output.getvalue()
+
+
+def gulcalc_parallel_partial_losses_to_bin(working_dir, batch_ids, output, pool_size, num_partial="?",
+                                           oasis_event_batch=None, loss_threshold=None):
+    """Encodes partial losses in a process pool and writes them to the output in batch order. At most 2 * pool_size
+    encoded buffers are in flight so that memory stays bounded.
+
+    :param working_dir: working directory containing the partial losses
+    :param batch_ids: iterable of batch ids in streaming order
+    :param output: output stream where results will be written to
+    :param pool_size: number of processes
+    :param num_partial: number of partial losses (for logging)
+    :param oasis_event_batch: event batch id attached to this process
+    :param loss_threshold: see gulcalc_sqlite_to_bin
+    :return: number of rows streamed
+    """
+    rc = 0
+    pending = deque()
+
+    def write_next():
+        batch_id, result = pending.popleft()
+        batch_rc, batch_bytes = result.get()
+        if rc > 0 and batch_rc > 0:
+            output.write(struct.pack('Q', 0))  # sidx/loss 0/0 as separator between partial losses
+        output.write(batch_bytes)
+        logging.info("RUNNING: Streamed partial loss " + str(1 + int(batch_id)) + "/" + num_partial
+                     + " for oasis_event_batch " + str(oasis_event_batch))
+        return batch_rc
+
+    # the workers share the in memory sort budget
+    sort_memory = psutil.virtual_memory().available * SORT_MEMORY_FRACTION / pool_size
+    with multiprocessing.Pool(pool_size) as pool:
+        for batch_id in batch_ids:
+            pending.append((batch_id, pool.apply_async(encode_partial_loss,
+                                                       (get_partial_loss_fp(working_dir, batch_id), sort_memory,
+                                                        loss_threshold))))
+            while pending and (len(pending) >= 2 * pool_size or pending[0][1].ready()):
+                rc = rc + write_next()
+        while pending:
+            rc = rc + write_next()
+    return rc
+
+
+def get_partial_loss_fp(working_dir, batch_id):
+    """Returns the path of a partial loss, the columnar format is preferred over sqlite when both exist"""
+    columnar_fp = os.path.join(working_dir, "oasis_loss_{0}{1}".format(batch_id, COLUMNAR_LOSS_EXTENSION))
+    if os.path.isfile(columnar_fp):
+        return columnar_fp
+    return os.path.join(working_dir, "oasis_loss_{0}.db".format(batch_id))
+
+
+def gulcalc_partial_loss_to_bin(batch_res_fp, output, add_first_separator, fetch_size=DEFAULT_FETCH_SIZE,
+                                sort_memory=None, loss_threshold=None):
+    """This transforms a partial loss, either a sqlite database or a columnar loss file, into oasis loss binary stream
+
+    :param batch_res_fp: path to the partial loss
+    :param output: output stream where results will be written to
+    :param add_first_separator: see gulcalc_sqlite_to_bin
+    :param fetch_size: see gulcalc_sqlite_to_bin
+    :param sort_memory: see gulcalc_sqlite_to_bin
+    :param loss_threshold: see gulcalc_sqlite_to_bin
+    :return: number of rows written
+    """
+    if batch_res_fp.endswith(COLUMNAR_LOSS_EXTENSION):
+        return gulcalc_columnar_to_bin(batch_res_fp, output, add_first_separator, fetch_size, loss_threshold)
+    con = sqlite3.connect(batch_res_fp)
+    try:
+        return gulcalc_sqlite_to_bin(con, output, add_first_separator, fetch_size, sort_memory, loss_threshold)
+    finally:
+        con.close()
+
+
+def connect_read_only(db_fp, busy_timeout=DEFAULT_BUSY_TIMEOUT):
+    """Opens the main database read-only, waiting up to busy_timeout seconds while the engine holds a lock on it"""
+    return sqlite3.connect("file:" + db_fp + "?mode=ro", uri=True, timeout=busy_timeout)
+
+
+def get_event_batch_ids(db_fp):
+    """Returns the sorted list of partial loss batch ids registered by the engine in the event_batches table
+
+    :param db_fp: path to the sqlite database
+    :return: list of batch ids
+    """
+    con = connect_read_only(db_fp)
+    try:
+        cur = con.cursor()
+        # a resumed engine may register a batch again
+        cur.execute("SELECT DISTINCT batch_id FROM event_batches ORDER BY batch_id")
+        return [row[0] for row in cur.fetchall()]
+    finally:
+        con.close()
+
+
+def has_event_batches(db_fp):
+    """Returns True if the engine registered partial losses in the event_batches table"""
+    con = connect_read_only(db_fp)
+    try:
+        cur = con.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='event_batches'")
+        if cur.fetchone() is None:
+            return False
+        cur.execute("SELECT 1 FROM event_batches LIMIT 1")
+        return cur.fetchone() is not None
+    finally:
+        con.close()
+
+
+def get_event_batch_states(db_fp):
+    """Returns the partial losses registered by the engine in the event_batches table and whether the engine flagged
+    them as complete (see EVENT_BATCH_COMPLETED_COLUMN). No batch is complete if the engine does not flag them.
+
+    :param db_fp: path to the sqlite database
+    :return: sorted list of (batch id, completed)
+    """
+    con = connect_read_only(db_fp)
+    try:
+        cur = con.cursor()
+        columns = [row[1] for row in cur.execute("PRAGMA table_info(event_batches)").fetchall()]
+        if EVENT_BATCH_COMPLETED_COLUMN not in columns:
+            return [(batch_id, False) for batch_id in get_event_batch_ids(db_fp)]
+        cur.execute("SELECT batch_id, MAX(COALESCE([" + EVENT_BATCH_COMPLETED_COLUMN + "], 0)) FROM event_batches "
+                    "GROUP BY batch_id ORDER BY batch_id")
+        return [(batch_id, bool(completed)) for batch_id, completed in cur.fetchall()]
+    finally:
+        con.close()
+
+
+def iter_completed_batch_ids(db_fp, is_engine_running, poll_interval=DEFAULT_POLL_INTERVAL):
+    """Watches the event_batches table and yields partial loss batch ids as soon as they are complete. While the
+    engine is running a batch is only complete once the engine flagged it in the completed column of event_batches,
+    batches are yielded in order up to the first registered batch that is not complete. Once the engine has exited
+    every remaining batch is yielded, so nothing is streamed early by an engine which does not flag its batches.
+
+    :param db_fp: path to the sqlite database containing the event_batches table
+    :param is_engine_running: callable returning True while the engine is still running
+    :param poll_interval: number of seconds between two checks
+    :return: a generator of batch ids
+    """
+    streamed = set()
+    while True:
+        running = is_engine_running()
+        if running:
+            try:
+                states = get_event_batch_states(db_fp)
+            except sqlite3.Error:  # event_batches not created yet or locked by the engine
+                states = []
+        else:
+            states = [(batch_id, True) for batch_id in get_event_batch_ids(db_fp)]
+
+        for batch_id, completed in states:
+            if not completed:
+                # the later batches wait so that batches registered in order are streamed in order
+                break
+            if batch_id not in streamed:
+                streamed.add(batch_id)
+                yield batch_id
+
+        if not running:
+            return
+        time.sleep(poll_interval)
+
+
+def cursor_iterator(cursor, batchsize=DEFAULT_FETCH_SIZE):
     """An iterator that uses fetchmany to keep memory usage down
 
     :param cursor: a sqlite db cursor
@@ -77,6 +473,20 @@ def cursor_iterator(cursor, batchsize=100000):
             yield result
 
 
+def cursor_array_iterator(cursor, batchsize=DEFAULT_FETCH_SIZE):
+    """An iterator that uses fetchmany to return (event_id, loc_id, sample_id, loss) rows as numpy chunks
+
+    :param cursor: a sqlite db cursor on a query returning event_id, loc_id, sample_id and loss
+    :param batchsize: size of the batch to be fetched
+    :return: a generator of LOSS_ROW_DTYPE structured arrays
+    """
+    while True:
+        results = cursor.fetchmany(batchsize)
+        if not results:
+            break
+        yield np.array(results, dtype=LOSS_ROW_DTYPE)
+
+
 def gulcalc_create_header(output, num_sample, stream_id=DEFAULT_GUL_STREAM):
     if stream_id not in list(SUPPORTED_GUL_STREAMS.values()) or not num_sample > 0:
         return
@@ -85,31 +495,285 @@ def gulcalc_create_header(output, num_sample, stream_id=DEFAULT_GUL_STREAM):
     output.write(struct.pack('i', num_sample))
 
 
-def gulcalc_sqlite_to_bin(con, output, add_first_separator):
+def gulcalc_encode_chunk(rows, last_key=(0, 0), add_first_separator=False):
+    """This encodes a sorted chunk of losses into gulcalc records. The (event_id, loc_id) groups are found with
+    vectorized diffs so that each chunk is assembled into a single preallocated buffer.
+
+    :param rows: LOSS_ROW_DTYPE array sorted by event_id, loc_id, sample_id
+    :param last_key: (event_id, loc_id) of the last row encoded before this chunk, (0, 0) if none
+    :param add_first_separator: boolean flag to add separator 0/0 before the first group
+    :return: a tuple (GUL_RECORD_DTYPE buffer, (event_id, loc_id) of the last row in the chunk)
+    """
+    num_rows = len(rows)
+    if num_rows == 0:
+        return np.zeros(0, dtype=GUL_RECORD_DTYPE), last_key
+    event_ids = rows["event_id"]
+    loc_ids = rows["loc_id"]
+
+    prev_event_ids = np.empty(num_rows, dtype=np.int64)
+    prev_event_ids[0] = last_key[0]
+    prev_event_ids[1:] = event_ids[:-1]
+    prev_loc_ids = np.empty(num_rows, dtype=np.int64)
+    prev_loc_ids[0] = last_key[1]
+    prev_loc_ids[1:] = loc_ids[:-1]
+
+    new_group = (event_ids != prev_event_ids) | (loc_ids != prev_loc_ids)
+    separator = new_group & ((prev_event_ids != 0) | (prev_loc_ids != 0) | bool(add_first_separator))
+
+    # each row emits a sample, optionally preceded by a header and a 0/0 separator (left zeroed)
+    sample_pos = np.cumsum(1 + new_group.astype(np.int64) + separator) - 1
+    buffer = np.zeros(sample_pos[-1] + 1, dtype=GUL_RECORD_DTYPE)
+    header_pos = sample_pos[new_group] - 1
+    buffer["first"][header_pos] = event_ids[new_group].astype(np.uint32)
+    buffer["second"][header_pos] = loc_ids[new_group].astype(np.uint32)
+    buffer["first"][sample_pos] = rows["sample_id"].astype(np.int32).view(np.uint32)
+    buffer["second"][sample_pos] = rows["loss"].astype(np.float32).view(np.uint32)
+
+    return buffer, (int(event_ids[-1]), int(loc_ids[-1]))
+
+
+def gulcalc_sqlite_to_bin(con, output, add_first_separator, fetch_size=DEFAULT_FETCH_SIZE, sort_memory=None,
+                          loss_threshold=None):
     """This transforms a sqlite result table (rf format) into oasis loss binary stream
 
     :param con: sqlite connection to result batch
     :param output: output stream where results will be written to
     :param add_first_separator: boolean flag to add separator 0/0 for second, third, ... batches
-    :return: OASIS compliant item or coverage binary stream
+    :param fetch_size: number of rows fetched, encoded and written at once
+    :param sort_memory: number of bytes that can be used to sort the losses in memory, defaults to a fraction of the
+        available memory
+    :param loss_threshold: optional threshold. When greater than 0, samples (sidx > 0) with a zero loss or a loss
+        below the threshold are filtered by the sqlite query. The special samples (sidx < 0) of every (event, item)
+        are always streamed
+    :return: number of rows written to the OASIS compliant item or coverage binary stream
     """
-    cur = con.cursor()
-    cur.execute("SELECT event_id, loc_id, sample_id, loss FROM oasis_loss ORDER BY event_id, loc_id, sample_id")
+    chunks = iter_sorted_losses(con, fetch_size, sort_memory, loss_threshold)
+    return gulcalc_losses_to_bin(chunks, output, add_first_separator)
+
+
+def gulcalc_columnar_to_bin(fp, output, add_first_separator, fetch_size=DEFAULT_FETCH_SIZE, loss_threshold=None):
+    """This transforms a columnar partial loss (see ColumnarLoss) into oasis loss binary stream. The columns are
+    memory mapped and encoded chunk by chunk.
 
+    :param fp: path to the columnar loss file
+    :param output: output stream where results will be written to
+    :param add_first_separator: see gulcalc_sqlite_to_bin
+    :param fetch_size: see gulcalc_sqlite_to_bin
+    :param loss_threshold: see gulcalc_sqlite_to_bin
+    :return: number of rows written to the OASIS compliant item or coverage binary stream
+    """
+    columns, is_sorted = read_columnar_loss(fp)
+    chunks = iter_columnar_losses(columns, is_sorted, fetch_size, loss_threshold)
+    return gulcalc_losses_to_bin(chunks, output, add_first_separator)
+
+
+def gulcalc_losses_to_bin(chunks, output, add_first_separator):
+    """Encodes sorted LOSS_ROW_DTYPE chunks into oasis loss binary stream
+
+    :param chunks: iterable of sorted LOSS_ROW_DTYPE chunks, already filtered by loss_threshold
+    :param output: output stream where results will be written to
+    :param add_first_separator: see gulcalc_sqlite_to_bin
+    :return: number of rows written
+    """
     last_key = (0, 0)
     rc = 0
-    for row in cursor_iterator(cur):
-        current_key = (int(row[0]), int(row[1]))
-        if not last_key == current_key:
-            if not last_key == (0, 0) or add_first_separator:
-                output.write(struct.pack('Q', 0))  # sidx/loss 0/0 as separator
-            output.write(struct.pack('II', current_key[0], current_key[1]))
-            last_key = (int(row[0]), int(row[1]))
-        output.write(struct.pack('if', int(row[2]), float(row[3])))
-        rc = rc + 1
+    for rows in chunks:
+        buffer, last_key = gulcalc_encode_chunk(rows, last_key, add_first_separator)
+        output.write(memoryview(buffer).cast('B'))
+        rc = rc + len(rows)
     return rc
 
 
+def columns_to_losses(columns, index):
+    """Gathers rows of memory mapped loss columns into a LOSS_ROW_DTYPE array
+
+    :param columns: dictionary of event_id, loc_id, sample_id and loss arrays
+    :param index: slice or integer array of the rows to gather
+    :return: LOSS_ROW_DTYPE array
+    """
+    event_ids = columns["event_id"][index]
+    rows = np.empty(len(event_ids), dtype=LOSS_ROW_DTYPE)
+    rows["event_id"] = event_ids
+    for name in ("loc_id", "sample_id", "loss"):
+        rows[name] = columns[name][index]
+    return rows
+
+
+def iter_columnar_losses(columns, is_sorted=False, fetch_size=DEFAULT_FETCH_SIZE, loss_threshold=None):
+    """Iterates over memory mapped loss columns in event_id, loc_id, sample_id order. The order is checked chunk by
+    chunk unless flagged in the file and rows are lexsorted only if needed.
+
+    :param columns: dictionary of event_id, loc_id, sample_id and loss arrays
+    :param is_sorted: True if the rows are known to be ordered
+    :param fetch_size: size of the chunks returned
+    :param loss_threshold: optional threshold, see get_loss_filter
+    :return: a generator of LOSS_ROW_DTYPE chunks
+    """
+    num_rows = len(columns["event_id"])
+    if not is_sorted:
+        is_sorted = all(is_sorted_losses(columns_to_losses(columns, slice(max(0, inx - 1), inx + fetch_size)))
+                        for inx in range(0, num_rows, fetch_size))
+    order = None
+    if not is_sorted:
+        order = np.lexsort((columns["sample_id"], columns["loc_id"], columns["event_id"]))
+    for inx in range(0, num_rows, fetch_size):
+        rows = columns_to_losses(columns, slice(inx, inx + fetch_size) if order is None
+                                 else order[inx:inx + fetch_size])
+        rows = filter_losses(rows, loss_threshold)
+        if len(rows) > 0:
+            yield rows
+
+
+def iter_live_loss_chunks(fd, loss_threshold=None):
+    """Converts the records received through the live transport into LOSS_ROW_DTYPE chunks. The records are not
+    sorted: the producer sends them in stream order.
+
+    :param fd: consumer end of the loss pipe
+    :param loss_threshold: optional threshold, see get_loss_filter
+    :return: a generator of LOSS_ROW_DTYPE chunks
+    """
+    for records in iter_live_losses(fd):
+        rows = filter_losses(columns_to_losses(records, slice(None)), loss_threshold)
+        if len(rows) > 0:
+            yield rows
+
+
+def is_loss_filtered(loss_threshold=None):
+    """Samples are only filtered when a loss threshold greater than 0 is set"""
+    return loss_threshold is not None and float(loss_threshold) > 0
+
+
+def filter_losses(rows, loss_threshold=None):
+    """Removes the samples with a zero loss or a loss below loss_threshold, same as get_loss_filter"""
+    if not is_loss_filtered(loss_threshold):
+        return rows
+    loss = rows["loss"]
+    return rows[(rows["sample_id"] < 0) | ((loss > 0) & (loss >= float(loss_threshold)))]
+
+
+def get_loss_filter(loss_threshold=None):
+    """Returns the WHERE clause and its parameters pushing the loss threshold down to the sqlite query"""
+    if not is_loss_filtered(loss_threshold):
+        return "", ()
+    return " WHERE sample_id < 0 OR (loss > 0 AND loss >= ?)", (float(loss_threshold),)
+
+
+def is_sort_free(cur, query, params=()):
+    """Checks whether sqlite can satisfy the ORDER BY of a query without building a temporary b-tree, i.e. the table
+    is clustered or indexed in that order
+
+    :param cur: sqlite cursor
+    :param query: select query with an ORDER BY clause
+    :param params: parameters of the query
+    :return: True if no sort is required
+    """
+    cur.execute("EXPLAIN QUERY PLAN " + query, params)
+    return not any("TEMP B-TREE" in str(row[-1]).upper() for row in cur.fetchall())
+
+
+def is_sorted_losses(rows):
+    """Vectorized check that rows are ordered by event_id, loc_id, sample_id"""
+    if len(rows) < 2:
+        return True
+    d_event = np.diff(rows["event_id"])
+    d_loc = np.diff(rows["loc_id"])
+    d_sample = np.diff(rows["sample_id"])
+    return bool(np.all((d_event > 0) | ((d_event == 0) & ((d_loc > 0) | ((d_loc == 0) & (d_sample >= 0))))))
+
+
+def sort_losses(rows):
+    """Orders rows by event_id, loc_id, sample_id with a stable lexsort, unless they are already ordered"""
+    if is_sorted_losses(rows):
+        return rows
+    return rows[np.lexsort((rows["sample_id"], rows["loc_id"], rows["event_id"]))]
+
+
+def iter_chunks(rows, chunk_size):
+    for inx in range(0, len(rows), chunk_size):
+        yield rows[inx:inx + chunk_size]
+
+
+def iter_sorted_losses(con, fetch_size=DEFAULT_FETCH_SIZE, sort_memory=None, loss_threshold=None):
+    """Iterates over the oasis_loss table in event_id, loc_id, sample_id order without relying on the sqlite sorter:
+        1. if the table is indexed or clustered in that order, rows are streamed as returned by sqlite
+        2. if the table fits in sort_memory, rows are loaded into numpy and ordered with a stable lexsort
+        3. otherwise rows are distributed by event_id range into spill files that are sorted one at a time
+
+    :param con: sqlite connection to result batch
+    :param fetch_size: size of the chunks returned
+    :param sort_memory: number of bytes that can be used to sort in memory
+    :param loss_threshold: optional threshold filtering samples in the sqlite query, see get_loss_filter
+    :return: a generator of LOSS_ROW_DTYPE chunks
+    """
+    cur = con.cursor()
+    where, params = get_loss_filter(loss_threshold)
+    ordered_query = "SELECT " + LOSS_COLUMNS + " FROM oasis_loss" + where + " ORDER BY " + LOSS_ORDER
+    if is_sort_free(cur, ordered_query, params):
+        cur.execute(ordered_query, params)
+        for rows in cursor_array_iterator(cur, fetch_size):
+            yield rows
+        return
+
+    if sort_memory is None:
+        sort_memory = psutil.virtual_memory().available * SORT_MEMORY_FRACTION
+    cur.execute("SELECT count(*) FROM oasis_loss")
+    num_rows = cur.fetchone()[0]
+    if num_rows * SORT_BYTES_PER_ROW <= sort_memory:
+        cur.execute("SELECT " + LOSS_COLUMNS + " FROM oasis_loss" + where, params)
+        chunks = list(cursor_array_iterator(cur, fetch_size))
+        rows = np.concatenate(chunks) if chunks else np.zeros(0, dtype=LOSS_ROW_DTYPE)
+        del chunks
+        for chunk in iter_chunks(sort_losses(rows), fetch_size):
+            yield chunk
+    else:
+        for chunk in iter_external_sorted_losses(con, num_rows, fetch_size, sort_memory, loss_threshold):
+            yield chunk
+
+
+def iter_external_sorted_losses(con, num_rows, fetch_size, sort_memory, loss_threshold=None):
+    """Bounded memory sort: rows are distributed by event_id range into spill files (in the directory of the partial
+    loss) which are then loaded, lexsorted and returned one after another
+
+    :param con: sqlite connection to result batch
+    :param num_rows: number of rows in the oasis_loss table
+    :param fetch_size: size of the chunks returned
+    :param sort_memory: number of bytes that can be used to sort a spill file in memory
+    :param loss_threshold: optional threshold filtering samples in the sqlite query, see get_loss_filter
+    :return: a generator of LOSS_ROW_DTYPE chunks
+    """
+    cur = con.cursor()
+    where, params = get_loss_filter(loss_threshold)
+    cur.execute("SELECT min(event_id), max(event_id) FROM oasis_loss")
+    min_event_id, max_event_id = cur.fetchone()
+    event_span = int(max_event_id) - int(min_event_id) + 1
+    # twice as many buckets as needed to absorb a non uniform distribution of losses per event
+    num_buckets = int(min(event_span, max(2, 2 * math.ceil(num_rows * SORT_BYTES_PER_ROW / sort_memory))))
+
+    db_fp = [row[2] for row in cur.execute("PRAGMA database_list").fetchall() if row[1] == "main"][0]
+    spill_dir = os.path.dirname(db_fp) if db_fp else None
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+        bucket_fps = [os.path.join(tmp_dir, "bucket_{0}.bin".format(i)) for i in range(num_buckets)]
+        bucket_files = [open(fp, "wb") for fp in bucket_fps]
+        try:
+            cur.execute("SELECT " + LOSS_COLUMNS + " FROM oasis_loss" + where, params)
+            for rows in cursor_array_iterator(cur, fetch_size):
+                buckets = (rows["event_id"] - int(min_event_id)) * num_buckets // event_span
+                order = np.argsort(buckets, kind="stable")
+                rows = rows[order]
+                bounds = np.searchsorted(buckets[order], np.arange(num_buckets + 1))
+                for bucket in np.nonzero(np.diff(bounds))[0]:
+                    rows[bounds[bucket]:bounds[bucket + 1]].tofile(bucket_files[bucket])
+        finally:
+            for bucket_file in bucket_files:
+                bucket_file.close()
+
+        for fp in bucket_fps:
+            rows = np.fromfile(fp, dtype=LOSS_ROW_DTYPE)
+            os.remove(fp)
+            for chunk in iter_chunks(sort_losses(rows), fetch_size):
+                yield chunk
+
+
 if __name__ == "__main__":
     import sys
     if len(sys.argv) <= 1:
@@ -1,22 +1,116 @@
-import itertools
+import functools
 import json
+import logging
 import numbers
 import math
-import sqlite3
+import multiprocessing
 import os
 from datetime import date
 
+import numpy as np
+import pandas as pd
+
 from oasislmf.utils.coverages import COVERAGE_TYPES
 from oasislmf.utils.status import OASIS_KEYS_STATUS
 from oasislmf.preparation.lookup import OasisBaseKeysLookup
 
-from complex_model.PostcodeLookup import PostcodeLookup
+from complex_model.PostcodeLookup import PostcodeLookup, POSTCODE_NOT_FOUND
 from complex_model.PostcodeDictionary import POSTCODE_CONCORDANCE, POSTCODE_SET, DELIVERY_POSTCODE_SET
 from complex_model.RFException import LocationLookupException, LocationNotModelledException
 from complex_model.Common import *
-from complex_model.DefaultSettings import COUNTRY_CODE, BASE_DB_NAME
+from complex_model.DefaultSettings import COUNTRY_CODE, BASE_DB_NAME, DEFAULT_KEYS_POOL_SIZE, DEFAULT_KEYS_CHUNK_SIZE, \
+    DEFAULT_GNAF_INDEX_DIRECTORY
+from complex_model.GnafIndex import GnafIndex
 from complex_model.utils import is_integer, to_bool, is_float, is_number
 
+KEYS_COLUMNS = ['loc_id', 'peril_id', 'coverage_type', 'model_data', 'status', 'message']
+TIV_COLUMNS = {
+    COVERAGE_TYPES['buildings']['id']: "buildingtiv",
+    COVERAGE_TYPES['contents']['id']: "contentstiv",
+    COVERAGE_TYPES['bi']['id']: "bitiv",
+    COVERAGE_TYPES['other']['id']: "othertiv",
+}
+
+
+# lookup and locations inherited by the forked workers of the parallel lookup
+_FORKED_LOOKUP = None
+
+
+def _process_forked_locations(bounds):
+    """Looks up a slice of the locations of the parallel lookup (process pool worker)"""
+    lookup, locs = _FORKED_LOOKUP
+    return lookup._process_locations(locs.iloc[bounds[0]:bounds[1]])
+
+
+def _get_column(locs, column, dtype):
+    """Returns the values of a column as seen in the rows of locs.iterrows() (upcast to the dtype of the frame)"""
+    if column not in locs:
+        return None
+    if dtype == object:
+        return locs[column].tolist()
+    return locs[column].astype(dtype).tolist()
+
+
+def _map_values(values, func):
+    """Applies func once per distinct value (values equal but of different types are distinguished)"""
+    keys = list(zip(map(type, values), values))
+    try:
+        results = dict.fromkeys(keys)
+    except TypeError:  # unhashable values
+        return [func(value) for value in values]
+    for key in results:
+        results[key] = func(key[1])
+    return [results[key] for key in keys]
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return np.nan
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+
+def _to_floats(values):
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (ValueError, TypeError):
+        return np.array(_map_values(values, _to_float), dtype=np.float64)
+
+
+def _json_column(values, null_mask=None):
+    """json encodes a column of values, the masked values are encoded as null"""
+    res = np.array(_map_values(values, json.dumps), dtype=object)
+    if null_mask is not None:
+        res[null_mask] = "null"
+    return res
+
+
+def _is_set(values):
+    return np.array([value is not None and not value == 0 for value in values], dtype=bool)
+
+
+def _json_type(mask, resolution):
+    """json encodes the resolution type of the masked values, null otherwise"""
+    return np.where(mask, str(resolution.value), "null").astype(object)
+
+
+def _set_failure(status, message, pending, mask, status_id, text):
+    """Records the failure of the keys still pending that match mask, the first failure of a key is kept"""
+    mask = pending & mask
+    status[mask] = status_id
+    if isinstance(text, np.ndarray):
+        message[mask] = text[mask]
+    else:
+        message[mask] = text
+    pending &= ~mask
+
 
 class HailAUSKeysLookup(OasisBaseKeysLookup):
     def __init__(self,
@@ -42,19 +136,36 @@ class HailAUSKeysLookup(OasisBaseKeysLookup):
         if model_name is not None and model_name.lower() in PerilSet.keys():
             self._peril_id = PerilSet[model_name.lower()]['OED_ID']
         self._postcode_lookup = None
-        self._supported_gnaf = []
+        # the supported GNAF addresses are loaded on first use, see _supported_gnaf
+        self._gnaf_db_fp = None
+        self._gnaf_index = []
         if self.keys_file_dir:
             self._postcode_lookup = PostcodeLookup(keys_file_dir=self.keys_file_dir)
-            db = sqlite3.connect(os.path.abspath(
-                os.path.join(self.keys_file_dir, '..', BASE_DB_NAME)))
-            cur = db.cursor()
-            cur.execute("select address_id from rf_address;")
-            res = cur.fetchall()
-            db.close()
-            self._supported_gnaf = set([x[0] for x in res])
+            self._gnaf_db_fp = os.path.abspath(os.path.join(self.keys_file_dir, '..', BASE_DB_NAME))
+            self._gnaf_index = None
+        self._pool_size = DEFAULT_KEYS_POOL_SIZE
+        if "RF_KEYS_POOL_SIZE" in os.environ and is_integer(os.environ["RF_KEYS_POOL_SIZE"]):
+            self._pool_size = max(1, int(os.environ["RF_KEYS_POOL_SIZE"]))
+        self._chunk_size = DEFAULT_KEYS_CHUNK_SIZE
+        if "RF_KEYS_CHUNK_SIZE" in os.environ and is_integer(os.environ["RF_KEYS_CHUNK_SIZE"]):
+            self._chunk_size = max(1, int(os.environ["RF_KEYS_CHUNK_SIZE"]))
         self._codes_mapping = {"construction": {"column": "constructioncode", "code": OED_CONSTRUCTION_CODE},
                                "occupancy": {"column": "occupancycode", "code": OED_OCCUPANCY_CODE}}
 
+    @property
+    def _supported_gnaf(self):
+        """GNAF address ids of the model, memory mapped from the GNAF index of the model database"""
+        if self._gnaf_index is None:
+            gnaf_index_dir = DEFAULT_GNAF_INDEX_DIRECTORY
+            if "RF_GNAF_INDEX_DIRECTORY" in os.environ and os.environ["RF_GNAF_INDEX_DIRECTORY"]:
+                gnaf_index_dir = os.environ["RF_GNAF_INDEX_DIRECTORY"]
+            self._gnaf_index = GnafIndex.load(self._gnaf_db_fp, gnaf_index_dir)
+        return self._gnaf_index
+
+    @_supported_gnaf.setter
+    def _supported_gnaf(self, address_ids):
+        self._gnaf_index = address_ids
+
     def _get_lob_id(self, record):
         """This transforms the occupancy error_code into Multi-Peril Workbench specified line of business"""
         try:
@@ -321,6 +432,13 @@ class HailAUSKeysLookup(OasisBaseKeysLookup):
             return False
         return address_id in self._supported_gnaf
 
+    def _are_valid_addresses(self, address_ids):
+        """Batch membership of GNAF address ids"""
+        supported_gnaf = self._supported_gnaf
+        if isinstance(supported_gnaf, GnafIndex):
+            return supported_gnaf.contains(address_ids)
+        return [address_id in supported_gnaf for address_id in address_ids]
+
     def is_valid_postcode(self, postcode):
         if not is_integer(postcode):
             return False
@@ -380,8 +498,287 @@ class HailAUSKeysLookup(OasisBaseKeysLookup):
             }
 
     def process_locations(self, locs):
-        locs_seq = (record for _, record in locs.iterrows())
-        for loc, coverage_type in itertools.product(locs_seq, self._coverage_types):
-            ret = self.process_location(loc, coverage_type)
-            if ret is not None:
-                yield ret
+        """Looks up the keys of the locations for each coverage type. The locations are split in chunks looked up in
+        a process pool when RF_KEYS_POOL_SIZE is greater than 1.
+
+        :param locs: OED locations as a DataFrame (lower case column names)
+        :return: a DataFrame of keys (status success, with model_data) and errors (status fail or nomatch, message)
+        """
+        num_chunks = -(-len(locs) // self._chunk_size)
+        pool_size = min(self._pool_size, multiprocessing.cpu_count(), num_chunks)
+        if pool_size > 1 and "fork" in multiprocessing.get_all_start_methods():
+            return self._process_locations_parallel(locs, pool_size, self._chunk_size)
+        return self._process_locations(locs)
+
+    def _process_locations_parallel(self, locs, pool_size, chunk_size):
+        """Looks up chunks of the locations in a pool of forked processes. The workers inherit the lookup data
+        (postcode boundaries, supported GNAF addresses) and the locations from the parent instead of receiving a copy,
+        only the results are sent back. The results are merged in the order of the locations.
+
+        :param locs: OED locations as a DataFrame
+        :param pool_size: number of processes
+        :param chunk_size: number of locations per chunk
+        :return: a DataFrame of keys and errors, see process_locations
+        """
+        global _FORKED_LOOKUP
+        bounds = [(start, min(start + chunk_size, len(locs))) for start in range(0, len(locs), chunk_size)]
+        _FORKED_LOOKUP = (self, locs)
+        try:
+            with multiprocessing.get_context("fork").Pool(pool_size) as pool:
+                results = pool.map(_process_forked_locations, bounds, chunksize=1)
+        finally:
+            _FORKED_LOOKUP = None
+        return pd.concat(results, ignore_index=True)
+
+    def _process_locations(self, locs):
+        """Looks up the keys of the locations for each coverage type. The validations of process_location are applied
+        column by column to the whole frame: the status and message of a key are the ones of the first check the
+        row-wise lookup would fail.
+
+        :param locs: OED locations as a DataFrame (lower case column names)
+        :return: a DataFrame of keys (status success, with model_data) and errors (status fail or nomatch, message)
+        """
+        num_locs = len(locs)
+        num_covs = len(self._coverage_types)
+        if num_locs == 0:
+            return pd.DataFrame(columns=KEYS_COLUMNS)
+        dtype = locs.iloc[:0].values.dtype
+        column = functools.partial(_get_column, locs, dtype=dtype)
+        loc_ids = column('loc_id')
+
+        # per location
+        geo = self._get_location_geography(locs, dtype)
+        construction_codes = column('constructioncode')
+        if construction_codes is None:
+            is_motor = is_unsupported_cc = is_marine = np.zeros(num_locs, dtype=bool)
+        else:
+            is_motor = np.array(_map_values(construction_codes, lambda cc: self._is_motor({'constructioncode': cc})))
+            is_unsupported_cc = np.array(_map_values(
+                construction_codes, lambda cc: self._is_unsupported_construction_code({'constructioncode': cc})))
+            is_marine = np.array(_map_values(construction_codes, lambda cc: self._check_in_group(
+                {'constructioncode': cc}, "motor_marine", self._codes_mapping["construction"])))
+        lob_ids, lob_status, lob_messages = self._get_lob_ids(column('occupancycode'), num_locs)
+        perils_covered = column('locperilscovered')
+        if perils_covered is None:
+            missing_perils = np.ones(num_locs, dtype=bool)
+            not_covered = np.zeros(num_locs, dtype=bool)
+        else:
+            missing_perils = np.array([peril is None for peril in perils_covered])
+            not_covered = ~np.array(_map_values(perils_covered,
+                                                lambda peril: self._peril_id in get_covered_ids(peril)))
+        missing_loc_ids = np.array([loc_id is None for loc_id in loc_ids])
+
+        # per key: the locations are crossed with the coverage types, location first
+        loc_index = np.repeat(np.arange(num_locs), num_covs)
+        coverage_types = np.tile(np.array(self._coverage_types), num_locs)
+        tivs = np.column_stack([_to_floats(column(TIV_COLUMNS[cov])) for cov in self._coverage_types]).ravel()
+        is_other = coverage_types == COVERAGE_TYPES['other']['id']
+        # skipped without TIV, other coverage is not supported
+        keep = tivs > 0
+        loc_index, coverage_types, is_other = loc_index[keep], coverage_types[keep], is_other[keep]
+        num_keys = len(loc_index)
+
+        status = np.full(num_keys, OASIS_KEYS_STATUS['success']['id'], dtype=object)
+        message = np.full(num_keys, "OK", dtype=object)
+        pending = np.ones(num_keys, dtype=bool)
+        fail = OASIS_KEYS_STATUS['fail']['id']
+        nomatch = OASIS_KEYS_STATUS['nomatch']['id']
+        motor = is_motor[loc_index]
+        _set_failure(status, message, pending, is_other, nomatch, "Other coverage is not supported")
+        _set_failure(status, message, pending, missing_perils[loc_index], fail, 'LocPerilsCovered is required')
+        _set_failure(status, message, pending, not_covered[loc_index], fail,
+                     'Location not covered for ' + str(oed_to_rf_peril(self._peril_id)))
+        _set_failure(status, message, pending, missing_loc_ids[loc_index], fail,
+                     "Location ID is required but is missing")
+        _set_failure(status, message, pending, is_unsupported_cc[loc_index], nomatch, "Unsupported construction code")
+        _set_failure(status, message, pending, lob_status[loc_index] == fail, fail, lob_messages[loc_index])
+        _set_failure(status, message, pending, lob_status[loc_index] == nomatch, nomatch, lob_messages[loc_index])
+        cover_ids = np.where(coverage_types == COVERAGE_TYPES['buildings']['id'],
+                             np.where(motor, EnumCover.Motor.value, EnumCover.Building.value),
+                             np.where(coverage_types == COVERAGE_TYPES['contents']['id'], EnumCover.Contents.value,
+                                      EnumCover.BI.value))
+        _set_failure(status, message, pending, motor & ~(coverage_types == COVERAGE_TYPES['buildings']['id']), nomatch,
+                     "Cannot convert coverage to RF internal coverage id. Do you have have Contents or BI TIV for a "
+                     "motor risk? This is not supported")
+        _set_failure(status, message, pending, geo["outside"][loc_index], fail, "Location is not in Australia")
+        _set_failure(status, message, pending, ~geo["located"][loc_index], fail,
+                     "A location must have at least a valid Cresta, Ica Zone, Postalcode, Lat/Lon or address id "
+                     "(GNAF ID)")
+        _set_failure(status, message, pending,
+                     (lob_ids[loc_index] == EnumLineOfBusiness.Residential.value) & (cover_ids == EnumCover.BI.value),
+                     fail, "Business Interruption losses are not currently modelled for Residential line of business")
+        _set_failure(status, message, pending,
+                     motor & np.isin(cover_ids,
+                                     [EnumCover.Building.value, EnumCover.Contents.value, EnumCover.BI.value]),
+                     fail, "If row has a motor construction code (between 5850 and 5950) then it cannot have cover "
+                           "other than Motor (TIV stored in OtherTIV)")
+
+        # model data of the successful keys
+        model_data = np.full(num_keys, np.nan, dtype=object)
+        if pending.any():
+            props = self._get_location_props(locs, dtype, is_marine)
+            json_prefix = '{"loc_id": ' + _json_column([str(loc_id) for loc_id in loc_ids]) \
+                + ', "lob_id": ' + _json_column(lob_ids.tolist())
+            json_suffix = ', "country_code": ' + geo["country_code"] + geo["json"] + ', "props": ' + props + '}'
+            model_data[pending] = json_prefix[loc_index[pending]] + ', "cover_id": ' \
+                + _json_column(cover_ids[pending].tolist()) + json_suffix[loc_index[pending]]
+
+        loc_ids = np.array(loc_ids, dtype=object)
+        return pd.DataFrame({
+            'loc_id': loc_ids[loc_index],
+            'peril_id': self._peril_id,
+            'coverage_type': coverage_types,
+            'model_data': model_data,
+            'status': status,
+            'message': message,
+        }, columns=KEYS_COLUMNS)
+
+    def _get_lob_ids(self, occupancy_codes, num_locs):
+        """Returns the line of business, status and message of each occupancy code"""
+        if occupancy_codes is None:
+            return (np.full(num_locs, EnumLineOfBusiness.Residential.value), np.full(num_locs, None, dtype=object),
+                    np.full(num_locs, None, dtype=object))
+
+        def get_lob_id(occupancy_code):
+            try:
+                return self._get_lob_id({'occupancycode': occupancy_code}), None, None
+            except LocationLookupException as e:
+                return 0, OASIS_KEYS_STATUS['fail']['id'], str(e)
+            except LocationNotModelledException as e:
+                return 0, OASIS_KEYS_STATUS['nomatch']['id'], str(e)
+
+        lob_ids, lob_status, lob_messages = zip(*_map_values(occupancy_codes, get_lob_id))
+        return np.array(lob_ids), np.array(lob_status, dtype=object), np.array(lob_messages, dtype=object)
+
+    def _get_location_geography(self, locs, dtype):
+        """Parses the country, address, postcode, ica zone, cresta, lat/lon, best resolution and state of each location
+
+        :return: dictionary of arrays: json fragments (country_code, json from address_id to state), located (at least
+         one valid geography) and outside (coordinates outside of Australia)
+        """
+        num_locs = len(locs)
+        column = functools.partial(_get_column, locs, dtype=dtype)
+        countries = column('countrycode')
+        country_code = _json_column([COUNTRY_CODE] * num_locs if countries is None
+                                    else [str(country).lower() for country in countries])
+
+        address_id = np.full(num_locs, None, dtype=object)
+        values = {"med_id": np.full(num_locs, None, dtype=object), "lrg_id": np.full(num_locs, None, dtype=object),
+                  "zone_id": np.full(num_locs, None, dtype=object)}
+        # the resolution type is set with the resolution parsed from the location, not with a looked up postcode
+        typed = dict((key, np.zeros(num_locs, dtype=bool)) for key in values)
+        geog_schemes = {"ICA": ("lrg_id", 50), "CRO": ("zone_id", 50), "PC4": ("med_id", None)}
+        for i in range(1, 6):
+            schemes, names = column("geogscheme" + str(i)), column("geogname" + str(i))
+            if schemes is None or names is None:
+                continue
+            schemes = np.array(schemes, dtype=object)
+            is_gnaf = (schemes == "GNAF") & np.array([isinstance(name, str) and not name == "" for name in names])
+            address_id[is_gnaf] = np.array(names, dtype=object)[is_gnaf]
+            int_names = np.array(_map_values(names, _to_int), dtype=object)
+            valid = np.array([name is not None and 0 < name for name in int_names])
+            for scheme, (key, upper) in geog_schemes.items():
+                mask = (schemes == scheme) & valid
+                if upper is not None:
+                    mask &= np.array([name is not None and name < upper for name in int_names])
+                values[key][mask] = int_names[mask]
+                typed[key] |= mask
+
+        postcodes = column('postalcode')
+        if postcodes is not None:
+            def get_postcode(postcode):
+                try:
+                    if not self.is_valid_postcode(postcode):
+                        return None
+                except TypeError:
+                    return None
+                postcode = int(postcode)
+                return POSTCODE_CONCORDANCE[str(postcode)] if postcode in DELIVERY_POSTCODE_SET else postcode
+            postcodes = np.array(_map_values(postcodes, get_postcode), dtype=object)
+            valid = np.array([postcode is not None for postcode in postcodes])
+            values["med_id"][valid] = postcodes[valid]
+            typed["med_id"] |= valid
+
+        # lat/lon
+        latitudes, longitudes = column('latitude'), column('longitude')
+        has_coordinates = np.zeros(num_locs, dtype=bool)
+        outside = np.zeros(num_locs, dtype=bool)
+        if latitudes is not None and longitudes is not None:
+            lats, lons = _to_floats(latitudes), _to_floats(longitudes)
+            candidates = ~np.isnan(lats) & ~np.isnan(lons) & (lats != 0) & (lons != 0)
+            inside = (AU_BOUNDING_BOX['MIN'][0] <= lons) & (lons <= AU_BOUNDING_BOX['MAX'][0]) \
+                & (AU_BOUNDING_BOX['MIN'][1] <= lats) & (lats <= AU_BOUNDING_BOX['MAX'][1])
+            has_coordinates = candidates & inside
+            outside = candidates & ~inside
+            if self._postcode_lookup:
+                lookup = has_coordinates & np.array([med_id is None or med_id == 0 for med_id in values["med_id"]])
+                if lookup.any():
+                    postcodes = self._postcode_lookup.get_postcodes(lons[lookup], lats[lookup])
+                    looked_up = postcodes.astype(object)
+                    looked_up[postcodes == POSTCODE_NOT_FOUND] = None
+                    values["med_id"][lookup] = looked_up
+                    logging.info("RUNNING: postcode lookup statistics {0}".format(self._postcode_lookup.cache_info()))
+
+        med_ids, lrg_ids, zone_ids = values["med_id"], values["lrg_id"], values["zone_id"]
+        has_med, has_lrg, has_zone = [np.array([value is not None and value > 0 for value in ids])
+                                      for ids in (med_ids, lrg_ids, zone_ids)]
+        has_address = np.array([address is not None for address in address_id])
+        valid_address = np.zeros(num_locs, dtype=bool)
+        if has_address.any():
+            valid_address[has_address] = self._are_valid_addresses(address_id[has_address].tolist())
+        best_res = np.full(num_locs, None, dtype=object)
+        best_res[has_lrg] = EnumResolution.IcaZone.value
+        best_res[has_zone] = EnumResolution.Cresta.value
+        best_res[has_med] = EnumResolution.Postcode.value
+        best_res[valid_address] = EnumResolution.Address.value
+        best_res[has_coordinates] = EnumResolution.LatLong.value
+        located = has_coordinates | valid_address | _is_set(med_ids) | _is_set(zone_ids) | _is_set(lrg_ids)
+
+        area_codes = column('areacode')
+        states = np.full(num_locs, None, dtype=object)
+        if area_codes is not None:
+            states = np.array([str(code).upper() for code in area_codes], dtype=object)
+            states[~np.isin(states, list(AU_STATES))] = None
+
+        no_coordinates = ~has_coordinates
+        fragments = ', "address_id": ' + _json_column(address_id.tolist()) \
+            + ', "address_type": ' + _json_type(has_address, EnumAddressType.GNAF)
+        for key, resolution in [("med_id", EnumResolution.Postcode), ("lrg_id", EnumResolution.IcaZone),
+                                ("zone_id", EnumResolution.Cresta)]:
+            fragments = fragments + ', "' + key + '": ' + _json_column(values[key].tolist()) \
+                + ', "' + key[:-2] + 'type": ' + _json_type(typed[key], resolution)
+        for key, coordinates in [("latitude", latitudes), ("longitude", longitudes)]:
+            fragments = fragments + ', "' + key + '": ' \
+                + _json_column(coordinates if coordinates is not None else [None] * num_locs, no_coordinates)
+        fragments = fragments \
+            + np.array(["" if res is None else ', "best_res": ' + str(res) for res in best_res], dtype=object) \
+            + ', "state": ' + _json_column(states.tolist())
+        return {"country_code": country_code, "json": fragments, "located": located, "outside": outside}
+
+    def _get_location_props(self, locs, dtype, is_marine):
+        """Returns the json encoded props (year built and static motor) of each location"""
+        num_locs = len(locs)
+        props = np.full(num_locs, "", dtype=object)
+        years = _get_column(locs, 'yearbuilt', dtype)
+        if years is not None:
+            def get_year_built(year):
+                try:
+                    return '"YearBuilt": ' + str(self.sanitize_year_built(int(year)))
+                except (ValueError, TypeError):
+                    return ""
+            props = props + np.array(_map_values(years, get_year_built), dtype=object)
+        smvs = _get_column(locs, 'staticmotorvehicle', dtype)
+        if smvs is not None:
+            def get_smv(smv):
+                try:
+                    return to_bool(smv)
+                except (ValueError, TypeError):
+                    return None
+            smvs = np.array(_map_values(smvs, get_smv), dtype=object)
+            has_smv = np.array([smv is not None for smv in smvs])
+            smvs[has_smv & is_marine] = True
+            smv_json = np.full(num_locs, "", dtype=object)
+            smv_json[has_smv] = np.where(np.array(smvs[has_smv], dtype=bool), '"StaticMotor": true',
+                                         '"StaticMotor": false')
+            props = props + np.where((props == "") | (smv_json == ""), "", ", ").astype(object) + smv_json
+        return "{" + props + "}"
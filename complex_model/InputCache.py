@@ -0,0 +1,139 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+from complex_model.utils import get_file_key, get_file_stats
+from complex_model.OasisToRF import DEFAULT_DB
+
+"""
+Node-local cache of the RF input database shared by the event batches of an analysis. Every event batch builds the
+same database from complex_items.csv and coverages.csv, so the first batch builds it under a file lock and the other
+ones clone it into their working directory (the engine writes its results into the database so it can not be
+shared). The cache is evicted in least recently used order once it exceeds its disk budget.
+    cache_root/{key}/riskfrontiersdbAUS_v2_6.db: the cached database
+    cache_root/{key}/cache.json: number of rows and size, its modification time is the last use
+    cache_root/{key}.lock: lock held exclusively while an entry is built or evicted, shared while it is cloned so
+        that the event batches of a node clone it concurrently
+"""
+
+CACHE_METADATA_FILENAME = "cache.json"
+FICLONE = 0x40049409  # linux ioctl cloning a file on copy-on-write filesystems (btrfs, xfs)
+
+
+def get_input_key(fps, template_fp, version):
+    """Returns the cache key of the input files built against the template database
+
+    :param fps: list of input file paths (items and coverages)
+    :param template_fp: path to the template database
+    :param version: integration version
+    :return: hexadecimal digest
+    """
+    values = get_file_stats([template_fp])
+    return get_file_key(fps, *(values + [version]))
+
+
+def clone_file(src_fp, dst_fp):
+    """Copies a file, through a copy-on-write clone when the filesystem supports it"""
+    with open(src_fp, "rb") as src, open(dst_fp, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src_fp, dst_fp)
+
+
+def _lock(cache_root, key, operation):
+    lock = open(os.path.join(cache_root, key + ".lock"), "w")
+    try:
+        fcntl.flock(lock, operation)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+
+def get_cached_rf_input(cache_root, key, sqlite_fp, build, budget):
+    """Clones the cached RF input database into sqlite_fp, building it first if it is not cached yet
+
+    :param cache_root: node-local cache directory
+    :param key: cache key, see get_input_key
+    :param sqlite_fp: path of the database to create
+    :param build: callable building the database at the given path and returning its number of rows
+    :param budget: disk budget of the cache in bytes
+    :return: number of rows in the items and coverages
+    """
+    os.makedirs(cache_root, exist_ok=True)
+    entry_dir = os.path.join(cache_root, key)
+    metadata_fp = os.path.join(entry_dir, CACHE_METADATA_FILENAME)
+    lock = _lock(cache_root, key, fcntl.LOCK_SH)
+    try:
+        while not os.path.isfile(metadata_fp):
+            # the entry is built under the exclusive lock, then cloned under the shared lock as the other batches do.
+            # The lock is released while converted so the entry is checked again, it may have been evicted meanwhile
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.isfile(metadata_fp):
+                start = time.time()
+                build_dir = entry_dir + ".build"
+                shutil.rmtree(build_dir, ignore_errors=True)
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                os.makedirs(build_dir)
+                num_rows = build(os.path.join(build_dir, DEFAULT_DB))
+                metadata = {"num_rows": int(num_rows), "size": os.path.getsize(os.path.join(build_dir, DEFAULT_DB))}
+                with open(os.path.join(build_dir, CACHE_METADATA_FILENAME), "w") as f:
+                    json.dump(metadata, f)
+                os.rename(build_dir, entry_dir)
+                logging.info("RUNNING: RF input database cached in " + entry_dir + " in "
+                             + "{:.2f}s".format(time.time() - start))
+            fcntl.flock(lock, fcntl.LOCK_SH)
+        with open(metadata_fp) as f:
+            metadata = json.load(f)
+        logging.info("RUNNING: RF input database cloned from cache " + entry_dir)
+        if os.path.isfile(sqlite_fp):
+            os.remove(sqlite_fp)
+        clone_file(os.path.join(entry_dir, DEFAULT_DB), sqlite_fp)
+        os.utime(metadata_fp)
+    finally:
+        lock.close()
+    evict_rf_inputs(cache_root, budget, keep=key)
+    return metadata["num_rows"]
+
+
+def evict_rf_inputs(cache_root, budget, keep=None):
+    """Removes the least recently used entries until the cache fits in its disk budget. Entries in use are skipped.
+
+    :param cache_root: node-local cache directory
+    :param budget: disk budget of the cache in bytes
+    :param keep: key of an entry that must not be evicted
+    :return: list of evicted keys
+    """
+    entries = []
+    for key in os.listdir(cache_root):
+        metadata_fp = os.path.join(cache_root, key, CACHE_METADATA_FILENAME)
+        if os.path.isfile(metadata_fp):
+            with open(metadata_fp) as f:
+                size = json.load(f)["size"]
+            entries.append((os.path.getmtime(metadata_fp), key, size))
+    total = sum(size for _, _, size in entries)
+    evicted = []
+    for _, key, size in sorted(entries):
+        if total <= budget:
+            break
+        if key == keep:
+            continue
+        lock = _lock(cache_root, key, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if lock is None:
+            continue
+        try:
+            # the entry is invalid as soon as its metadata is removed
+            os.remove(os.path.join(cache_root, key, CACHE_METADATA_FILENAME))
+            shutil.rmtree(os.path.join(cache_root, key), ignore_errors=True)
+        finally:
+            # the lock file is kept: removing it would race with a worker waiting on it
+            lock.close()
+        total = total - size
+        evicted.append(key)
+        logging.info("RUNNING: RF input database " + key + " evicted from cache " + cache_root)
+    return evicted
@@ -0,0 +1,145 @@
+import os
+import stat
+import numpy as np
+
+"""
+Live transport of losses from the engine to the gulcalc stream through a named pipe (FIFO), so that losses do not
+round-trip through partial loss databases on disk.
+
+The producer writes fixed-size little-endian records (event_id uint32, loc_id uint32, sample_id int32, loss float32).
+Records of an (event_id, loc_id) group are contiguous with ascending sample ids and the groups of an event are
+contiguous. The stream ends with an all-zero record (event_id 0 is not a valid event). Back-pressure is provided by the
+pipe itself: the producer blocks once the pipe buffer is full until the consumer has encoded the pending records.
+"""
+
+LIVE_LOSS_RECORD_DTYPE = np.dtype([("event_id", "<u4"), ("loc_id", "<u4"), ("sample_id", "<i4"), ("loss", "<f4")])
+LIVE_LOSS_RECORD_FORMAT = "<u4 event_id, <u4 loc_id, <i4 sample_id, <f4 loss"
+END_OF_STREAM = np.zeros(1, dtype=LIVE_LOSS_RECORD_DTYPE)
+DEFAULT_PIPE_SIZE = 2**20
+DEFAULT_READ_SIZE = 2**20
+
+
+def create_loss_pipe(fifo_fp, pipe_size=DEFAULT_PIPE_SIZE):
+    """Creates the named pipe and opens its consumer end. The pipe is opened read/write so that opening never blocks
+    and the consumer end stays valid whether or not the producer has connected yet.
+
+    :param fifo_fp: path of the named pipe
+    :param pipe_size: requested pipe buffer size in bytes (linux only)
+    :return: file descriptor of the consumer end
+    """
+    if os.path.exists(fifo_fp):
+        if not stat.S_ISFIFO(os.stat(fifo_fp).st_mode):
+            raise ValueError(fifo_fp + " exists and is not a named pipe")
+    else:
+        os.mkfifo(fifo_fp)
+    fd = os.open(fifo_fp, os.O_RDWR)
+    try:
+        import fcntl
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, pipe_size)
+    except (ImportError, AttributeError, OSError):
+        pass  # default pipe buffer size
+    return fd
+
+
+def close_loss_pipe(fifo_fp):
+    """Sends the end of stream record so that a consumer waiting on the pipe returns (e.g. once the producer exited
+    without ending the stream). Does nothing if no consumer has the pipe opened.
+
+    :param fifo_fp: path of the named pipe
+    """
+    try:
+        fd = os.open(fifo_fp, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        return
+    try:
+        # blocks until the consumer has drained the pipe. Two records so that an aligned end of stream record is
+        # found even if the producer died in the middle of a record
+        os.set_blocking(fd, True)
+        os.write(fd, END_OF_STREAM.tobytes() * 2)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def iter_live_losses(fd, read_size=DEFAULT_READ_SIZE):
+    """Reads loss records from the consumer end of the pipe until the end of stream record
+
+    :param fd: file descriptor returned by create_loss_pipe
+    :param read_size: maximum number of bytes read at once
+    :return: a generator of LIVE_LOSS_RECORD_DTYPE arrays
+    """
+    record_size = LIVE_LOSS_RECORD_DTYPE.itemsize
+    pending = b''
+    while True:
+        data = os.read(fd, read_size)
+        if not data:
+            raise EOFError("Loss pipe closed before the end of stream record")
+        if pending:
+            data = pending + data
+        num_records = len(data) // record_size
+        pending = data[num_records * record_size:]
+        records = np.frombuffer(data, dtype=LIVE_LOSS_RECORD_DTYPE, count=num_records)
+        end = np.nonzero((records["event_id"] == 0) & (records["loc_id"] == 0))[0]
+        if len(end) > 0:
+            if end[0] > 0:
+                yield records[:end[0]]
+            return
+        if num_records > 0:
+            yield records
+
+
+def write_live_losses(fifo_fp, chunks):
+    """Python stand-in producer: writes loss records to the named pipe, then the end of stream record
+
+    :param fifo_fp: path of the named pipe
+    :param chunks: iterable of record arrays with event_id, loc_id, sample_id and loss fields
+    :return: number of records written
+    """
+    num_records = 0
+    with open(fifo_fp, "wb", buffering=0) as fifo:
+        for chunk in chunks:
+            records = np.empty(len(chunk), dtype=LIVE_LOSS_RECORD_DTYPE)
+            for name in LIVE_LOSS_RECORD_DTYPE.names:
+                records[name] = chunk[name]
+            view = memoryview(records).cast('B')
+            while len(view) > 0:
+                view = view[fifo.write(view):]
+            num_records = num_records + len(records)
+        fifo.write(END_OF_STREAM.tobytes())
+    return num_records
+
+
+def generate_live_losses(num_events, num_locs, num_samples, zero_loss_fraction=0.0, seed=1):
+    """Synthetic losses in live transport order, one chunk per event
+
+    :param num_events: number of events
+    :param num_locs: number of items (or coverages)
+    :param num_samples: number of samples, the special samples -3 (tiv) and -1 (mean) are added
+    :param zero_loss_fraction: fraction of the losses set to zero
+    :param seed: random seed
+    :return: a generator of LIVE_LOSS_RECORD_DTYPE arrays
+    """
+    rng = np.random.default_rng(seed)
+    sample_ids = np.array([-3, -1] + list(range(1, num_samples + 1)), dtype=np.int32)
+    for event_id in range(1, num_events + 1):
+        records = np.empty(num_locs * len(sample_ids), dtype=LIVE_LOSS_RECORD_DTYPE)
+        records["event_id"] = event_id
+        records["loc_id"] = np.repeat(np.arange(1, num_locs + 1), len(sample_ids))
+        records["sample_id"] = np.tile(sample_ids, num_locs)
+        records["loss"] = rng.uniform(0, 1e6, len(records))
+        records["loss"][rng.random(len(records)) < zero_loss_fraction] = 0
+        yield records
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Stand-in producer for the live loss transport.')
+    parser.add_argument("fifo_fp", help="named pipe created by the consumer (ResultPipe in oasis_param.json)")
+    parser.add_argument("--events", type=int, default=100)
+    parser.add_argument("--locs", type=int, default=1000)
+    parser.add_argument("--samples", type=int, default=10)
+    parser.add_argument("--zero-loss-fraction", type=float, default=0.0)
+    args = parser.parse_args()
+    print(write_live_losses(args.fifo_fp, generate_live_losses(args.events, args.locs, args.samples,
+                                                               args.zero_loss_fraction)))
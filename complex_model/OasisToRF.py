@@ -1,16 +1,33 @@
 import os
 import json
+import itertools
+import logging
 import sqlite3
-from shutil import copyfile
+import time
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import shape
 from complex_model.Common import EnumResolution
 
 """
 This script is used to transform oasis item and coverage files into cannonical rf item and coverage files stored in a sqlite database
-1. copy template database from the specified risk_platform_data folder
-2. convert oasis items.csv and coverages.csv into u_item and u_coverage tables
+1. convert oasis items.csv and coverages.csv into u_item and u_coverage tables
+2. copy the template database tables from the specified risk_platform_data folder, only the rf_address rows
+   referenced by the items are copied
+3. resolve the GNAF addresses and, when boundary layers are given, the resolutions of the exposures located by
+   latitude and longitude
 """
 
 DEFAULT_DB = "riskfrontiersdbAUS_v2_6.db"
+DEFAULT_CHUNK_SIZE = 100000
+
+# resolutions which can be located by latitude and longitude: resolution column -> (type column, resolution type)
+LAT_LONG_RESOLUTIONS = {
+    "catchment_id": ("catchment_type", 4),
+    "zone_id": ("zone_type", 2),
+    "lrg_id": ("lrg_type", 3),
+}
 
 RF_DEFAULT_ITEM_SQLITE_DEF = {
     "loc_id": {"datatype": "TEXT", "default": None},
@@ -62,7 +79,7 @@ def is_valid_model_data(risk_platform_data):
     return os.path.isfile(os.path.join(risk_platform_data, DEFAULT_DB))
 
 
-def create_rf_input(item_source, coverage_source, sqlite_fp, risk_platform_data):
+def create_rf_input(item_source, coverage_source, sqlite_fp, risk_platform_data, boundary_layers=None):
     """This function populates Risk Frontiers exposure and coverage database from oasis generated input files.
     Precondition: The number of rows in item_source and coverage_source must be exactly the same.
 
@@ -70,74 +87,80 @@ def create_rf_input(item_source, coverage_source, sqlite_fp, risk_platform_data)
     :param coverage_source: the coverages.csv as a dataframe
     :param sqlite_fp: path to store the sqlite database containing the exposure and coverage tables
     :param risk_platform_data: path containing the template databases for Risk Frontiers models
+    :param boundary_layers: see fill_resolution_from_lat_long
     :return: a number of rows in the items and coverages.
     """
     num_items = len(item_source)
     num_coverages = len(coverage_source)
     if not num_items == num_coverages:
         raise Exception("the items.csv and coverage.csv must have the exact same number of rows")
+    return create_rf_input_from_chunks([(item_source, coverage_source)], sqlite_fp, risk_platform_data,
+                                       boundary_layers)
+
+
+def create_rf_input_from_csv(items_fp, coverages_fp, sqlite_fp, risk_platform_data, chunk_size=DEFAULT_CHUNK_SIZE,
+                             boundary_layers=None):
+    """This function populates Risk Frontiers exposure and coverage database from the oasis complex_items.csv and
+    coverages.csv files read chunk by chunk, so that memory is bounded by the chunk size rather than the portfolio.
+
+    :param items_fp: path to the complex_items.csv
+    :param coverages_fp: path to the coverages.csv
+    :param sqlite_fp: path to store the sqlite database containing the exposure and coverage tables
+    :param risk_platform_data: path containing the template databases for Risk Frontiers models
+    :param chunk_size: number of rows read, converted and inserted at once
+    :param boundary_layers: see fill_resolution_from_lat_long
+    :return: a number of rows in the items and coverages.
+    """
+    with pd.read_csv(items_fp, chunksize=chunk_size) as item_chunks, \
+            pd.read_csv(coverages_fp, chunksize=chunk_size) as coverage_chunks:
+        return create_rf_input_from_chunks(iter_aligned_chunks(item_chunks, coverage_chunks), sqlite_fp,
+                                           risk_platform_data, boundary_layers)
+
+
+def iter_aligned_chunks(item_chunks, coverage_chunks):
+    """Pairs the item and coverage chunks, their rows are aligned by position"""
+    for item_chunk, coverage_chunk in itertools.zip_longest(item_chunks, coverage_chunks):
+        if item_chunk is None or coverage_chunk is None or not len(item_chunk) == len(coverage_chunk):
+            raise Exception("the items.csv and coverage.csv must have the exact same number of rows")
+        yield item_chunk, coverage_chunk
 
+
+def create_rf_input_from_chunks(chunks, sqlite_fp, risk_platform_data, boundary_layers=None):
+    """Populates Risk Frontiers exposure and coverage database from chunks of items and coverages. The chunks are
+    inserted in a single transaction.
+
+    :param chunks: iterable of (items dataframe, coverages dataframe) with the same number of rows
+    :param sqlite_fp: path to store the sqlite database containing the exposure and coverage tables
+    :param risk_platform_data: path containing the template databases for Risk Frontiers models
+    :param boundary_layers: see fill_resolution_from_lat_long
+    :return: a number of rows in the items and coverages.
+    """
     if os.path.isfile(sqlite_fp):
         os.remove(sqlite_fp)
-    copyfile(os.path.join(risk_platform_data, DEFAULT_DB), sqlite_fp)
+    template_fp = os.path.join(risk_platform_data, DEFAULT_DB)
+    if not os.path.isfile(template_fp):
+        raise FileNotFoundError("Template database not found: " + template_fp)
 
     con = sqlite3.connect(sqlite_fp)
     cur = con.cursor()
+    copy_template_settings(cur, template_fp)
 
-    cur.execute("CREATE TABLE u_exposure_tmp (" + ",".join(
-        ["[" + col + "] " + RF_DEFAULT_ITEM_SQLITE_DEF[col]["datatype"] for col in RF_DEFAULT_ITEM_SQLITE_DEF]) + ");")
     cur.execute("CREATE TABLE u_exposure (" + ",".join(
         ["[" + col + "] " + RF_DEFAULT_ITEM_SQLITE_DEF[col]["datatype"] for col in RF_DEFAULT_ITEM_SQLITE_DEF]) + ");")
     cur.execute("CREATE TABLE u_coverage (" + ",".join(
         ["[" + col + "] " + RF_DEFAULT_COVERAGE_SQLITE_DEF[col]["datatype"] for col in
          RF_DEFAULT_COVERAGE_SQLITE_DEF]) + ");")
 
-    origin_file_line = 0
-    items = []
-    coverages = []
-    for line_id in range(0, num_items):
-        item_row = item_source.iloc[line_id]
-        coverage_row = coverage_source.iloc[line_id]
-        origin_file_line = line_id + 1
-        # building item row
-        rf_item = RF_DEFAULT_ITEM.copy()
-
-        model_data = json.loads(item_row['model_data'])
-        for key in rf_item.keys():
-            if key in model_data and model_data[key] is not None:
-                if key.lower() == "props":
-                    rf_item[key] = json.dumps(model_data[key])
-                else:
-                    rf_item[key] = model_data[key]
-
-        # if not rf_item['loc_id']:
-        #     rf_item['loc_id'] = "rf_loc_" + str(model_data['loc_id'])
-        rf_item['loc_id'] = str(item_row['item_id'])
-
-        # building coverage row
-        rf_coverage = RF_DEFAULT_COVERAGE.copy()
-
-        rf_coverage['cover_id'] = int(model_data['cover_id'])
-        rf_coverage['value'] = float(coverage_row['tiv'])
-
-        rf_coverage['loc_id'] = rf_item['loc_id']
-
-        # for oasis origin_file_line will be item_id/coverage_id
-        rf_item['origin_file_line'] = origin_file_line
-        rf_coverage['origin_file_line'] = origin_file_line
-
-        items.append(tuple(rf_item.values()))
-        coverages.append(tuple(rf_coverage.values()))
-
-    item_sql = "INSERT INTO u_exposure_tmp VALUES (" + ",".join(["?" for c in RF_DEFAULT_ITEM]) + ");"
-    coverage_sql = "INSERT INTO u_coverage VALUES (" + ",".join(["?" for c in RF_DEFAULT_COVERAGE]) + ");"
-    cur.executemany(item_sql, items)
-    cur.executemany(coverage_sql, coverages)
+    num_items = 0
+    for item_source, coverage_source in chunks:
+        num_items = num_items + insert_rf_chunk(cur, item_source, coverage_source, num_items + 1)
     con.commit()
 
+    copy_template(con, cur, template_fp)
+
     # spatial analysis ...
     fill_resolution_from_address_id(con, cur)
-    fill_resolution_from_lat_long(con, cur)
+    fill_resolution_from_lat_long(con, cur, boundary_layers)
 
     # post processing ...
     ofl_exposure_index = "CREATE INDEX ofl_exposure_index ON u_exposure (origin_file_line);"
@@ -147,7 +170,110 @@ def create_rf_input(item_source, coverage_source, sqlite_fp, risk_platform_data)
     con.commit()
 
     con.close()
-    return origin_file_line
+    return num_items
+
+
+def insert_rf_chunk(cur, item_source, coverage_source, first_line):
+    """Converts a chunk of oasis items and coverages into the u_exposure and u_coverage tables
+
+    :param cur: sqlite cursor
+    :param item_source: items dataframe
+    :param coverage_source: coverages dataframe, aligned by position with the items
+    :param first_line: origin_file_line of the first row of the chunk
+    :return: number of rows inserted
+    """
+    num_items = len(item_source)
+    # model_data is parsed in bulk, each column is then gathered from the parsed items
+    model_data = json.loads("[" + ",".join(item_source['model_data'].tolist()) + "]")
+    if len(model_data) != num_items or not all(isinstance(item, dict) for item in model_data):
+        # a model_data holding several comma separated objects would shift every following item
+        raise Exception("the model_data of the items starting at line " + str(first_line)
+                        + " must each be a single json object")
+    item_columns = []
+    for key in RF_DEFAULT_ITEM:
+        if key == "loc_id":
+            # for oasis loc_id is the item_id
+            column = [str(item_id) for item_id in item_source['item_id'].tolist()]
+        elif key == "origin_file_line":
+            # for oasis origin_file_line will be item_id/coverage_id
+            column = range(first_line, first_line + num_items)
+        elif key.lower() == "props":
+            column = [None if item.get(key) is None else json.dumps(item[key]) for item in model_data]
+        else:
+            column = [item.get(key) for item in model_data]
+        item_columns.append(column)
+
+    coverage_columns = []
+    for key, default in RF_DEFAULT_COVERAGE.items():
+        if key == "loc_id":
+            column = item_columns[0]
+        elif key == "cover_id":
+            column = [int(item['cover_id']) for item in model_data]
+        elif key == "value":
+            # tiv is aligned by position with the items
+            column = [float(tiv) for tiv in coverage_source['tiv'].tolist()]
+        elif key == "origin_file_line":
+            column = range(first_line, first_line + num_items)
+        else:
+            column = [default] * num_items
+        coverage_columns.append(column)
+
+    item_sql = "INSERT INTO u_exposure VALUES (" + ",".join(["?" for c in RF_DEFAULT_ITEM]) + ");"
+    coverage_sql = "INSERT INTO u_coverage VALUES (" + ",".join(["?" for c in RF_DEFAULT_COVERAGE]) + ");"
+    cur.executemany(item_sql, zip(*item_columns))
+    cur.executemany(coverage_sql, zip(*coverage_columns))
+    return num_items
+
+
+def copy_template_settings(cur, template_fp):
+    """Applies the page size and versions of the template database, must be called before any table is created
+
+    :param cur: sqlite cursor on the new database
+    :param template_fp: path to the template database
+    """
+    template_con = sqlite3.connect(template_fp)
+    try:
+        settings = dict((pragma, template_con.execute("PRAGMA " + pragma).fetchone()[0])
+                        for pragma in ["page_size", "user_version", "application_id"])
+    finally:
+        template_con.close()
+    for pragma, value in settings.items():
+        cur.execute("PRAGMA {0} = {1:d};".format(pragma, int(value)))
+
+
+def copy_template(con, cur, template_fp):
+    """Copies the tables of the template database instead of copying the whole file: the template is attached and
+    every table is copied except rf_address (GNAF) of which only the addresses referenced by u_exposure are
+    copied. Indexes, triggers and views are created once the tables are loaded.
+
+    :param con: sqlite connection to the database containing the exposure table
+    :param cur: sqlite cursor
+    :param template_fp: path to the template database
+    """
+    cur.execute("ATTACH DATABASE ? AS template;", (template_fp,))
+    try:
+        cur.execute("SELECT type, name, sql FROM template.sqlite_master WHERE sql IS NOT NULL ORDER BY rowid;")
+        schema = cur.fetchall()
+        tables = [(name, sql) for obj_type, name, sql in schema
+                  if obj_type == "table" and not name.startswith("sqlite_")]
+        for name, sql in tables:
+            cur.execute(sql)
+        for name, _ in tables:
+            if name.lower() == "rf_address":
+                cur.execute("INSERT INTO main.[rf_address] SELECT * FROM template.[rf_address] WHERE address_id IN "
+                            "(SELECT address_id FROM main.u_exposure WHERE NOT address_id IS NULL);")
+            else:
+                cur.execute("INSERT INTO main.[" + name + "] SELECT * FROM template.[" + name + "];")
+        if any(name == "sqlite_sequence" for _, name, _ in schema):
+            # the copy of AUTOINCREMENT tables may have registered sequences
+            cur.execute("DELETE FROM main.sqlite_sequence;")
+            cur.execute("INSERT INTO main.sqlite_sequence SELECT * FROM template.sqlite_sequence;")
+        for obj_type, name, sql in schema:
+            if obj_type in ("index", "trigger", "view"):
+                cur.execute(sql)
+        con.commit()
+    finally:
+        cur.execute("DETACH DATABASE template;")
 
 
 ADDRESS_COLUMN_AUTOPOPULATE = [EnumResolution.Latitude, EnumResolution.Longitude, EnumResolution.Postcode,
@@ -157,41 +283,122 @@ ADDRESS_COLUMN_AUTOPOPULATE = [EnumResolution.Latitude, EnumResolution.Longitude
 def fill_resolution_from_address_id(con, cur):
     """This function populate rows with valid GNAF IDs (not lat/lon)
     TODO: this will be handled by risk.platform in future. Only supports GNAF here.
+    Only the au exposures with an address id and without coordinates are resolved: their addresses are probed through
+    the rf_address index and the rows are updated in place. As with an inner join on rf_address, the exposures whose
+    address is unknown are removed and an address found several times duplicates its exposure.
 
     :param con: sqlite connection to the database containing the exposure table
     :param cur: sqlite cursor
     """
-    address_fill_sql = """INSERT INTO u_exposure
-                SELECT a.loc_id, 
-                CASE WHEN a.latitude IS NULL OR a.latitude = 0 THEN b.latitude ELSE a.latitude END latitude,
-                CASE WHEN a.longitude IS NULL OR a.longitude = 0 THEN b.longitude ELSE a.longitude END longitude,
-                1 address_type,
-                a.address_id,
-                a.best_res,
-                lower(a.country_code) country_code,
-                CASE WHEN a.[state] IS NULL THEN b.[state] ELSE a.[state] END [state],
-                2 zone_type,
-                CASE WHEN a.zone_id IS NULL THEN b.cresta ELSE a.zone_id END zone_id,		
-                4 catchment_type,
-                CASE WHEN a.catchment_id IS NULL THEN b.catchment_id ELSE a.catchment_id END catchment_id,
-                3 lrg_type,
-                CASE WHEN a.lrg_id IS NULL THEN b.ica_zone ELSE a.lrg_id END lrg_id,
-                1 med_type,
-                CASE WHEN a.med_id IS NULL OR a.med_id = 0 THEN b.postcode ELSE a.med_id END med_id,
-                a.fine_type,
-                a.fine_id,
-                a.lob_id,
-                a.props,
-                a.modelled,
-                a.origin_file_line
-        FROM u_exposure_tmp a INNER JOIN rf_address b ON a.address_id = b.address_id 
-        WHERE NOT a.address_id IS NULL AND lower(country_code) = 'au' AND 
-            (a.latitude = 0 OR a.latitude IS NULL OR a.longitude = 0 or a.longitude IS NULL)
-        UNION ALL SELECT * FROM u_exposure_tmp WHERE NOT (NOT address_id IS NULL AND lower(country_code) = 'au' AND 
-            (latitude = 0 OR latitude IS NULL OR longitude = 0 or longitude IS NULL));"""
-    cur.execute(address_fill_sql)
+    start = time.time()
+    cur.execute("""SELECT e.rowid, b.address_id, b.latitude, b.longitude, b.[state], b.cresta, b.catchment_id,
+                b.ica_zone, b.postcode
+        FROM u_exposure e LEFT JOIN rf_address b ON e.address_id = b.address_id
+        WHERE NOT e.address_id IS NULL AND lower(e.country_code) = 'au' AND
+            (e.latitude = 0 OR e.latitude IS NULL OR e.longitude = 0 OR e.longitude IS NULL)
+        ORDER BY e.rowid;""")
+    resolved = []
+    unresolved = []
+    last_rowid = None
+    for row in cur.fetchall():
+        rowid, address_id = row[0], row[1]
+        if address_id is None:
+            unresolved.append((rowid,))
+            continue
+        if rowid == last_rowid:
+            # the address is found several times
+            cur.execute("INSERT INTO u_exposure SELECT * FROM u_exposure WHERE rowid = ?;", (rowid,))
+            rowid = cur.lastrowid
+        else:
+            last_rowid = rowid
+        resolved.append(tuple(row[2:]) + (rowid,))
+
+    cur.executemany("""UPDATE u_exposure SET
+                latitude = CASE WHEN latitude IS NULL OR latitude = 0 THEN ? ELSE latitude END,
+                longitude = CASE WHEN longitude IS NULL OR longitude = 0 THEN ? ELSE longitude END,
+                address_type = 1,
+                country_code = lower(country_code),
+                [state] = CASE WHEN [state] IS NULL THEN ? ELSE [state] END,
+                zone_type = 2,
+                zone_id = CASE WHEN zone_id IS NULL THEN ? ELSE zone_id END,
+                catchment_type = 4,
+                catchment_id = CASE WHEN catchment_id IS NULL THEN ? ELSE catchment_id END,
+                lrg_type = 3,
+                lrg_id = CASE WHEN lrg_id IS NULL THEN ? ELSE lrg_id END,
+                med_type = 1,
+                med_id = CASE WHEN med_id IS NULL OR med_id = 0 THEN ? ELSE med_id END
+        WHERE rowid = ?;""", resolved)
+    cur.executemany("DELETE FROM u_exposure WHERE rowid = ?;", unresolved)
+    # without country code the lookup condition is unknown (NULL) and the exposure was never kept
+    cur.execute("""DELETE FROM u_exposure WHERE NOT address_id IS NULL AND country_code IS NULL AND
+            (latitude = 0 OR latitude IS NULL OR longitude = 0 OR longitude IS NULL);""")
     con.commit()
+    logging.info("COMPLETED: GNAF enrichment resolved {0} exposures, removed {1} unknown addresses in {2:.2f}s"
+                 .format(len(resolved), len(unresolved), time.time() - start))
 
 
-def fill_resolution_from_lat_long(con, cur):
-    pass  # todo: required when implementing flood to get catchment id etc
+def load_boundary_layer(boundary_fp, property_name):
+    """Loads the polygons of a GeoJSON boundary layer into a spatial index
+
+    :param boundary_fp: path to the GeoJSON file
+    :param property_name: feature property holding the resolution id
+    :return: (STRtree of the polygons, array of the resolution id of each polygon)
+    """
+    with open(boundary_fp, 'r') as f:
+        boundaries_json = json.load(f)
+    polygons = []
+    values = []
+    for feature in boundaries_json["features"]:
+        polygons.append(shape(feature["geometry"]))
+        values.append(int(feature["properties"][property_name]))
+    return shapely.STRtree(polygons), np.array(values, dtype=np.int64)
+
+
+def locate_points(tree, values, lons, lats):
+    """Returns the resolution id of the polygon intersecting each point, points on a shared boundary or in
+    overlapping polygons take the lowest id
+
+    :param tree: STRtree of the polygons
+    :param values: resolution id of each polygon
+    :param lons: array of longitudes
+    :param lats: array of latitudes
+    :return: (indices of the located points, their resolution ids)
+    """
+    point_index, polygon_index = tree.query(shapely.points(lons, lats), predicate="intersects")
+    # matches are sorted by point then id, keep the lowest id of each point
+    ids = values[polygon_index]
+    order = np.lexsort((ids, point_index))
+    point_index, ids = point_index[order], ids[order]
+    located, first = np.unique(point_index, return_index=True)
+    return located, ids[first]
+
+
+def fill_resolution_from_lat_long(con, cur, boundary_layers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """This function populates the catchment, cresta and ica zone of the exposures located by latitude and longitude
+    from the given boundary layers. The points are joined to each layer chunk by chunk through a spatial index and
+    the resolutions are updated in bulk. Resolutions already set are kept. Nothing is done without boundary layers.
+
+    :param con: sqlite connection to the database containing the exposure table
+    :param cur: sqlite cursor
+    :param boundary_layers: resolution column (see LAT_LONG_RESOLUTIONS) -> (path to a GeoJSON file, feature property
+                            holding the resolution id)
+    :param chunk_size: number of exposures located at once
+    """
+    for column, (boundary_fp, property_name) in (boundary_layers or {}).items():
+        type_column, resolution_type = LAT_LONG_RESOLUTIONS[column]
+        start = time.time()
+        tree, values = load_boundary_layer(boundary_fp, property_name)
+        cur.execute("SELECT rowid, longitude, latitude FROM u_exposure WHERE [" + column + "] IS NULL AND "
+                    "NOT latitude IS NULL AND NOT latitude = 0 AND NOT longitude IS NULL AND NOT longitude = 0;")
+        rows = np.array(cur.fetchall(), dtype=np.float64).reshape(-1, 3)
+        update_sql = "UPDATE u_exposure SET [" + column + "] = ?, [" + type_column + "] = ? WHERE rowid = ?;"
+        num_located = 0
+        for offset in range(0, len(rows), chunk_size):
+            chunk = rows[offset:offset + chunk_size]
+            located, ids = locate_points(tree, values, chunk[:, 1], chunk[:, 2])
+            rowids = chunk[located, 0].astype(np.int64)
+            cur.executemany(update_sql, zip(ids.tolist(), itertools.repeat(resolution_type), rowids.tolist()))
+            num_located = num_located + len(located)
+        con.commit()
+        logging.info("COMPLETED: {0} resolved for {1} of {2} exposures from {3} in {4:.2f}s"
+                     .format(column, num_located, len(rows), boundary_fp, time.time() - start))
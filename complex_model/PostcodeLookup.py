@@ -1,64 +1,104 @@
 # -*- coding: utf-8 -*-
 
-import csv, json
-from shapely.geometry import shape, Point
-from os import path
-from complex_model.QuadTree import QuadTree
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import shapely
+from shapely.geometry import box, Point
+from complex_model.QuadTree import Quad
+from complex_model.PostcodeSnapshot import PostcodeSnapshot, get_source_signature
+from complex_model.DefaultSettings import DEFAULT_POSTCODE_CACHE_SIZE, DEFAULT_POSTCODE_SNAPSHOT_DIRECTORY
 
+# relative margin of the boxes the postcode boundaries are clipped to, so the points on the edge of a cell are inside
+CELL_MARGIN = 1e-6
+# postcode of the points that are not in any postcode boundary, see get_postcodes
+POSTCODE_NOT_FOUND = -1
 
-# from multiprocessing.pool import ThreadPool
+# postcode data loaded in this process by keys data directory and version of its files, see get_postcode_data
+_POSTCODE_DATA = {}
+_POSTCODE_DATA_LOCK = threading.Lock()
 
 
-class PostcodeLookup(object):
-    """Functionality to perform postcode lookup"""
+class PostcodeData(object):
+    """Read-only postcode data of a keys data directory: the quad tree, the postcodes of each node and the boundaries
+    of each postcode, all held in the buffers of the memory mapped snapshot"""
+    __slots__ = ("_snapshot", "_quadtree", "_node_cells", "_postcode_offsets", "_postcodes", "_boundary_postcodes",
+                 "_boundary_offsets", "_wkb_offsets", "_wkb")
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        self._quadtree = snapshot.get_quadtree()
+        self._node_cells = snapshot.get_node_cells()
+        self._postcode_offsets, self._postcodes = snapshot.get_cell_postcodes()
+        self._boundary_postcodes, self._boundary_offsets, self._wkb_offsets, self._wkb = snapshot.get_boundaries()
+
+    @property
+    def quadtree(self):
+        return self._quadtree
+
+    def get_cell_postcodes(self, node):
+        """Returns the postcodes of the cell of a node of the quad tree
+
+        :param node: node of the quad tree
+        :return: memoryview of the postcodes, raises a KeyError with the cell id when the cell has no postcodes
+        """
+        cell = self._node_cells[node]
+        if cell < 0:
+            raise KeyError(self._quadtree.get_cell_id(node))
+        return self._postcodes[self._postcode_offsets[cell]:self._postcode_offsets[cell + 1]]
+
+    def get_boundaries(self, postcode):
+        """Returns the shapes of the boundaries of a postcode, built from their WKB at each call
 
-    _keys_file_dir = None
+        :param postcode: postcode
+        :return: list of shapes
+        """
+        i = int(np.searchsorted(self._boundary_postcodes, postcode))
+        if i == len(self._boundary_postcodes) or self._boundary_postcodes[i] != postcode:
+            return []
+        return [shapely.from_wkb(bytes(self._wkb[self._wkb_offsets[j]:self._wkb_offsets[j + 1]]))
+                for j in range(self._boundary_offsets[i], self._boundary_offsets[i + 1])]
+
+
+def get_postcode_data(keys_file_dir, snapshot_dir=None):
+    """Returns the postcode data of a keys data directory, loaded once per process for each version of its files and
+    shared with the processes forked afterwards
+
+    :param keys_file_dir: keys data directory
+    :param snapshot_dir: directory containing the snapshots, RF_POSTCODE_SNAPSHOT_DIRECTORY by default
+    :return: PostcodeData
+    """
+    if snapshot_dir is None:
+        snapshot_dir = DEFAULT_POSTCODE_SNAPSHOT_DIRECTORY
+        if "RF_POSTCODE_SNAPSHOT_DIRECTORY" in os.environ and os.environ["RF_POSTCODE_SNAPSHOT_DIRECTORY"]:
+            snapshot_dir = os.environ["RF_POSTCODE_SNAPSHOT_DIRECTORY"]
+    key = (os.path.realpath(keys_file_dir), get_source_signature(keys_file_dir))
+    with _POSTCODE_DATA_LOCK:
+        if key not in _POSTCODE_DATA:
+            # the postcode files are compiled into a memory mapped snapshot the first time they are loaded
+            _POSTCODE_DATA[key] = PostcodeData(PostcodeSnapshot.load(keys_file_dir, snapshot_dir))
+        return _POSTCODE_DATA[key]
 
-    _postcode_boundary_file = "postcode_boundaries.json"
-    _postcode_boundaries = {}
-    _postcode_grid_file = "postcode_grid.csv"
-    _postcode_cellid_file = "cellid_to_postcode.csv"
-    _postcode_quadtree = QuadTree(8, 8, -44.36151598, 115.35990092, 2.56)
-    _cellid_to_postcode = {}
 
-    def __init__(self, keys_file_dir=None):
+class PostcodeLookup(object):
+    """Functionality to perform postcode lookup"""
+
+    def __init__(self, keys_file_dir=None, cache_size=DEFAULT_POSTCODE_CACHE_SIZE, snapshot_dir=None):
         self._keys_file_dir = keys_file_dir
-        if self._keys_file_dir:
-            self._load_postcode_boundaries()
-
-    def _load_postcode_boundaries(self):
-        # loading cellid-postcode lookup first
-        with open(path.join(self._keys_file_dir, self._postcode_cellid_file), 'r') as f:
-            reader = csv.DictReader(f, delimiter=",")
-            for row in reader:
-                cellid = str(row["cellid"])
-                postcode = int(row["postcode"])
-                if cellid not in self._cellid_to_postcode:
-                    self._cellid_to_postcode[cellid] = []
-                self._cellid_to_postcode[cellid].append(postcode)
-
-        # now we load the quad tree
-        with open(path.join(self._keys_file_dir, self._postcode_grid_file), 'r') as f:
-            reader = csv.DictReader(f, delimiter=",")
-            for row in reader:
-                cellid = str(row["cellid"])
-                latitude = float(row["latitude"])
-                longitude = float(row["longitude"])
-                size = float(row["size"]) / 2
-                self._postcode_quadtree.Load(cellid, latitude, longitude, size)
-
-        # now we load the postcode boundary shapes
-        with open(path.join(self._keys_file_dir, self._postcode_boundary_file), 'r') as f:
-            boundaries_json = json.load(f)
-
-        for feature in boundaries_json["features"]:
-            postcode = feature["properties"]["postcode"]
-            if postcode not in self._postcode_boundaries.keys():
-                self._postcode_boundaries[postcode] = []
-            self._postcode_boundaries[postcode].append(shape(feature["geometry"]))
+        self._data = get_postcode_data(keys_file_dir, snapshot_dir) if keys_file_dir else None
+        # bounded LRU cache of the postcode of each coordinate
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._duplicates = 0
+        # candidates of each quad tree node, see _get_cell_candidates, and shapes of the boundaries used to build them
+        self._cell_candidates = {}
+        self._boundaries = {}
 
     def get_postcode(self, lon, lat):
-        """Get postcode of a given latitude and longitude
+        """Get postcode of a given latitude and longitude, the postcodes of the last looked up coordinates are cached
 
         :param lon: latitude of the point
         :param lat: longitude of the point
@@ -66,13 +106,146 @@ class PostcodeLookup(object):
         """
         if lat is None or lon is None:
             return None
-        point = Point(float(lon), float(lat))
-        quad = self._postcode_quadtree.Lookup(lat, lon)
+        key = (lon, lat)
+        if key in self._cache:
+            self._cache_hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        self._cache_misses += 1
+        postcode = self._lookup_postcode(lon, lat)
+        if self._cache_size > 0:
+            self._cache[key] = postcode
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return postcode
+
+    def get_postcodes(self, lons, lats):
+        """Get postcodes of arrays of longitudes and latitudes: each distinct coordinate is looked up once, the points
+        descend the quad tree together and are tested against the boundaries of their cell as a batch
+
+        :param lons: longitudes of the points
+        :param lats: latitudes of the points
+        :return: an array of integer postcodes, POSTCODE_NOT_FOUND when not found
+        """
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        postcodes = np.full(len(lons), POSTCODE_NOT_FOUND, dtype=np.int64)
+        valid = ~np.isnan(lons) & ~np.isnan(lats)
+        if self._data is None or not valid.any():
+            return postcodes
+        coordinates, inverse = np.unique(np.column_stack([lons[valid], lats[valid]]), axis=0, return_inverse=True)
+        self._duplicates += int(valid.sum()) - len(coordinates)
+        self._cache_misses += len(coordinates)
+        postcodes[valid] = self._lookup_postcodes(coordinates[:, 0], coordinates[:, 1])[inverse.ravel()]
+        return postcodes
+
+    def cache_info(self):
+        """Returns the statistics of the lookups: points resolved by deduplication in get_postcodes, cache hits and
+        misses (points tested against the postcode boundaries) and hit rate of both"""
+        lookups = self._duplicates + self._cache_hits + self._cache_misses
+        return {"duplicates": self._duplicates, "hits": self._cache_hits, "misses": self._cache_misses,
+                "size": len(self._cache), "max_size": self._cache_size,
+                "hit_rate": (self._duplicates + self._cache_hits) / lookups if lookups else 0.0}
+
+    def _lookup_postcode(self, lon, lat):
+        if self._data is None:
+            return None
+        quad = self._data.quadtree.Lookup(lat, lon)
         if quad:
-            postcodes = self._cellid_to_postcode[quad.CellID]
-            for postcode in postcodes:
-                if postcode in self._postcode_boundaries.keys():
-                    for polygon in self._postcode_boundaries[postcode]:
-                        if polygon.contains(point):
-                            return postcode
+            if abs(lat - quad.Lat) > quad.Size or abs(lon - quad.Long) > quad.Size:
+                # the base cells also hold the points up to a cell away from the edge of the grid
+                return self._lookup_postcode_in_boundaries(self._data.get_cell_postcodes(quad.Node), lon, lat)
+            for postcode, geometry in self._get_cell_candidates(quad):
+                if geometry is None or shapely.contains_xy(geometry, lon, lat):
+                    return postcode
+        return None
+
+    def _lookup_postcodes(self, lons, lats):
+        quadtree = self._data.quadtree
+        nodes = quadtree.lookup_many(lats, lons)
+        postcodes = np.full(len(lons), POSTCODE_NOT_FOUND, dtype=np.int64)
+        order = np.argsort(nodes, kind="stable")
+        cell_nodes, starts = np.unique(nodes[order], return_index=True)
+        for node, start, end in zip(cell_nodes.tolist(), starts.tolist(), starts[1:].tolist() + [len(order)]):
+            if node < 0:
+                continue
+            quad = Quad(quadtree, node)
+            points = order[start:end]
+            outside = (np.abs(lats[points] - quad.Lat) > quad.Size) | (np.abs(lons[points] - quad.Long) > quad.Size)
+            for i in points[outside]:
+                # the base cells also hold the points up to a cell away from the edge of the grid
+                postcode = self._lookup_postcode_in_boundaries(self._data.get_cell_postcodes(node), lons[i], lats[i])
+                postcodes[i] = POSTCODE_NOT_FOUND if postcode is None else postcode
+            points = points[~outside]
+            for postcode, geometry in self._get_cell_candidates(quad) if len(points) else ():
+                if geometry is None:
+                    postcodes[points] = postcode
+                    break
+                inside = shapely.contains_xy(geometry, lons[points], lats[points])
+                postcodes[points[inside]] = postcode
+                points = points[~inside]
+                if not len(points):
+                    break
+        return postcodes
+
+    def _lookup_postcode_in_boundaries(self, postcodes, lon, lat):
+        point = Point(float(lon), float(lat))
+        for postcode in postcodes:
+            for polygon in self._get_boundaries(postcode):
+                if polygon.contains(point):
+                    return postcode
         return None
+
+    def _get_boundaries(self, postcode):
+        boundaries = self._boundaries.get(postcode)
+        if boundaries is None:
+            boundaries = self._boundaries[postcode] = self._data.get_boundaries(postcode)
+        return boundaries
+
+    def _get_cell_candidates(self, quad):
+        """Returns the candidates of a cell of the quad tree, computed the first time the cell is looked up: a single
+        (postcode, None) when the cell is entirely inside one postcode, otherwise (postcode, geometry) pairs of the
+        postcode boundaries clipped to the cell as prepared geometries, the largest first
+
+        :param quad: node of the quad tree
+        :return: tuple of (postcode, geometry or None)
+        """
+        candidates = self._cell_candidates.get(quad.Node)
+        if candidates is not None:
+            return candidates
+        postcodes = self._data.get_cell_postcodes(quad.Node)
+        margin = quad.Size * (1 + CELL_MARGIN)
+        cell = box(quad.Long - margin, quad.Lat - margin, quad.Long + margin, quad.Lat + margin)
+        pieces = []
+        for order, postcode in enumerate(postcodes):
+            for polygon in self._get_boundaries(postcode):
+                if not polygon.intersects(cell):
+                    continue
+                if polygon.contains_properly(cell):
+                    pieces.append((order, postcode, cell))
+                    continue
+                for piece in shapely.get_parts(polygon.intersection(cell)):
+                    if piece.geom_type == "Polygon" and piece.area > 0:
+                        pieces.append((order, postcode, piece))
+        covering = [postcode for _, postcode, piece in pieces if piece is cell]
+        if covering and len(set(postcode for _, postcode, _ in pieces)) == 1:
+            candidates = ((covering[0], None),)
+        else:
+            if not _overlap(pieces):
+                # the postcodes are disjoint, the order of the postcodes of the cell does not matter
+                pieces = [(0, postcode, piece) for _, postcode, piece in pieces]
+            pieces.sort(key=lambda item: (item[0], -item[2].area))
+            for _, _, piece in pieces:
+                shapely.prepare(piece)
+            candidates = tuple((postcode, piece) for _, postcode, piece in pieces)
+        self._cell_candidates[quad.Node] = candidates
+        return candidates
+
+
+def _overlap(pieces):
+    """Whether the interiors of pieces of different postcodes intersect"""
+    for i, (_, postcode, piece) in enumerate(pieces):
+        for _, other_postcode, other_piece in pieces[i + 1:]:
+            if postcode != other_postcode and piece.relate_pattern(other_piece, "2********"):
+                return True
+    return False
@@ -0,0 +1,295 @@
+import csv
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import numpy as np
+import shapely
+from shapely.geometry import shape
+from complex_model.QuadTree import QuadTree, NODE_ARRAYS
+
+"""
+Compiled snapshot of the postcode lookup data of a keys data directory, written once and memory mapped by the keys
+lookup processes instead of parsing the csv files, the GeoJSON boundaries and building the quad tree in each process.
+    snapshot_dir/postcode_{key}.snap: the snapshot, key identifies the keys data directory
+    snapshot_dir/postcode_{key}.lock: lock held while the snapshot is built
+The snapshot starts with MAGIC, the snapshot version and the length of a json header, the header holds the sha1 of
+the source files and their size and modification time (the sha1 are only computed again when those differ), the
+dimensions of the quad tree and the dtype, shape and offset of the arrays that follow:
+    the arrays of the quad tree nodes (see QuadTree.NODE_ARRAYS) and its loaded cell ids
+    the cell ids of cellid_to_postcode.csv, the offsets of their postcodes and the postcodes
+    the index of the cell of each node of the quad tree (-1 when its cell id is not in cellid_to_postcode.csv)
+    the sorted postcodes of the boundaries, the offsets of their boundaries and the WKB of the boundaries
+All the arrays are read in place from the memory mapped file, so the processes forked after loading a snapshot share
+its pages instead of copying python objects.
+"""
+
+MAGIC = b"RFPCSNAP"
+POSTCODE_SNAPSHOT_VERSION = 3
+POSTCODE_GRID = (8, 8, -44.36151598, 115.35990092, 2.56)
+POSTCODE_BOUNDARY_FILE = "postcode_boundaries.json"
+POSTCODE_GRID_FILE = "postcode_grid.csv"
+POSTCODE_CELLID_FILE = "cellid_to_postcode.csv"
+SOURCE_FILES = (POSTCODE_CELLID_FILE, POSTCODE_GRID_FILE, POSTCODE_BOUNDARY_FILE)
+PREFIX = struct.Struct("<8sIQ")
+ALIGNMENT = 64
+
+
+class PostcodeSnapshotError(Exception):
+    pass
+
+
+def get_postcode_snapshot_fp(snapshot_dir, keys_file_dir):
+    """Returns the path of the snapshot of the keys data directory
+
+    :param snapshot_dir: directory containing the snapshots
+    :param keys_file_dir: keys data directory
+    :return: path to the snapshot file
+    """
+    key = hashlib.sha1("{0}\x00{1}".format(os.path.realpath(keys_file_dir), POSTCODE_SNAPSHOT_VERSION)
+                       .encode("utf-8")).hexdigest()
+    return os.path.join(snapshot_dir, "postcode_" + key[:16] + ".snap")
+
+
+def get_source_signature(keys_file_dir):
+    """Returns the size and modification time of the source files of the keys data directory"""
+    signature = []
+    for file_name in SOURCE_FILES:
+        stat = os.stat(os.path.join(keys_file_dir, file_name))
+        signature.extend([stat.st_size, stat.st_mtime_ns])
+    return tuple(signature)
+
+
+def get_source_hashes(keys_file_dir):
+    """Returns the sha1 of the source files of the keys data directory"""
+    hashes = {}
+    for file_name in SOURCE_FILES:
+        sha1 = hashlib.sha1()
+        with open(os.path.join(keys_file_dir, file_name), "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+        hashes[file_name] = sha1.hexdigest()
+    return hashes
+
+
+def read_postcode_sources(keys_file_dir):
+    """Parses the source files of the keys data directory
+
+    :param keys_file_dir: keys data directory
+    :return: quad tree of the grid, dict of the postcodes of each cell id, postcodes of the boundaries and their shapes
+    """
+    # loading cellid-postcode lookup first
+    cellid_to_postcode = {}
+    with open(os.path.join(keys_file_dir, POSTCODE_CELLID_FILE), 'r') as f:
+        reader = csv.DictReader(f, delimiter=",")
+        for row in reader:
+            cellid = str(row["cellid"])
+            postcode = int(row["postcode"])
+            if cellid not in cellid_to_postcode:
+                cellid_to_postcode[cellid] = []
+            cellid_to_postcode[cellid].append(postcode)
+
+    # now we load the quad tree
+    quadtree = QuadTree(*POSTCODE_GRID)
+    with open(os.path.join(keys_file_dir, POSTCODE_GRID_FILE), 'r') as f:
+        reader = csv.DictReader(f, delimiter=",")
+        for row in reader:
+            cellid = str(row["cellid"])
+            latitude = float(row["latitude"])
+            longitude = float(row["longitude"])
+            size = float(row["size"]) / 2
+            quadtree.Load(cellid, latitude, longitude, size)
+
+    # now we load the postcode boundary shapes
+    with open(os.path.join(keys_file_dir, POSTCODE_BOUNDARY_FILE), 'r') as f:
+        boundaries_json = json.load(f)
+    postcodes = [feature["properties"]["postcode"] for feature in boundaries_json["features"]]
+    geometries = [shape(feature["geometry"]) for feature in boundaries_json["features"]]
+    return quadtree, cellid_to_postcode, postcodes, geometries
+
+
+def _encode_strings(strings):
+    return np.frombuffer("\n".join(strings).encode("utf-8"), dtype=np.uint8)
+
+
+def _decode_strings(values, count):
+    return bytes(values).decode("utf-8").split("\n") if count else []
+
+
+def build_postcode_snapshot(keys_file_dir, snapshot_fp):
+    """Writes the snapshot of the keys data directory into snapshot_fp
+
+    :param keys_file_dir: keys data directory
+    :param snapshot_fp: path to the snapshot file
+    :return: number of cells of the quad tree
+    """
+    start = time.time()
+    # the signature is taken first, a source file modified while it is hashed is hashed again on the next load
+    signature = get_source_signature(keys_file_dir)
+    hashes = get_source_hashes(keys_file_dir)
+    quadtree, cellid_to_postcode, postcodes, geometries = read_postcode_sources(keys_file_dir)
+    dims, nodes, cell_ids = quadtree.get_state()
+    arrays = {name: np.frombuffer(nodes[name], dtype=typecode) for name, typecode in NODE_ARRAYS}
+    arrays["cell_ids"] = _encode_strings(cell_ids)
+    arrays["postcode_cell_ids"] = _encode_strings(cellid_to_postcode.keys())
+    arrays["postcode_offsets"] = np.cumsum([0] + [len(values) for values in cellid_to_postcode.values()],
+                                           dtype=np.int64)
+    arrays["postcodes"] = np.array([value for values in cellid_to_postcode.values() for value in values],
+                                   dtype=np.int64)
+    cell_index = {cell_id: i for i, cell_id in enumerate(cellid_to_postcode.keys())}
+    arrays["node_cells"] = np.array([cell_index.get(quadtree.get_cell_id(node), -1)
+                                     for node in range(len(arrays["_lat"]))], dtype=np.int64)
+
+    # the boundaries grouped by postcode, in the order of the features, postcodes that are not integers never match
+    boundaries = sorted([(postcode, i) for i, postcode in enumerate(postcodes) if type(postcode) is int])
+    wkbs = [shapely.to_wkb(geometries[i]) for _, i in boundaries]
+    boundary_postcodes = [postcode for postcode, _ in boundaries]
+    arrays["boundary_postcodes"] = np.array(sorted(set(boundary_postcodes)), dtype=np.int64)
+    arrays["boundary_offsets"] = np.searchsorted(np.array(boundary_postcodes, dtype=np.int64),
+                                                 np.append(arrays["boundary_postcodes"], np.iinfo(np.int64).max))
+    arrays["wkb_offsets"] = np.cumsum([0] + [len(wkb) for wkb in wkbs], dtype=np.int64)
+    arrays["wkb"] = np.frombuffer(b"".join(wkbs), dtype=np.uint8)
+
+    header = {"version": POSTCODE_SNAPSHOT_VERSION, "sources": hashes, "signature": list(signature), "dims": dims,
+              "cell_count": len(cell_ids), "postcode_cell_count": len(cellid_to_postcode), "arrays": {}}
+    offset = 0
+    for name, values in arrays.items():
+        header["arrays"][name] = [values.dtype.str, len(values), offset]
+        offset += -(-values.nbytes // ALIGNMENT) * ALIGNMENT
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = -(-(PREFIX.size + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    tmp_fp = snapshot_fp + ".tmp"
+    with open(tmp_fp, "wb") as f:
+        f.write(PREFIX.pack(MAGIC, POSTCODE_SNAPSHOT_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, values in arrays.items():
+            f.seek(data_start + header["arrays"][name][2])
+            f.write(values.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_fp, snapshot_fp)
+    logging.info("COMPLETED: postcode snapshot of {0} cells and {1} boundaries built in {2} in {3:.2f}s"
+                 .format(len(cell_ids), len(wkbs), snapshot_fp, time.time() - start))
+    return len(cell_ids)
+
+
+class PostcodeSnapshot(object):
+    """Memory mapped snapshot of the postcode lookup data of a keys data directory"""
+
+    def __init__(self, buffer, header, data_start):
+        self._buffer = buffer
+        self._header = header
+        self._data_start = data_start
+
+    @classmethod
+    def open(cls, snapshot_fp, hashes=None):
+        """Memory maps a snapshot
+
+        :param snapshot_fp: path to the snapshot file
+        :param hashes: expected sha1 of the source files, not checked when None
+        :return: PostcodeSnapshot
+        """
+        with open(snapshot_fp, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(buffer) < PREFIX.size:
+            raise PostcodeSnapshotError("truncated postcode snapshot " + snapshot_fp)
+        magic, version, header_length = PREFIX.unpack_from(buffer)
+        if magic != MAGIC or version != POSTCODE_SNAPSHOT_VERSION:
+            raise PostcodeSnapshotError("unsupported postcode snapshot " + snapshot_fp)
+        header = json.loads(bytes(buffer[PREFIX.size:PREFIX.size + header_length]).decode("utf-8"))
+        if hashes is not None and header["sources"] != hashes:
+            raise PostcodeSnapshotError("postcode snapshot " + snapshot_fp + " does not match its source files")
+        if list(header["dims"]) != list(POSTCODE_GRID):
+            raise PostcodeSnapshotError("postcode snapshot " + snapshot_fp + " has another grid")
+        return cls(buffer, header, -(-(PREFIX.size + header_length) // ALIGNMENT) * ALIGNMENT)
+
+    @classmethod
+    def load(cls, keys_file_dir, snapshot_dir):
+        """Loads the snapshot of the keys data directory, building it first if it does not exist yet or if it does not
+        match the source files
+
+        :param keys_file_dir: keys data directory
+        :param snapshot_dir: directory containing the snapshots
+        :return: PostcodeSnapshot
+        """
+        os.makedirs(snapshot_dir, exist_ok=True)
+        snapshot_fp = get_postcode_snapshot_fp(snapshot_dir, keys_file_dir)
+        try:
+            return cls._open_matching(snapshot_fp, keys_file_dir)
+        except (OSError, ValueError, PostcodeSnapshotError):
+            pass
+        with open(snapshot_fp[:-len(".snap")] + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return cls._open_matching(snapshot_fp, keys_file_dir)
+            except (OSError, ValueError, PostcodeSnapshotError):
+                build_postcode_snapshot(keys_file_dir, snapshot_fp)
+            return cls.open(snapshot_fp, get_source_hashes(keys_file_dir))
+
+    @classmethod
+    def _open_matching(cls, snapshot_fp, keys_file_dir):
+        """Memory maps the snapshot if it matches the source files, their sha1 is only computed when their size or
+        modification time differs from the ones recorded in the snapshot"""
+        snapshot = cls.open(snapshot_fp)
+        if snapshot._header.get("signature") == list(get_source_signature(keys_file_dir)):
+            return snapshot
+        return cls.open(snapshot_fp, get_source_hashes(keys_file_dir))
+
+    def _get_array(self, name, typecode=None):
+        dtype, length, offset = self._header["arrays"][name]
+        start = self._data_start + offset
+        values = memoryview(self._buffer)[start:start + length * np.dtype(dtype).itemsize]
+        return values.cast(typecode) if typecode else np.frombuffer(values, dtype=dtype)
+
+    def get_quadtree(self):
+        """Returns the read-only quad tree, its nodes are memoryviews of the snapshot"""
+        arrays = {name: self._get_array(name, typecode) for name, typecode in NODE_ARRAYS}
+        return QuadTree.from_state(self._header["dims"], arrays,
+                                   _decode_strings(self._get_array("cell_ids"), self._header["cell_count"]))
+
+    def get_node_cells(self):
+        """Returns the index of the cell of cellid_to_postcode.csv of each node of the quad tree, -1 if none"""
+        return self._get_array("node_cells", "q")
+
+    def get_cell_postcodes(self):
+        """Returns the offsets of the postcodes of each cell of cellid_to_postcode.csv and the postcodes"""
+        return self._get_array("postcode_offsets", "q"), self._get_array("postcodes", "q")
+
+    def get_boundaries(self):
+        """Returns the sorted postcodes of the boundaries, the offsets of their boundaries, the offsets of the WKB of
+        each boundary and the WKB"""
+        return (self._get_array("boundary_postcodes"), self._get_array("boundary_offsets", "q"),
+                self._get_array("wkb_offsets", "q"), self._get_array("wkb", "B"))
+
+    def get_cellid_to_postcode(self):
+        """Returns the dict of the postcodes of each cell id"""
+        cell_ids = _decode_strings(self._get_array("postcode_cell_ids"), self._header["postcode_cell_count"])
+        offsets, postcodes = self.get_cell_postcodes()
+        return {cell_id: postcodes[start:end].tolist() for cell_id, start, end in zip(cell_ids, offsets, offsets[1:])}
+
+    def get_postcode_boundaries(self):
+        """Returns the dict of the shapes of the boundaries of each postcode"""
+        boundary_postcodes, boundary_offsets, wkb_offsets, wkb = self.get_boundaries()
+        postcode_boundaries = {}
+        for postcode, start, end in zip(boundary_postcodes.tolist(), boundary_offsets, boundary_offsets[1:]):
+            postcode_boundaries[postcode] = [shapely.from_wkb(bytes(wkb[wkb_offsets[i]:wkb_offsets[i + 1]]))
+                                             for i in range(start, end)]
+        return postcode_boundaries
+
+
+if __name__ == "__main__":
+    import argparse
+    from complex_model.DefaultSettings import DEFAULT_POSTCODE_SNAPSHOT_DIRECTORY
+    parser = argparse.ArgumentParser(description='Builds the postcode lookup snapshot of a keys data directory.')
+    parser.add_argument("keys_file_dir", help="keys data directory containing the postcode files")
+    parser.add_argument("--snapshot-dir", default=os.environ.get("RF_POSTCODE_SNAPSHOT_DIRECTORY") or
+                        DEFAULT_POSTCODE_SNAPSHOT_DIRECTORY)
+    args = parser.parse_args()
+    os.makedirs(args.snapshot_dir, exist_ok=True)
+    snapshot_fp = get_postcode_snapshot_fp(args.snapshot_dir, args.keys_file_dir)
+    build_postcode_snapshot(args.keys_file_dir, snapshot_fp)
+    print(snapshot_fp)
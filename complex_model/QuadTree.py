@@ -1,4 +1,15 @@
 # Python translation of QuadTree from Risk.Platform.Standard
+from array import array
+import numpy as np
+
+# The nodes are stored in flat arrays: node i has its centroid (Lat[i], Long[i]), its size (dist from centroid to edge)
+# and the index of its 4 children (-1 for a leaf). The child of a point is east * 2 + south where east is
+# longitude > Long and south is latitude <= Lat, the suffix of its generated cell id is str(east) + str(south):
+# 0 Nw "00", 1 Sw "01", 2 Ne "10", 3 Se "11".
+MAX_DEPTH = 64
+# typed arrays of the nodes and their type codes, see get_state
+NODE_ARRAYS = (("_lat", "d"), ("_long", "d"), ("_size", "d"), ("_children", "i"), ("_loaded", "b"),
+               ("_cell_index", "i"), ("_parent", "i"), ("_prefix_index", "i"))
 
 
 class QuadTree(object):  # in decimal degrees dist from centroid to edge
@@ -8,17 +19,129 @@ class QuadTree(object):  # in decimal degrees dist from centroid to edge
         self.__minLong = minLongCentroid
         self.__baseSize = baseSize
         self.__minLat = minLatCentroid
-        self.__baseGrid = [[Quad("b" + str(latInx) + "-" + str(longInx) + "-", True, self.__baseSize,
-                                 latInx * 2 * self.__baseSize + self.__minLat,
-                                 longInx * 2 * self.__baseSize + self.__minLong) for longInx in range(0, longDim)] for
-                           latInx in range(0, latDim)]
+        # nodes as growable typed arrays, copied into numpy arrays on the first lookup_many
+        self._lat = array("d")
+        self._long = array("d")
+        self._size = array("d")
+        self._children = array("i")
+        self._loaded = array("b")
+        # loaded cell id (index in _cell_ids) or -1, generated cell ids are derived from the parent
+        self._cell_index = array("i")
+        self._parent = array("i")
+        self._prefix_index = array("i")  # loaded cell id of the parent when it was divided or -1
+        self._cell_ids = []
+        self._arrays = None
+        self._generated_ids = {}
+        for latInx in range(0, latDim):
+            for longInx in range(0, longDim):
+                self._add_node(latInx * 2 * self.__baseSize + self.__minLat,
+                               longInx * 2 * self.__baseSize + self.__minLong, self.__baseSize, -1, -1)
+
+    def get_state(self):
+        """Returns the dimensions of the grid, the arrays of the nodes (see NODE_ARRAYS) and the loaded cell ids"""
+        return ([self.__latDim, self.__longDim, self.__minLat, self.__minLong, self.__baseSize],
+                {name: getattr(self, name) for name, _ in NODE_ARRAYS}, self._cell_ids)
+
+    @classmethod
+    def from_state(cls, dims, arrays, cell_ids):
+        """Creates a read-only quad tree from the state returned by get_state, no cell can be loaded into it
+
+        :param dims: dimensions of the grid
+        :param arrays: dict of arrays of the nodes, any buffers of the type codes of NODE_ARRAYS (e.g. memoryviews)
+        :param cell_ids: list of the loaded cell ids
+        :return: QuadTree
+        """
+        tree = cls.__new__(cls)
+        tree.__latDim, tree.__longDim, tree.__minLat, tree.__minLong, tree.__baseSize = dims
+        for name, _ in NODE_ARRAYS:
+            setattr(tree, name, arrays[name])
+        tree._cell_ids = cell_ids
+        tree._arrays = (np.frombuffer(tree._lat, dtype=np.float64), np.frombuffer(tree._long, dtype=np.float64),
+                        np.frombuffer(tree._children, dtype=np.intc))
+        tree._generated_ids = {}
+        return tree
+
+    def _add_node(self, lat, lon, size, parent, prefix_index):
+        self._lat.append(lat)
+        self._long.append(lon)
+        self._size.append(size)
+        self._children.append(-1)
+        self._loaded.append(0)
+        self._cell_index.append(-1)
+        self._parent.append(parent)
+        self._prefix_index.append(prefix_index)
+        return len(self._lat) - 1
+
+    def _divide(self, node):
+        new_size = self._size[node] / 2
+        lat, lon = self._lat[node], self._long[node]
+        first = len(self._lat)
+        for east, south in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+            self._add_node(lat - new_size if south else lat + new_size, lon + new_size if east else lon - new_size,
+                           new_size, node, self._cell_index[node])
+        self._children[node] = first
+
+    def _get_arrays(self):
+        if self._arrays is None:
+            self._arrays = (np.array(self._lat), np.array(self._long), np.array(self._children))
+        return self._arrays
 
     def Lookup(self, latitude, longitude):
         latInx = self.LatInx(latitude)
         longInx = self.LongInx(longitude)
         if latInx < 0 or latInx >= self.__latDim or longInx < 0 or longInx >= self.__longDim:
             return None
-        return self.__baseGrid[latInx][longInx].Lookup(latitude, longitude)
+        lats, longs, children = self._lat, self._long, self._children
+        node = latInx * self.__longDim + longInx
+        while children[node] >= 0:
+            node = children[node] + 2 * (longitude > longs[node]) + (latitude <= lats[node])
+        return Quad(self, node)
+
+    def lookup_many(self, latitudes, longitudes):
+        """Looks up the leaves of arrays of points, all the points descend the tree one level at a time
+
+        :param latitudes: array of latitudes
+        :param longitudes: array of longitudes
+        :return: array of node indices, -1 for the points outside of the grid (see get_cell_id)
+        """
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        lats, longs, children = self._get_arrays()
+        with np.errstate(invalid="ignore"):
+            lat_inx = np.trunc((latitudes - self.__minLat + self.__baseSize) / (2 * self.__baseSize))
+            long_inx = np.trunc((longitudes - self.__minLong + self.__baseSize) / (2 * self.__baseSize))
+        inside = (lat_inx >= 0) & (lat_inx < self.__latDim) & (long_inx >= 0) & (long_inx < self.__longDim)
+        nodes = np.full(len(latitudes), -1, dtype=np.int64)
+        nodes[inside] = lat_inx[inside].astype(np.int64) * self.__longDim + long_inx[inside].astype(np.int64)
+        active = np.flatnonzero(inside)
+        while len(active):
+            active = active[children[nodes[active]] >= 0]
+            current = nodes[active]
+            nodes[active] = children[current] + 2 * (longitudes[active] > longs[current]) \
+                + (latitudes[active] <= lats[current])
+        return nodes
+
+    def get_cell_id(self, node):
+        """Returns the cell id of a node: the loaded cell id or the one generated when its parent was divided"""
+        if self._cell_index[node] >= 0:
+            return self._cell_ids[self._cell_index[node]]
+        cell_id = self._generated_ids.get(node)
+        if cell_id is None:
+            cell_id = self._generated_ids[node] = self._generate_cell_id(node)
+        return cell_id
+
+    def _generate_cell_id(self, node):
+        suffixes = []
+        while True:
+            parent = self._parent[node]
+            if parent < 0:
+                latInx, longInx = divmod(node, self.__longDim)
+                return "b" + str(latInx) + "-" + str(longInx) + "-" + "".join(reversed(suffixes))
+            position = node - self._children[parent]
+            suffixes.append(str(position // 2) + str(position % 2))
+            if self._prefix_index[node] >= 0:
+                return self._cell_ids[self._prefix_index[node]] + "".join(reversed(suffixes))
+            node = parent
 
     def LongInx(self, longitude):
         return int((longitude - self.__minLong + self.__baseSize) / (2 * self.__baseSize))
@@ -29,66 +152,54 @@ class QuadTree(object):  # in decimal degrees dist from centroid to edge
     def Load(self, cellId, latitude, longitude, size):
         latInx = self.LatInx(latitude)
         longInx = self.LongInx(longitude)
-        self.__baseGrid[latInx][longInx].Load(cellId, latitude, longitude, size)
+        if not -self.__latDim <= latInx < self.__latDim or not -self.__longDim <= longInx < self.__longDim:
+            raise IndexError("cell " + str(cellId) + " is outside of the quad tree")
+        self._arrays = None
+        self._generated_ids = {}
+        node = (latInx % self.__latDim) * self.__longDim + longInx % self.__longDim
+        for _ in range(MAX_DEPTH):
+            if abs(size - self._size[node]) < 0.00001:
+                self._cell_index[node] = len(self._cell_ids)
+                self._cell_ids.append(cellId)
+                self._loaded[node] = 1
+                return
+            if self._children[node] < 0:
+                self._divide(node)
+            node = self._children[node] + 2 * (longitude > self._long[node]) + (latitude <= self._lat[node])
+        raise ValueError("cell " + str(cellId) + " of size " + str(size) + " does not match the quad tree")
 
     def PostLoadTest(self):
-        return all([y.IsValid() for x in self.__baseGrid for y in self.__baseGrid[x]])
+        return not any(loaded and children >= 0 for loaded, children in zip(self._loaded, self._children))
 
 
 class Quad(object):
-    def __init__(self, cellID, isLeaf, size, lat, lon):
-        self.CellID = cellID
-        self.IsLeaf = isLeaf
-        self.WasLoaded = False
-        self.Size = size  # dist from centroid to edge (start at 2.56 degrees)
-        self.Lat = lat  # centroid latitude
-        self.Long = lon  # centroid longitude
-        self.Ne = None  # children if not a leaf
-        self.Nw = None
-        self.Se = None
-        self.Sw = None
-
-    def Divide(self):
-        newSize = self.Size / 2
-        self.IsLeaf = False
-        self.Ne = Quad(self.CellID + "10", True, newSize, self.Lat + newSize, self.Long + newSize)
-        self.Nw = Quad(self.CellID + "00", True, newSize, self.Lat + newSize, self.Long - newSize)
-        self.Se = Quad(self.CellID + "11", True, newSize, self.Lat - newSize, self.Long + newSize)
-        self.Sw = Quad(self.CellID + "01", True, newSize, self.Lat - newSize, self.Long - newSize)
+    """View of a node of the quad tree"""
+    __slots__ = ("_tree", "Node")
 
-    def Lookup(self, latitude, longitude):
-        if self.IsLeaf:
-            return self
-        if latitude <= self.Lat and longitude <= self.Long:
-            return self.Sw.Lookup(latitude, longitude)
-        if latitude > self.Lat and longitude > self.Long:
-            return self.Ne.Lookup(latitude, longitude)
-        if latitude > self.Lat and longitude <= self.Long:
-            return self.Nw.Lookup(latitude, longitude)
-        return self.Se.Lookup(latitude, longitude)
+    def __init__(self, tree, node):
+        self._tree = tree
+        self.Node = node
 
-    def Load(self, cellId, latitude, longitude, size):
-        if abs(size - self.Size) < 0.00001:
-            self.CellID = cellId
-            self.WasLoaded = True
-            return
-        if self.IsLeaf:
-            self.Divide()
-
-        if latitude <= self.Lat and longitude <= self.Long:
-            self.Sw.Load(cellId, latitude, longitude, size)
-        if latitude > self.Lat and longitude > self.Long:
-            self.Ne.Load(cellId, latitude, longitude, size)
-        if latitude > self.Lat and longitude <= self.Long:
-            self.Nw.Load(cellId, latitude, longitude, size)
-        if latitude <= self.Lat and longitude > self.Long:
-            self.Se.Load(cellId, latitude, longitude, size)
-
-    def IsValid(self):
-        if self.WasLoaded and self.IsLeaf:
-            return True
-        if self.WasLoaded and not self.IsLeaf:
-            return False
-        if not self.WasLoaded and self.IsLeaf:
-            return True
-        return self.Ne.IsValid() and self.Nw.IsValid() and self.Se.IsValid() and self.Sw.IsValid()
+    @property
+    def CellID(self):
+        return self._tree.get_cell_id(self.Node)
+
+    @property
+    def IsLeaf(self):
+        return self._tree._children[self.Node] < 0
+
+    @property
+    def WasLoaded(self):
+        return bool(self._tree._loaded[self.Node])
+
+    @property
+    def Size(self):
+        return self._tree._size[self.Node]
+
+    @property
+    def Lat(self):
+        return self._tree._lat[self.Node]
+
+    @property
+    def Long(self):
+        return self._tree._long[self.Node]
@@ -3,19 +3,22 @@ import os
 import json
 import sys
 import logging
+import threading
 from subprocess import Popen, PIPE
 import psutil
 import platform
 
-import pandas as pd
 import complex_model.DefaultSettings as DS
 
 from backports.tempfile import TemporaryDirectory
-from complex_model.OasisToRF import create_rf_input, DEFAULT_DB, get_connection_string, is_valid_model_data
-from complex_model.GulcalcToBin import gulcalc_sqlite_fp_to_bin
+from complex_model.OasisToRF import create_rf_input_from_csv, DEFAULT_DB, get_connection_string, is_valid_model_data
+from complex_model.GulcalcToBin import gulcalc_sqlite_fp_to_bins, gulcalc_live_to_bins
+from complex_model.LossTransport import create_loss_pipe, close_loss_pipe, LIVE_LOSS_RECORD_FORMAT
+from complex_model.Checkpoint import Checkpoint, STAGE_RF_INPUT, STAGE_ENGINE
+from complex_model.InputCache import get_cached_rf_input, get_input_key
 from complex_model.Common import PerilSet
 from complex_model.RFException import FileNotFoundException, DotNetEngineException
-from complex_model.utils import is_bool, is_float, is_integer, to_bool
+from complex_model.utils import is_bool, is_float, is_integer, to_bool, get_file_key
 from datetime import datetime
 import multiprocessing
 
@@ -145,16 +148,14 @@ def main():
     else:
         model_settings = {}
 
-    # Read the inputs, including the extended items
-    with open(os.path.join(inputs_fp, 'coverages.csv')) as p:
-        coverages_pd = pd.read_csv(p)
+    # the inputs, including the extended items, are read chunk by chunk when the RF input database is built
+    coverages_fp = os.path.join(inputs_fp, 'coverages.csv')
+    if not os.path.exists(coverages_fp):
+        raise Exception('Coverages file does not exist')
 
     # with open(os.path.join(inputs_fp, 'gulsummaryxref.csv')) as p:
     #    gulsummaryxref_pd = pd.read_csv(p)
 
-    with open(complex_items_fp) as p:
-        items_pd = pd.read_csv(p)
-
     # dump some system diagnostic into log
     platform_name = platform.platform()
     logging.info("Platform: {0}".format(platform_name))
@@ -174,6 +175,21 @@ def main():
             working_dir = "/tmp/oasis_debug_{}".format(event_batch)
             clean_directory(working_dir)
             log_fp = os.path.join(working_dir, log_filename)
+
+        # opt-in persistent working directory so that a retry resumes from the completed stages
+        checkpoint = None
+        checkpoint_root = DS.DEFAULT_CHECKPOINT_DIRECTORY
+        if "RF_CHECKPOINT_DIRECTORY" in os.environ and os.environ["RF_CHECKPOINT_DIRECTORY"]:
+            checkpoint_root = os.environ["RF_CHECKPOINT_DIRECTORY"]
+        if checkpoint_root:
+            checkpoint_key = get_file_key([analysis_settings_fp, coverages_fp, complex_items_fp], event_batch,
+                                          max_event_batch, DS.INTEGRATION_VERSION,
+                                          os.path.abspath(args.model_data_directory))
+            checkpoint = Checkpoint(checkpoint_root, event_batch, checkpoint_key)
+            working_dir = checkpoint.working_dir
+            logging.info("Checkpoint of batch " + str(event_batch) + " (attempt "
+                         + str(checkpoint.manifest["attempts"]) + ") completed stages: "
+                         + ", ".join(checkpoint.manifest["stages"].keys()))
         logging.info("Working directory for worker with batch " + str(event_batch) + " is set to be " + working_dir)
         logging.info("The process independent log file for this worker is " + log_filename)
 
@@ -197,9 +213,39 @@ def main():
         logging.info("License file found at " + licence_file)
 
         # populate RF exposure and coverage datatable
-        logging.info("STARTED: Generating RF input database in " + temp_db_fp)
-        num_rows = create_rf_input(items_pd, coverages_pd, temp_db_fp, risk_platform_data)
-        logging.info("COMPLETED: RF input database generated in " + temp_db_fp + " [OK]")
+        rf_input_stage = checkpoint.get_stage(STAGE_RF_INPUT) if checkpoint is not None else None
+        if rf_input_stage is not None and os.path.isfile(temp_db_fp):
+            num_rows = rf_input_stage["num_rows"]
+            logging.info("COMPLETED: RF input database resumed from checkpoint in " + temp_db_fp + " [OK]")
+        else:
+            logging.info("STARTED: Generating RF input database in " + temp_db_fp)
+            input_chunk_size = DS.DEFAULT_INPUT_CHUNK_SIZE
+            if "RF_INPUT_CHUNK_SIZE" in os.environ and is_integer(os.environ["RF_INPUT_CHUNK_SIZE"]) \
+                    and 1 <= int(os.environ["RF_INPUT_CHUNK_SIZE"]):
+                input_chunk_size = int(os.environ["RF_INPUT_CHUNK_SIZE"])
+            input_cache_root = DS.DEFAULT_INPUT_CACHE_DIRECTORY
+            if "RF_INPUT_CACHE_DIRECTORY" in os.environ and os.environ["RF_INPUT_CACHE_DIRECTORY"]:
+                input_cache_root = os.environ["RF_INPUT_CACHE_DIRECTORY"]
+            if input_cache_root:
+                # the database is built once per node and cloned by the other event batches
+                input_cache_budget = DS.DEFAULT_INPUT_CACHE_BUDGET_MB
+                if "RF_INPUT_CACHE_BUDGET_MB" in os.environ and is_integer(os.environ["RF_INPUT_CACHE_BUDGET_MB"]):
+                    input_cache_budget = int(os.environ["RF_INPUT_CACHE_BUDGET_MB"])
+                input_key = get_input_key([complex_items_fp, coverages_fp],
+                                          os.path.join(risk_platform_data, DEFAULT_DB), DS.INTEGRATION_VERSION)
+                num_rows = get_cached_rf_input(input_cache_root, input_key, temp_db_fp,
+                                               lambda fp: create_rf_input_from_csv(complex_items_fp, coverages_fp, fp,
+                                                                                   risk_platform_data,
+                                                                                   input_chunk_size),
+                                               input_cache_budget * 2**20)
+            else:
+                num_rows = create_rf_input_from_csv(complex_items_fp, coverages_fp, temp_db_fp, risk_platform_data,
+                                                    input_chunk_size)
+            if checkpoint is not None:
+                checkpoint.complete_stage(STAGE_RF_INPUT, num_rows=int(num_rows))
+            logging.info("COMPLETED: RF input database generated in " + temp_db_fp + " [OK]")
+
+        engine_completed = checkpoint is not None and checkpoint.get_stage(STAGE_ENGINE) is not None
 
         # generate oasis_param.json
         complex_model_directory = args.complex_model_directory
@@ -212,6 +258,20 @@ def main():
                 and 1 <= int(os.environ["RF_MAX_DEGREE_OF_PARALLELISM"]):
             max_parallelism = int(os.environ["RF_MAX_DEGREE_OF_PARALLELISM"])
 
+        pipelined_streaming = DS.DEFAULT_PIPELINED_STREAMING
+        if "RF_PIPELINED_STREAMING" in os.environ:
+            pipelined_streaming = to_bool(os.environ["RF_PIPELINED_STREAMING"])
+
+        conversion_pool_size = DS.DEFAULT_CONVERSION_POOL_SIZE
+        if "RF_CONVERSION_POOL_SIZE" in os.environ \
+                and is_integer(os.environ["RF_CONVERSION_POOL_SIZE"]) \
+                and 1 <= int(os.environ["RF_CONVERSION_POOL_SIZE"]):
+            conversion_pool_size = int(os.environ["RF_CONVERSION_POOL_SIZE"])
+
+        live_transport = DS.DEFAULT_LIVE_TRANSPORT
+        if "RF_LIVE_TRANSPORT" in os.environ:
+            live_transport = to_bool(os.environ["RF_LIVE_TRANSPORT"])
+
         batch_exposure_size = DS.DEFAULT_BATCH_EXPOSURE_SIZE
         if "RF_BATCH_EXPOSURE_SIZE" in os.environ and is_integer(os.environ["RF_BATCH_EXPOSURE_SIZE"]):
             batch_exposure_size = int(os.environ["RF_BATCH_EXPOSURE_SIZE"])
@@ -235,11 +295,43 @@ def main():
         input_scaling = max(-1.0, input_scaling)
         input_scaling = min(input_scaling, 1.0)
 
+        # samples below the loss threshold (and zero losses) are not streamed when a threshold greater than 0 is set
+        loss_threshold = None
+        if 'lossThreshold' in model_settings and is_float(model_settings['lossThreshold']) \
+                and float(model_settings['lossThreshold']) > 0:
+            loss_threshold = float(model_settings['lossThreshold'])
+
         hailaus_db = DS.DEFAULT_HAILAUS_DB
         if ('event_set' in model_settings and model_settings['event_set'].lower() == 'restricted') or \
            ('event_occurrence_id' in model_settings and model_settings['event_occurrence_id'].lower() == 'restricted'):
             hailaus_db = DS.DEFAULT_HAILAUS_DB + "_restricted"
 
+        gul_streams = []
+        if do_item_output:
+            gul_streams.append((output_item, (2, 1)))
+        if do_coverage_output:
+            gul_streams.append((output_coverage, (1, 2)))
+        if not gul_streams:
+            # neither item nor coverage output requested: nothing is streamed
+            gul_passes = []
+        elif len(set(id(gul_output) for gul_output, _ in gul_streams)) == len(gul_streams):
+            # item and coverage streams are generated in a single pass over the partial losses
+            gul_passes = [gul_streams]
+        else:
+            gul_passes = [[gul_stream] for gul_stream in gul_streams]
+        if live_transport and checkpoint is not None:
+            # live losses are not persisted so the engine could not be resumed
+            logging.warning("Live transport is not supported with checkpoints")
+            live_transport = False
+        if engine_completed:
+            pipelined_streaming = False
+        if live_transport and len(gul_passes) > 1:
+            # the live stream can only be consumed once
+            logging.warning("Live transport is not supported when item and coverage streams share an output")
+            live_transport = False
+        if live_transport and not gul_passes:
+            live_transport = False
+
         oasis_param = {
             "Peril": DS.DEFAULT_RF_PERIL_ID,
             "ItemConduit": {"DbBrand": 1, "ConnectionString": get_connection_string(temp_db_fp)},
@@ -265,6 +357,18 @@ def main():
             "BatchExposureSize": batch_exposure_size,
         }
 
+        live_fd = None
+        if live_transport:
+            # losses are sent by the engine through a named pipe instead of partial loss databases
+            result_pipe_fp = os.path.join(working_dir, "oasis_loss.fifo")
+            oasis_param["ResultPipe"] = {"Path": result_pipe_fp, "RecordFormat": LIVE_LOSS_RECORD_FORMAT}
+        if checkpoint is not None and not engine_completed:
+            # the engine cannot resume: what an interrupted engine left is discarded and the engine is run again
+            num_discarded = checkpoint.discard_partial_losses(temp_db_fp)
+            if num_discarded:
+                logging.info("Discarded " + str(num_discarded) + " partial loss files of an interrupted engine for "
+                             + "event batch " + str(event_batch))
+
         oasis_param_fp = os.path.join(working_dir, "oasis_param.json")
         with open(oasis_param_fp, 'w') as param:
             param.writelines(json.dumps(oasis_param, indent=4, separators=(',', ': ')))
@@ -274,33 +378,84 @@ def main():
         # call Risk.Platform.Core/Risk.Platform.Core.dll --oasis -c oasis_param.json [--debug] --log path_to_log.txt
         dotnet_exe = os.path.join(oasis_param["ComplexModelDirectory"], "Risk.Platform.Core", "Risk.Platform.Core")
         cmd_str = "{} --oasis -c {} {} --log {}".format(dotnet_exe, oasis_param, "--debug" if _DEBUG else "", log_fp)
-        process = Popen([dotnet_exe, '--oasis', '-c', oasis_param_fp, "--debug" if _DEBUG else "", "--log", log_fp],
-                        stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        try:
-            logging.info("STARTED: Calling Risk Frontiers .Net engine: " + cmd_str + " for event batch "
-                         + str(event_batch))
-            output, error = process.communicate()
+        process = None
+        engine_result = {}
+
+        def run_engine():
+            try:
+                engine_result["output"], engine_result["error"] = process.communicate()
+            finally:
+                if live_fd is not None:
+                    # ends the live stream if the engine did not (failure or no support of ResultPipe)
+                    close_loss_pipe(result_pipe_fp)
+
+        def check_engine_result():
             logging.info("The .Net engine was executed and return code is " + str(process.returncode))
-
             if not process.returncode == 0:
-                logging.error("An error occurred while calling the Risk Frontiers .Net engine: " + str(error))
-                raise DotNetEngineException(str(error), error_code=501)
+                logging.error("An error occurred while calling the Risk Frontiers .Net engine: "
+                              + str(engine_result["error"]))
+                raise DotNetEngineException(str(engine_result["error"]), error_code=501)
 
-            if output and not output == b'':
-                logging.info(".Net engine output: " + output)
+            if engine_result["output"] and not engine_result["output"] == b'':
+                logging.info(".Net engine output: " + str(engine_result["output"]))
             logging.info("COMPLETED: Loss database has been generated in " + temp_db_fp + " for event batch "
                          + str(event_batch))
+            if checkpoint is not None:
+                checkpoint.complete_stage(STAGE_ENGINE)
 
-            if do_item_output:
-                gulcalc_sqlite_fp_to_bin(working_dir=working_dir,
-                                         db_fp=temp_db_fp, output=output_item,
-                                         num_sample=int(number_of_samples), stream_id=(2, 1),
-                                         oasis_event_batch=event_batch)
-            if do_coverage_output:
-                gulcalc_sqlite_fp_to_bin(working_dir=working_dir,
-                                         db_fp=temp_db_fp, output=output_coverage,
-                                         num_sample=int(number_of_samples), stream_id=(1, 2),
-                                         oasis_event_batch=event_batch)
+        try:
+            if live_transport:
+                live_fd = create_loss_pipe(result_pipe_fp)
+            if not engine_completed:
+                process = Popen([dotnet_exe, '--oasis', '-c', oasis_param_fp, "--debug" if _DEBUG else "",
+                                 "--log", log_fp], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            logging.info("STARTED: Calling Risk Frontiers .Net engine: " + cmd_str + " for event batch "
+                         + str(event_batch))
+            if engine_completed:
+                logging.info("COMPLETED: Loss database resumed from checkpoint in " + temp_db_fp + " for event batch "
+                             + str(event_batch))
+            elif live_fd is not None:
+                engine_thread = threading.Thread(target=run_engine, daemon=True)
+                engine_thread.start()
+
+                def wait_for_engine():
+                    engine_thread.join()
+                    engine_result["checked"] = True
+                    check_engine_result()
+
+                gulcalc_live_to_bins(working_dir=working_dir, db_fp=temp_db_fp, fd=live_fd, outputs=gul_passes[0],
+                                     num_sample=int(number_of_samples), oasis_event_batch=event_batch,
+                                     wait_for_engine=wait_for_engine, pool_size=conversion_pool_size,
+                                     loss_threshold=loss_threshold)
+                gul_passes = []
+            elif pipelined_streaming:
+                # partial losses are streamed by the main thread while the engine thread drains stdout/stderr
+                engine_thread = threading.Thread(target=run_engine, daemon=True)
+                engine_thread.start()
+
+                def engine_running():
+                    if engine_thread.is_alive():
+                        return True
+                    if "checked" not in engine_result:
+                        engine_result["checked"] = True
+                        check_engine_result()
+                    return False
+            else:
+                run_engine()
+                check_engine_result()
+
+            for pass_index, gul_pass in enumerate(gul_passes):
+                # only the first pass runs along the engine, the others start once it has exited
+                gulcalc_sqlite_fp_to_bins(working_dir=working_dir,
+                                          db_fp=temp_db_fp, outputs=gul_pass,
+                                          num_sample=int(number_of_samples), oasis_event_batch=event_batch,
+                                          is_engine_running=engine_running if pipelined_streaming and pass_index == 0
+                                          else None,
+                                          pool_size=conversion_pool_size, loss_threshold=loss_threshold)
+            if pipelined_streaming:
+                engine_thread.join()
+                if "checked" not in engine_result:
+                    check_engine_result()
 
         except DotNetEngineException as e:
             logging.error("Please look at " + log_fp + " for more information")
@@ -314,6 +469,15 @@ def main():
         except Exception as e:
             logging.error("Some error occurred while generating or streaming losses")
             raise e
+        finally:
+            if live_fd is not None:
+                # the named pipe is released whether or not the live losses could be streamed
+                os.close(live_fd)
+                if os.path.exists(result_pipe_fp):
+                    os.remove(result_pipe_fp)
+
+        if checkpoint is not None:
+            checkpoint.close(success=True)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,9 @@
 # Simple centralised set of utilities to account for changes in Oasis.
 # E.g. how datatypes are assigned to parsed OED columns
+import hashlib
+import os
+
+HASH_BLOCK_SIZE = 2**20
 
 
 def is_integer(obj):
@@ -38,3 +42,34 @@ def to_bool(obj):
         if obj.lower() in ['0', 'false', 'no']:
             return False
     raise TypeError("{0} is not a boolean value".format(obj))
+
+
+def get_file_key(fps, *values):
+    """Returns a key identifying the content of the files and the values (event batch, versions...)
+
+    :param fps: list of file paths
+    :param values: additional values to the key
+    :return: hexadecimal digest
+    """
+    key = hashlib.sha1()
+    for fp in fps:
+        with open(fp, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                key.update(block)
+        key.update(b"\x00")
+    for value in values:
+        key.update(str(value).encode("utf-8") + b"\x00")
+    return key.hexdigest()
+
+
+def get_file_stats(fps):
+    """Returns the path, size and modification time of the files, a cheap key of large files which are not hashed
+
+    :param fps: list of file paths
+    :return: list of values
+    """
+    values = []
+    for fp in fps:
+        stat = os.stat(fp)
+        values.extend([os.path.realpath(fp), stat.st_size, stat.st_mtime_ns])
+    return values
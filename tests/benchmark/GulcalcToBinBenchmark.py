@@ -0,0 +1,232 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+import numpy as np
+import psutil
+from backports.tempfile import TemporaryDirectory
+
+import complex_model.GulcalcToBin as GulcalcToBin
+from complex_model.GulcalcToBin import gulcalc_sqlite_fp_to_bin, get_partial_loss_fp
+
+"""
+Throughput benchmark of the sqlite partial losses to gulcalc binary stream conversion (gulcalc_sqlite_fp_to_bin).
+
+Synthetic oasis_loss_N.db sets are generated for every combination of events x items x samples x partial batches x
+zero-loss fraction, converted, and the measures are saved to a JSON file so that releases can be compared:
+    python -m tests.benchmark.GulcalcToBinBenchmark --events 100 1000 --items 1000 --samples 10 -o results.json
+"""
+
+DEFAULT_RSS_INTERVAL = 0.01
+
+
+def create_benchmark_dbs(working_dir, num_partial, num_events, num_items, num_samples, zero_loss_fraction,
+                         is_sorted=False, seed=1):
+    """Creates the main database with its event_batches table and num_partial oasis_loss_{batch_id}.db partial losses
+    of num_events events each
+
+    :param working_dir: directory where the databases are written
+    :param num_partial: number of partial losses
+    :param num_events: number of events per partial loss
+    :param num_items: number of items
+    :param num_samples: number of samples, the special samples -3 (tiv) and -1 (mean) are added
+    :param zero_loss_fraction: fraction of the losses set to zero
+    :param is_sorted: if False, rows are inserted in random order
+    :param seed: random seed
+    :return: path to the main database and total number of rows
+    """
+    db_fp = os.path.join(working_dir, "riskfrontiersdbAUS_v2_6.db")
+    con = sqlite3.connect(db_fp)
+    con.execute("CREATE TABLE event_batches (batch_id INTEGER);")
+    con.executemany("INSERT INTO event_batches VALUES (?);", [(i,) for i in range(num_partial)])
+    con.commit()
+    con.close()
+
+    rng = np.random.default_rng(seed)
+    sample_ids = np.array([-3, -1] + list(range(1, num_samples + 1)), dtype=np.int64)
+    num_rows = 0
+    for batch_id in range(num_partial):
+        event_ids = np.arange(batch_id * num_events + 1, (batch_id + 1) * num_events + 1, dtype=np.int64)
+        event_col = np.repeat(event_ids, num_items * len(sample_ids))
+        item_col = np.tile(np.repeat(np.arange(1, num_items + 1, dtype=np.int64), len(sample_ids)), num_events)
+        sample_col = np.tile(sample_ids, num_events * num_items)
+        loss_col = rng.uniform(0, 1e6, len(event_col)).astype(np.float32).astype(np.float64)
+        loss_col[rng.random(len(event_col)) < zero_loss_fraction] = 0
+        order = np.arange(len(event_col)) if is_sorted else rng.permutation(len(event_col))
+        con = sqlite3.connect(get_partial_loss_fp(working_dir, batch_id))
+        con.execute("PRAGMA journal_mode = OFF;")
+        con.execute("CREATE TABLE oasis_loss (event_id INTEGER, loc_id INTEGER, sample_id INTEGER, loss REAL);")
+        con.executemany("INSERT INTO oasis_loss VALUES (?, ?, ?, ?);",
+                        zip(event_col[order].tolist(), item_col[order].tolist(), sample_col[order].tolist(),
+                            loss_col[order].tolist()))
+        con.commit()
+        con.close()
+        num_rows = num_rows + len(event_col)
+    return db_fp, num_rows
+
+
+class TimedOutput(object):
+    """Output stream measuring the time spent and the number of bytes written"""
+
+    def __init__(self, output):
+        self._output = output
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def write(self, data):
+        start = time.perf_counter()
+        n = self._output.write(data)
+        self.seconds = self.seconds + time.perf_counter() - start
+        self.bytes = self.bytes + memoryview(data).nbytes
+        return n
+
+
+class TimedEncoder(object):
+    """Replaces GulcalcToBin.gulcalc_encode_chunk to measure the time spent encoding and the number of rows"""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.rows = 0
+        self._encode = None
+
+    def __call__(self, rows, *args, **kwargs):
+        start = time.perf_counter()
+        result = self._encode(rows, *args, **kwargs)
+        self.seconds = self.seconds + time.perf_counter() - start
+        self.rows = self.rows + len(rows)
+        return result
+
+    def __enter__(self):
+        self._encode = GulcalcToBin.gulcalc_encode_chunk
+        GulcalcToBin.gulcalc_encode_chunk = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        GulcalcToBin.gulcalc_encode_chunk = self._encode
+
+
+class PeakRSS(object):
+    """Samples the resident set size of this process and its children in a background thread"""
+
+    def __init__(self, interval=DEFAULT_RSS_INTERVAL):
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.peak = 0
+
+    def _sample(self):
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss = rss + child.memory_info().rss
+            except psutil.Error:
+                pass
+        self.peak = max(self.peak, rss)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self._interval)
+
+    def __enter__(self):
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+def run_case(num_events, num_items, num_samples, num_partial, zero_loss_fraction, is_sorted=False, pool_size=1,
+             loss_threshold=None, repeat=1):
+    """Generates a synthetic partial loss set and measures its conversion, the fastest run is kept. Throughput is
+    given in partial loss rows read per second and in MB of gulcalc stream written per second.
+
+    :return: dictionary of the case parameters and measures
+    """
+    case = {"events": num_events, "items": num_items, "samples": num_samples, "partials": num_partial,
+            "zero_loss_fraction": zero_loss_fraction, "sorted": is_sorted, "pool_size": pool_size,
+            "loss_threshold": loss_threshold}
+    with TemporaryDirectory() as working_dir:
+        db_fp, num_rows = create_benchmark_dbs(working_dir, num_partial, num_events, num_items, num_samples,
+                                               zero_loss_fraction, is_sorted)
+        case["input_rows"] = num_rows
+        case["input_bytes"] = sum(os.path.getsize(get_partial_loss_fp(working_dir, batch_id))
+                                  for batch_id in range(num_partial))
+        best = None
+        for _ in range(repeat):
+            output_fp = os.path.join(working_dir, "gul.bin")
+            with open(output_fp, "wb") as f, TimedEncoder() as encoder, PeakRSS() as rss:
+                output = TimedOutput(f)
+                start = time.perf_counter()
+                gulcalc_sqlite_fp_to_bin(working_dir, db_fp, output, num_samples, pool_size=pool_size,
+                                         loss_threshold=loss_threshold)
+                seconds = time.perf_counter() - start
+            run = {"seconds": seconds, "output_bytes": output.bytes,
+                   "rows_per_second": num_rows / seconds if seconds > 0 else None,
+                   "mb_per_second": output.bytes / 2**20 / seconds if seconds > 0 else None,
+                   "peak_rss_mb": rss.peak / 2**20,
+                   "write_seconds": output.seconds}
+            if pool_size == 1:
+                # with a process pool the encoding happens in the workers and is not measured
+                run["streamed_rows"] = encoder.rows
+                run["encode_seconds"] = encoder.seconds
+                run["fetch_seconds"] = max(0.0, seconds - encoder.seconds - output.seconds)
+            os.remove(output_fp)
+            if best is None or run["seconds"] < best["seconds"]:
+                best = run
+        case.update(best)
+    return case
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of the sqlite to gulcalc binary stream conversion.')
+    parser.add_argument("--events", type=int, nargs="+", default=[100], help="events per partial loss")
+    parser.add_argument("--items", type=int, nargs="+", default=[1000])
+    parser.add_argument("--samples", type=int, nargs="+", default=[10])
+    parser.add_argument("--partials", type=int, nargs="+", default=[4])
+    parser.add_argument("--zero-loss-fraction", type=float, nargs="+", default=[0.0, 0.5])
+    parser.add_argument("--pool-size", type=int, nargs="+", default=[1])
+    parser.add_argument("--loss-threshold", type=float, default=None)
+    parser.add_argument("--sorted", action="store_true", help="insert the rows in stream order")
+    parser.add_argument("--repeat", type=int, default=1, help="number of runs per case, the fastest is kept")
+    parser.add_argument("-o", "--output", default="gulcalc_benchmark.json", help="JSON result file")
+    args = parser.parse_args(argv)
+
+    results = {"date": datetime.now().isoformat(), "revision": get_git_revision(),
+               "python": sys.version.split()[0], "platform": platform.platform(), "cpu_count": os.cpu_count(),
+               "numpy": np.__version__, "sqlite": sqlite3.sqlite_version, "cases": []}
+    for num_events, num_items, num_samples, num_partial, zero_loss_fraction, pool_size in itertools.product(
+            args.events, args.items, args.samples, args.partials, args.zero_loss_fraction, args.pool_size):
+        case = run_case(num_events, num_items, num_samples, num_partial, zero_loss_fraction, args.sorted, pool_size,
+                        args.loss_threshold, args.repeat)
+        results["cases"].append(case)
+        print("events={events} items={items} samples={samples} partials={partials} zero={zero_loss_fraction} "
+              "pool={pool_size}: {rows_per_second:.0f} rows/s {mb_per_second:.1f} MB/s "
+              "peak rss {peak_rss_mb:.0f} MB".format(**case))
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+    return results
+
+
+if __name__ == "__main__":
+    main()
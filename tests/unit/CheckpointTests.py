@@ -0,0 +1,61 @@
+import unittest
+import os
+import sqlite3
+from backports.tempfile import TemporaryDirectory
+
+from tests.unit.RFBaseTest import RFBaseTestCase
+from tests.unit.GulcalcToBinTests import create_partial_loss_dbs
+from complex_model.Checkpoint import Checkpoint, STAGE_RF_INPUT, STAGE_ENGINE
+from complex_model.utils import get_file_key
+from complex_model.GulcalcToBin import get_partial_loss_fp
+
+
+class CheckpointTests(RFBaseTestCase):
+    """This contains tests for the checkpoint and resume of an event batch
+    """
+    def test_stages_are_resumed(self):
+        with TemporaryDirectory() as checkpoint_root:
+            checkpoint = Checkpoint(checkpoint_root, 1, "abc")
+            checkpoint.complete_stage(STAGE_RF_INPUT, num_rows=12)
+            checkpoint.close(success=False)
+
+            checkpoint = Checkpoint(checkpoint_root, 1, "abc")
+            self.assertEqual(2, checkpoint.manifest["attempts"])
+            self.assertEqual({"num_rows": 12}, checkpoint.get_stage(STAGE_RF_INPUT))
+            self.assertIsNone(checkpoint.get_stage(STAGE_ENGINE))
+            working_dir = checkpoint.working_dir
+            checkpoint.close(success=True)
+            self.assertFalse(os.path.exists(working_dir))
+
+    def test_key_depends_on_inputs(self):
+        with TemporaryDirectory() as checkpoint_root:
+            fp = os.path.join(checkpoint_root, "coverages.csv")
+            with open(fp, "w") as f:
+                f.write("coverage_id,tiv\n1,100\n")
+            key = get_file_key([fp], 1, 4)
+            self.assertEqual(key, get_file_key([fp], 1, 4))
+            self.assertNotEqual(key, get_file_key([fp], 2, 4))
+            with open(fp, "a") as f:
+                f.write("2,200\n")
+            self.assertNotEqual(key, get_file_key([fp], 1, 4))
+
+    def test_partial_losses_are_discarded(self):
+        with TemporaryDirectory() as checkpoint_root:
+            checkpoint = Checkpoint(checkpoint_root, 1, "abc")
+            db_fp = create_partial_loss_dbs(checkpoint.working_dir, 3)
+            # interrupted while writing batch 1, not started batch 2
+            open(get_partial_loss_fp(checkpoint.working_dir, 1) + "-journal", "w").close()
+            os.remove(get_partial_loss_fp(checkpoint.working_dir, 2))
+            self.assertEqual(3, checkpoint.discard_partial_losses(db_fp))
+            self.assertFalse(os.path.exists(get_partial_loss_fp(checkpoint.working_dir, 0)))
+            self.assertFalse(os.path.exists(get_partial_loss_fp(checkpoint.working_dir, 1) + "-journal"))
+            self.assertTrue(os.path.isfile(db_fp))
+            con = sqlite3.connect(db_fp)
+            self.assertEqual(0, con.execute("SELECT COUNT(*) FROM event_batches").fetchone()[0])
+            con.close()
+            self.assertEqual(0, checkpoint.discard_partial_losses(db_fp))
+            checkpoint.close(success=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
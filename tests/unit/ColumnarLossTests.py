@@ -0,0 +1,96 @@
+import unittest
+import io
+import os
+import sqlite3
+import numpy as np
+from backports.tempfile import TemporaryDirectory
+from parameterized import parameterized
+
+from tests.unit.RFBaseTest import RFBaseTestCase
+from tests.unit.GulcalcToBinTests import create_partial_loss_dbs
+from complex_model.ColumnarLoss import write_columnar_loss, read_columnar_loss, sqlite_to_columnar_loss, \
+    generate_columnar_losses, COLUMNAR_LOSS_EXTENSION
+from complex_model.GulcalcToBin import gulcalc_sqlite_fp_to_bin, get_partial_loss_fp, get_partial_loss_fps, \
+    get_encoded_size_bound, encode_partial_loss
+
+
+class ColumnarLossTests(RFBaseTestCase):
+    """This contains tests for the columnar partial loss format and its ingest by GulcalcToBin
+    """
+    def test_write_read_round_trip(self):
+        with TemporaryDirectory() as working_dir:
+            fp = os.path.join(working_dir, "oasis_loss_0" + COLUMNAR_LOSS_EXTENSION)
+            self.assertEqual(3, write_columnar_loss(fp, [1, 1, 2], [4, 5, 4], [-3, 1, 1], [1.5, 0, 2.5]))
+            columns, is_sorted = read_columnar_loss(fp)
+            self.assertFalse(is_sorted)
+            self.assertEqual([1, 1, 2], columns["event_id"].tolist())
+            self.assertEqual([4, 5, 4], columns["loc_id"].tolist())
+            self.assertEqual([-3, 1, 1], columns["sample_id"].tolist())
+            self.assertEqual([1.5, 0, 2.5], columns["loss"].tolist())
+            self.assertFalse(columns["loss"].flags.writeable)
+
+    def test_truncated_file(self):
+        with TemporaryDirectory() as working_dir:
+            fp = os.path.join(working_dir, "oasis_loss_0" + COLUMNAR_LOSS_EXTENSION)
+            write_columnar_loss(fp, [1, 1, 2], [4, 5, 4], [-3, 1, 1], [1.5, 0, 2.5])
+            with open(fp, "r+b") as f:
+                f.truncate(40)
+            self.assertRaises(ValueError, read_columnar_loss, fp)
+
+    @parameterized.expand([[True, None], [False, None], [True, 0], [False, 5e5]])
+    def test_columnar_stream_is_identical(self, is_sorted, loss_threshold):
+        with TemporaryDirectory() as working_dir:
+            db_fp = create_partial_loss_dbs(working_dir, 3)
+            expected = io.BytesIO()
+            gulcalc_sqlite_fp_to_bin(working_dir, db_fp, expected, 2, loss_threshold=loss_threshold)
+
+            for batch_id in range(3):
+                batch_res_fp = get_partial_loss_fp(working_dir, batch_id)
+                columnar_fp = os.path.join(working_dir,
+                                           "oasis_loss_{0}{1}".format(batch_id, COLUMNAR_LOSS_EXTENSION))
+                if is_sorted:
+                    sqlite_to_columnar_loss(batch_res_fp, columnar_fp)
+                else:
+                    con = sqlite3.connect(batch_res_fp)
+                    rows = np.array(con.execute("SELECT event_id, loc_id, sample_id, loss FROM oasis_loss "
+                                                "ORDER BY random()").fetchall())
+                    con.close()
+                    write_columnar_loss(columnar_fp, rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3])
+                os.remove(batch_res_fp)
+                self.assertEqual(columnar_fp, get_partial_loss_fp(working_dir, batch_id))
+
+            result = io.BytesIO()
+            gulcalc_sqlite_fp_to_bin(working_dir, db_fp, result, 2, loss_threshold=loss_threshold)
+            self.assertEqual(expected.getvalue(), result.getvalue())
+
+    def test_generate_columnar_losses(self):
+        with TemporaryDirectory() as working_dir:
+            db_fp = os.path.join(working_dir, "riskfrontiersdbAUS_v2_6.db")
+            num_rows = generate_columnar_losses(working_dir, db_fp, 2, num_events=4, num_locs=3, num_samples=5,
+                                                is_sorted=False)
+            self.assertEqual(2 * 4 * 3 * 7, num_rows)
+            result = io.BytesIO()
+            gulcalc_sqlite_fp_to_bin(working_dir, db_fp, result, 5)
+            # header, then per (event, item): header, 7 samples and a separator except for the very first group
+            self.assertEqual(8 + 8 * (2 * 4 * 3 * 9 - 1), len(result.getvalue()))
+
+    def test_partial_loss_sizes(self):
+        with TemporaryDirectory() as working_dir:
+            create_partial_loss_dbs(working_dir, 3, num_samples=1)
+            for batch_id in [1, 2]:
+                db_fp = get_partial_loss_fp(working_dir, batch_id)
+                sqlite_to_columnar_loss(db_fp, os.path.join(working_dir, "oasis_loss_{0}{1}".format(
+                    batch_id, COLUMNAR_LOSS_EXTENSION)))
+            os.remove(os.path.join(working_dir, "oasis_loss_2.db"))
+            open(os.path.join(working_dir, "oasis_loss_0.db-journal"), "w").close()
+            open(os.path.join(working_dir, "oasis_loss_3.rfl.tmp"), "w").close()
+            partial_loss_fps = get_partial_loss_fps(working_dir)
+            self.assertEqual([get_partial_loss_fp(working_dir, batch_id) for batch_id in range(3)], partial_loss_fps)
+            self.assertTrue(partial_loss_fps[1].endswith(COLUMNAR_LOSS_EXTENSION))
+            for partial_loss_fp in partial_loss_fps:
+                self.assertLessEqual(len(encode_partial_loss(partial_loss_fp)[1]),
+                                     get_encoded_size_bound(partial_loss_fp))
+
+
+if __name__ == '__main__':
+    unittest.main()
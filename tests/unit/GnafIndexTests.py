@@ -0,0 +1,106 @@
+import unittest
+import os
+import random
+import sqlite3
+from backports.tempfile import TemporaryDirectory
+
+from tests.unit.RFBaseTest import RFBaseTestCase
+from complex_model.GnafIndex import GnafIndex, get_gnaf_index_fp
+from complex_model import HailAUSKeysLookup
+
+
+def create_address_db(db_fp, address_ids):
+    con = sqlite3.connect(db_fp)
+    con.execute("CREATE TABLE rf_address (address_id nchar(14) NOT NULL, latitude REAL, longitude REAL);")
+    con.executemany("INSERT INTO rf_address (address_id) VALUES (?);", [(address_id,) for address_id in address_ids])
+    con.commit()
+    con.close()
+
+
+class GnafIndexTests(RFBaseTestCase):
+    """This contains tests for the memory mapped index of the supported GNAF addresses
+    """
+    def test_membership(self):
+        rng = random.Random(1)
+        address_ids = ["GA" + rng.choice(["NSW", "VIC", "QLD"]) + str(rng.randrange(10**9)).zfill(9)
+                       for _ in range(5000)]
+        with TemporaryDirectory() as tmp_dir:
+            db_fp = os.path.join(tmp_dir, "model.db")
+            create_address_db(db_fp, address_ids + address_ids[:10])
+            index = GnafIndex.load(db_fp, os.path.join(tmp_dir, "index"))
+            supported = set(address_ids)
+            self.assertEqual(len(supported), len(index))
+            probes = address_ids[::7] + [address_id[:-1] + "X" for address_id in address_ids[::11]] \
+                + ["", "GANSW", "GANSW1234567890123", None, 12, float("nan"), "ZZZZZZZZZZZZZZ"]
+            self.assertEqual([probe in supported if isinstance(probe, str) else False for probe in probes],
+                             index.contains(probes).tolist())
+            self.assertTrue(address_ids[0] in index)
+            self.assertFalse("GANSW" in index)
+
+    def test_index_is_built_once_per_database(self):
+        with TemporaryDirectory() as tmp_dir:
+            db_fp = os.path.join(tmp_dir, "model.db")
+            create_address_db(db_fp, ["GANSW123456789"])
+            index_dir = os.path.join(tmp_dir, "index")
+            GnafIndex.load(db_fp, index_dir)
+            index_fp = get_gnaf_index_fp(index_dir, db_fp)
+            mtime = os.path.getmtime(index_fp)
+            self.assertEqual(1, len(GnafIndex.load(db_fp, index_dir)))
+            self.assertEqual(mtime, os.path.getmtime(index_fp))
+
+            # a new model data version is indexed again
+            con = sqlite3.connect(db_fp)
+            con.execute("INSERT INTO rf_address (address_id) VALUES ('GAVIC123456789');")
+            con.commit()
+            con.close()
+            os.utime(db_fp, ns=(0, os.stat(db_fp).st_mtime_ns + 10**9))
+            self.assertNotEqual(index_fp, get_gnaf_index_fp(index_dir, db_fp))
+            self.assertTrue("GAVIC123456789" in GnafIndex.load(db_fp, index_dir))
+
+    def test_stale_indexes_are_pruned(self):
+        with TemporaryDirectory() as tmp_dir:
+            db_fp = os.path.join(tmp_dir, "model.db")
+            other_db_fp = os.path.join(tmp_dir, "other.db")
+            create_address_db(db_fp, ["GANSW123456789"])
+            create_address_db(other_db_fp, ["GAVIC123456789"])
+            index_dir = os.path.join(tmp_dir, "index")
+            GnafIndex.load(db_fp, index_dir)
+            GnafIndex.load(other_db_fp, index_dir)
+            stale_index_fp = get_gnaf_index_fp(index_dir, db_fp)
+
+            os.utime(db_fp, ns=(0, os.stat(db_fp).st_mtime_ns + 10**9))
+            index_fp = get_gnaf_index_fp(index_dir, db_fp)
+            GnafIndex.load(db_fp, index_dir)
+            self.assertEqual(sorted(os.path.basename(fp[:-len(".npy")]) + extension
+                                    for fp in [index_fp, get_gnaf_index_fp(index_dir, other_db_fp)]
+                                    for extension in [".lock", ".npy"]),
+                             sorted(os.listdir(index_dir)))
+            self.assertFalse(os.path.exists(stale_index_fp))
+
+    def test_empty_table(self):
+        with TemporaryDirectory() as tmp_dir:
+            db_fp = os.path.join(tmp_dir, "model.db")
+            create_address_db(db_fp, [])
+            index = GnafIndex.load(db_fp, tmp_dir)
+            self.assertEqual(0, len(index))
+            self.assertEqual([False], index.contains(["GANSW123456789"]).tolist())
+
+    def test_lookup_loads_index_lazily(self):
+        with TemporaryDirectory() as tmp_dir:
+            db_fp = os.path.join(tmp_dir, "model.db")
+            create_address_db(db_fp, ["GANSW123456789"])
+            lookup = HailAUSKeysLookup(keys_data_directory=None, model_name="hailAus")
+            lookup._gnaf_db_fp = db_fp
+            lookup._gnaf_index = None
+            os.environ["RF_GNAF_INDEX_DIRECTORY"] = os.path.join(tmp_dir, "index")
+            try:
+                self.assertFalse(os.path.exists(os.path.join(tmp_dir, "index")))
+                self.assertTrue(lookup.is_valid_address("GANSW123456789", 1))
+                self.assertFalse(lookup.is_valid_address("GANSW000000000", 1))
+                self.assertTrue(os.path.exists(get_gnaf_index_fp(os.path.join(tmp_dir, "index"), db_fp)))
+            finally:
+                del os.environ["RF_GNAF_INDEX_DIRECTORY"]
+
+
+if __name__ == '__main__':
+    unittest.main()
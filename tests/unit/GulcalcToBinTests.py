@@ -1,7 +1,10 @@
 import unittest
 import csv
+import io
 import sqlite3
+import struct
 import os
+import random
 import subprocess
 from backports.tempfile import TemporaryDirectory
 from parameterized import parameterized
@@ -9,7 +12,9 @@ import pandas as pd
 import itertools
 
 from tests.unit.RFBaseTest import RFBaseTestCase
-from complex_model.GulcalcToBin import gulcalc_sqlite_to_bin, SUPPORTED_GUL_STREAMS, gulcalc_create_header
+from complex_model.GulcalcToBin import gulcalc_sqlite_to_bin, SUPPORTED_GUL_STREAMS, gulcalc_create_header, \
+    gulcalc_sqlite_fp_to_bin, iter_completed_batch_ids, get_partial_loss_fp, gulcalc_parallel_partial_losses_to_bin, \
+    gulcalc_sqlite_fp_to_bins, is_sort_free, GulStreamWriter
 from complex_model.Common import ArgumentOutOfRangeException
 
 
@@ -32,6 +37,47 @@ def load_csv(con, csv_file, reg_col='item_id'):
     con.commit()
 
 
+def legacy_sqlite_to_bin(con, output, add_first_separator):
+    """Reference row by row encoder the vectorized gulcalc_sqlite_to_bin must be byte identical to"""
+    cur = con.cursor()
+    cur.execute("SELECT event_id, loc_id, sample_id, loss FROM oasis_loss ORDER BY event_id, loc_id, sample_id")
+    last_key = (0, 0)
+    for row in cur.fetchall():
+        current_key = (int(row[0]), int(row[1]))
+        if not last_key == current_key:
+            if not last_key == (0, 0) or add_first_separator:
+                output.write(struct.pack('Q', 0))
+            output.write(struct.pack('II', current_key[0], current_key[1]))
+            last_key = current_key
+        output.write(struct.pack('if', int(row[2]), float(row[3])))
+
+
+def create_random_loss_db(num_events, num_locs, num_samples, seed=0):
+    """Creates an in memory oasis_loss table with shuffled rows, special samples and zero losses"""
+    rng = random.Random(seed)
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE TABLE oasis_loss (event_id INTEGER, loc_id INTEGER, sample_id INTEGER, loss REAL);")
+    rows = [(event_id, loc_id, sample_id, 0.0 if rng.random() < 0.3 else rng.uniform(0, 1e6))
+            for event_id in rng.sample(range(1, 10 * num_events), num_events)
+            for loc_id in range(1, num_locs + 1)
+            for sample_id in [-3, -1] + list(range(1, num_samples + 1))]
+    rng.shuffle(rows)
+    con.executemany("INSERT INTO oasis_loss VALUES (?, ?, ?, ?);", rows)
+    con.commit()
+    return con
+
+
+def filter_loss_db(con, loss_threshold):
+    """Reference loss threshold: drops zero or below threshold samples, the special samples are always kept"""
+    rows = con.execute("SELECT event_id, loc_id, sample_id, loss FROM oasis_loss").fetchall()
+    if loss_threshold > 0:
+        rows = [row for row in rows if row[2] < 0 or (row[3] > 0 and row[3] >= loss_threshold)]
+    filtered_con = sqlite3.connect(":memory:")
+    filtered_con.execute("CREATE TABLE oasis_loss (event_id INTEGER, loc_id INTEGER, sample_id INTEGER, loss REAL);")
+    filtered_con.executemany("INSERT INTO oasis_loss VALUES (?, ?, ?, ?);", rows)
+    return filtered_con
+
+
 def recreate_csv_from_bin(working_dir, file_fp, stream_name="loss"):
     """This recreates an in memory sqlite database from an oasis gul csv output"""
     gul_fp = os.path.join(working_dir, "gul.bin")
@@ -104,5 +150,213 @@ class GulcalcToBinTests(RFBaseTestCase):
             self.assertEqual(expected, result)
 
 
+class GulcalcEncoderTests(RFBaseTestCase):
+    """Test that the vectorized encoder generates exactly the same bytes as the row by row encoder"""
+
+    @parameterized.expand([[add_first_separator, fetch_size] for add_first_separator, fetch_size
+                           in itertools.product([False, True], [1, 7, 100, 100000])])
+    def test_byte_identical(self, add_first_separator, fetch_size):
+        con = create_random_loss_db(num_events=13, num_locs=5, num_samples=4)
+        expected = io.BytesIO()
+        legacy_sqlite_to_bin(con, expected, add_first_separator)
+        result = io.BytesIO()
+        rc = gulcalc_sqlite_to_bin(con, result, add_first_separator, fetch_size=fetch_size)
+        con.close()
+        self.assertEqual(13 * 5 * 6, rc)
+        self.assertEqual(expected.getvalue(), result.getvalue())
+
+    @parameterized.expand([[sort_memory] for sort_memory in [None, 2000, 1]])
+    def test_sort_free_byte_identical(self, sort_memory):
+        con = create_random_loss_db(num_events=13, num_locs=5, num_samples=4)
+        expected = io.BytesIO()
+        legacy_sqlite_to_bin(con, expected, True)
+        result = io.BytesIO()
+        gulcalc_sqlite_to_bin(con, result, True, fetch_size=11, sort_memory=sort_memory)
+        self.assertEqual(expected.getvalue(), result.getvalue())
+
+        con.execute("CREATE INDEX loss_order ON oasis_loss (event_id, loc_id, sample_id);")
+        self.assertTrue(is_sort_free(con.cursor(), "SELECT * FROM oasis_loss ORDER BY event_id, loc_id, sample_id"))
+        result = io.BytesIO()
+        gulcalc_sqlite_to_bin(con, result, True, fetch_size=11, sort_memory=sort_memory)
+        con.close()
+        self.assertEqual(expected.getvalue(), result.getvalue())
+
+    @parameterized.expand([[threshold, fetch_size, sort_memory] for threshold, fetch_size, sort_memory
+                           in itertools.product([0, 5e5, 2e6], [1, 5, 100000], [None, 1])])
+    def test_loss_threshold(self, loss_threshold, fetch_size, sort_memory):
+        con = create_random_loss_db(num_events=13, num_locs=5, num_samples=4)
+        filtered_con = filter_loss_db(con, loss_threshold)
+        expected = io.BytesIO()
+        legacy_sqlite_to_bin(filtered_con, expected, True)
+        expected_rc = filtered_con.execute("SELECT count(*) FROM oasis_loss").fetchone()[0]
+        filtered_con.close()
+        result = io.BytesIO()
+        rc = gulcalc_sqlite_to_bin(con, result, True, fetch_size=fetch_size, sort_memory=sort_memory,
+                                   loss_threshold=loss_threshold)
+        con.close()
+        self.assertEqual(expected_rc, rc)
+        self.assertEqual(expected.getvalue(), result.getvalue())
+
+    def test_empty_table(self):
+        con = create_random_loss_db(num_events=0, num_locs=5, num_samples=4)
+        result = io.BytesIO()
+        self.assertEqual(0, gulcalc_sqlite_to_bin(con, result, True))
+        con.close()
+        self.assertEqual(b'', result.getvalue())
+
+
+def create_partial_loss_dbs(working_dir, num_partial, num_events=5, num_locs=3, num_samples=2):
+    """Creates the main database with its event_batches table and the oasis_loss_{batch_id}.db partial losses"""
+    db_fp = os.path.join(working_dir, "riskfrontiersdbAUS_v2_6.db")
+    con = sqlite3.connect(db_fp)
+    con.execute("CREATE TABLE event_batches (batch_id INTEGER);")
+    con.executemany("INSERT INTO event_batches VALUES (?);", [(i,) for i in range(num_partial)])
+    con.commit()
+    con.close()
+    for batch_id in range(num_partial):
+        mem_con = create_random_loss_db(num_events, num_locs, num_samples, seed=batch_id)
+        batch_con = sqlite3.connect(get_partial_loss_fp(working_dir, batch_id))
+        mem_con.backup(batch_con)
+        batch_con.close()
+        mem_con.close()
+    return db_fp
+
+
+class PipelinedStreamingTests(RFBaseTestCase):
+    """Test that partial losses are streamed in order while the engine is running"""
+
+    def test_completed_batches_are_yielded_in_order(self):
+        with TemporaryDirectory() as working_dir:
+            db_fp = create_partial_loss_dbs(working_dir, 4)
+            con = sqlite3.connect(db_fp)
+            con.execute("ALTER TABLE event_batches ADD COLUMN completed INTEGER DEFAULT 0;")
+            con.execute("DELETE FROM event_batches WHERE batch_id > 0;")
+            # batch 2 is registered before batch 1, both before they are complete
+            con.executemany("INSERT INTO event_batches VALUES (?, ?);", [(0, 1), (2, 0), (1, 0)])
+            con.commit()
+            state = {"polls": 0}
+
+            def is_engine_running():
+                state["polls"] = state["polls"] + 1
+                if state["polls"] == 3:
+                    con.execute("UPDATE event_batches SET completed = 1 WHERE batch_id = 2;")
+                    con.commit()
+                elif state["polls"] == 5:
+                    con.execute("UPDATE event_batches SET completed = 1 WHERE batch_id = 1;")
+                    con.commit()
+                elif state["polls"] == 7:
+                    con.execute("INSERT INTO event_batches VALUES (3, 0);")
+                    con.commit()
+                return state["polls"] < 9
+
+            yielded = [(batch_id, state["polls"]) for batch_id
+                       in iter_completed_batch_ids(db_fp, is_engine_running, poll_interval=0)]
+            con.close()
+            # batch 2 waits for batch 1, batch 3 is only streamed once the engine has exited
+            self.assertEqual([(0, 1), (1, 5), (2, 5), (3, 9)], yielded)
+
+    def test_unflagged_batches_wait_for_the_engine(self):
+        with TemporaryDirectory() as working_dir:
+            db_fp = create_partial_loss_dbs(working_dir, 3)
+            state = {"polls": 0}
+
+            def is_engine_running():
+                state["polls"] = state["polls"] + 1
+                return state["polls"] < 3
+
+            yielded = [(batch_id, state["polls"]) for batch_id
+                       in iter_completed_batch_ids(db_fp, is_engine_running, poll_interval=0)]
+            # nothing is streamed while the engine runs, the engine does not flag its batches
+            self.assertEqual([(0, 3), (1, 3), (2, 3)], yielded)
+
+    def test_pipelined_stream_is_identical(self):
+        with TemporaryDirectory() as working_dir:
+            db_fp = create_partial_loss_dbs(working_dir, 3)
+            expected = io.BytesIO()
+            gulcalc_sqlite_fp_to_bin(working_dir, db_fp, expected, 2)
+            result = io.BytesIO()
+            polls = iter([True, True, True, False])
+            gulcalc_sqlite_fp_to_bin(working_dir, db_fp, result, 2, is_engine_running=lambda: next(polls))
+            self.assertEqual(expected.getvalue(), result.getvalue())
+
+
+class ParallelConversionTests(RFBaseTestCase):
+    """Test that partial losses encoded in a process pool are written in batch order"""
+
+    @parameterized.expand([[1], [2], [3]])
+    def test_parallel_stream_is_identical(self, pool_size):
+        with TemporaryDirectory() as working_dir:
+            db_fp = create_partial_loss_dbs(working_dir, 5)
+            expected = io.BytesIO()
+            gulcalc_sqlite_fp_to_bin(working_dir, db_fp, expected, 2)
+            result = io.BytesIO()
+            gulcalc_create_header(result, 2)
+            rc = gulcalc_parallel_partial_losses_to_bin(working_dir, range(5), result, pool_size)
+            self.assertEqual(5 * 5 * 3 * 4, rc)
+            self.assertEqual(expected.getvalue(), result.getvalue())
+
+    @parameterized.expand([[1], [2]])
+    def test_filtered_out_partial_loss(self, pool_size):
+        with TemporaryDirectory() as working_dir:
+            db_fp = create_partial_loss_dbs(working_dir, 3)
+            batch_con = sqlite3.connect(get_partial_loss_fp(working_dir, 0))
+            # a partial loss without special samples and with zero losses only
+            batch_con.execute("DELETE FROM oasis_loss WHERE sample_id < 0;")
+            batch_con.execute("UPDATE oasis_loss SET loss = 0;")
+            batch_con.commit()
+            batch_con.close()
+            expected = io.BytesIO()
+            gulcalc_create_header(expected, 2)
+            for batch_id in [1, 2]:
+                batch_con = sqlite3.connect(get_partial_loss_fp(working_dir, batch_id))
+                filtered_con = filter_loss_db(batch_con, 1)
+                legacy_sqlite_to_bin(filtered_con, expected, batch_id > 1)
+                filtered_con.close()
+                batch_con.close()
+            result = io.BytesIO()
+            if pool_size == 1:
+                gulcalc_sqlite_fp_to_bin(working_dir, db_fp, result, 2, loss_threshold=1)
+            else:
+                gulcalc_create_header(result, 2)
+                gulcalc_parallel_partial_losses_to_bin(working_dir, range(3), result, pool_size, loss_threshold=1)
+            self.assertEqual(expected.getvalue(), result.getvalue())
+
+    def test_threshold_of_zero_does_not_filter(self):
+        with TemporaryDirectory() as working_dir:
+            db_fp = create_partial_loss_dbs(working_dir, 3)
+            expected = io.BytesIO()
+            gulcalc_sqlite_fp_to_bin(working_dir, db_fp, expected, 2)
+            for loss_threshold in [0, 0.0, -1]:
+                result = io.BytesIO()
+                gulcalc_sqlite_fp_to_bin(working_dir, db_fp, result, 2, loss_threshold=loss_threshold)
+                self.assertEqual(expected.getvalue(), result.getvalue())
+
+
+class SinglePassStreamsTests(RFBaseTestCase):
+    """Test that the item and coverage streams generated in a single pass match the ones generated separately"""
+
+    @parameterized.expand([[1], [2]])
+    def test_item_and_coverage_streams(self, pool_size):
+        with TemporaryDirectory() as working_dir:
+            db_fp = create_partial_loss_dbs(working_dir, 3)
+            expected_item = io.BytesIO()
+            gulcalc_sqlite_fp_to_bin(working_dir, db_fp, expected_item, 2, stream_id=(2, 1))
+            expected_coverage = io.BytesIO()
+            gulcalc_sqlite_fp_to_bin(working_dir, db_fp, expected_coverage, 2, stream_id=(1, 2))
+
+            item = io.BytesIO()
+            coverage = io.BytesIO()
+            gulcalc_sqlite_fp_to_bins(working_dir, db_fp, [(item, (2, 1)), (coverage, (1, 2))], 2,
+                                      pool_size=pool_size)
+            self.assertEqual(expected_item.getvalue(), item.getvalue())
+            self.assertEqual(expected_coverage.getvalue(), coverage.getvalue())
+
+    def test_no_output_stream(self):
+        self.assertRaisesWithErrorCode(300, GulStreamWriter, [])
+        with TemporaryDirectory() as working_dir:
+            db_fp = create_partial_loss_dbs(working_dir, 1)
+            self.assertRaises(ArgumentOutOfRangeException, gulcalc_sqlite_fp_to_bins, working_dir, db_fp, [], 2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+from backports.tempfile import TemporaryDirectory
+
+from tests.unit.RFBaseTest import RFBaseTestCase
+from complex_model.InputCache import get_cached_rf_input, evict_rf_inputs, get_input_key
+from complex_model.OasisToRF import DEFAULT_DB
+
+
+def create_db(fp, num_rows):
+    con = sqlite3.connect(fp)
+    con.execute("CREATE TABLE IF NOT EXISTS u_exposure (loc_id TEXT);")
+    con.executemany("INSERT INTO u_exposure VALUES (?);", [(str(i),) for i in range(num_rows)])
+    con.commit()
+    con.close()
+    return num_rows
+
+
+class InputCacheTests(RFBaseTestCase):
+    """This contains tests for the node-local cache of the RF input database
+    """
+    def test_database_is_built_once(self):
+        with TemporaryDirectory() as tmp_dir:
+            cache_root = os.path.join(tmp_dir, "cache")
+            builds = []
+
+            def build(fp):
+                builds.append(fp)
+                return create_db(fp, 5)
+
+            for event_batch in range(3):
+                sqlite_fp = os.path.join(tmp_dir, "batch_{}.db".format(event_batch))
+                self.assertEqual(5, get_cached_rf_input(cache_root, "abc", sqlite_fp, build, 2**30))
+                con = sqlite3.connect(sqlite_fp)
+                self.assertEqual(5, con.execute("SELECT COUNT(*) FROM u_exposure").fetchone()[0])
+                # each batch has its own copy the engine can write to
+                con.execute("INSERT INTO u_exposure VALUES ('x');")
+                con.commit()
+                con.close()
+            self.assertEqual(1, len(builds))
+            self.assertTrue(os.path.isfile(os.path.join(cache_root, "abc", DEFAULT_DB)))
+
+    def test_entry_is_cloned_under_a_shared_lock(self):
+        with TemporaryDirectory() as tmp_dir:
+            cache_root = os.path.join(tmp_dir, "cache")
+            get_cached_rf_input(cache_root, "abc", os.path.join(tmp_dir, "batch_0.db"), lambda fp: create_db(fp, 5),
+                                2**30)
+            # another batch is cloning the entry
+            with open(os.path.join(cache_root, "abc.lock"), "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                self.assertEqual([], evict_rf_inputs(cache_root, 0))
+                result = []
+                clone = threading.Thread(target=lambda: result.append(get_cached_rf_input(
+                    cache_root, "abc", os.path.join(tmp_dir, "batch_1.db"), lambda fp: create_db(fp, 5), 2**30)))
+                clone.start()
+                clone.join(10)
+                self.assertEqual([5], result)
+
+    def test_least_recently_used_are_evicted(self):
+        with TemporaryDirectory() as tmp_dir:
+            cache_root = os.path.join(tmp_dir, "cache")
+            sqlite_fp = os.path.join(tmp_dir, "batch.db")
+            for key in ["a", "b", "c"]:
+                get_cached_rf_input(cache_root, key, sqlite_fp, lambda fp: create_db(fp, 100), 2**30)
+                time.sleep(0.01)
+            # "a" is used again so "b" is the least recently used
+            get_cached_rf_input(cache_root, "a", sqlite_fp, None, 2**30)
+            size = os.path.getsize(os.path.join(cache_root, "a", DEFAULT_DB))
+            self.assertEqual(["b"], evict_rf_inputs(cache_root, 2 * size))
+            self.assertEqual(["c"], evict_rf_inputs(cache_root, size, keep="a"))
+            self.assertTrue(os.path.isfile(os.path.join(cache_root, "a", DEFAULT_DB)))
+
+    def test_key_depends_on_template(self):
+        with TemporaryDirectory() as tmp_dir:
+            items_fp = os.path.join(tmp_dir, "complex_items.csv")
+            with open(items_fp, "w") as f:
+                f.write("item_id\n1\n")
+            template_fp = os.path.join(tmp_dir, DEFAULT_DB)
+            create_db(template_fp, 1)
+            key = get_input_key([items_fp], template_fp, "1.0")
+            self.assertEqual(key, get_input_key([items_fp], template_fp, "1.0"))
+            self.assertNotEqual(key, get_input_key([items_fp], template_fp, "1.1"))
+            create_db(template_fp, 1000)
+            self.assertNotEqual(key, get_input_key([items_fp], template_fp, "1.0"))
+
+
+if __name__ == '__main__':
+    unittest.main()
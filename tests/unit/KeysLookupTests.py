@@ -2,7 +2,9 @@ import unittest
 import copy
 from parameterized import parameterized
 import itertools
+import random
 from datetime import date
+import pandas as pd
 
 from oasislmf.utils.coverages import COVERAGE_TYPES
 
@@ -1068,5 +1070,88 @@ class CreateUniExposureOEDFieldsTests(RFBaseTestCase):
             self.assertEqual(to_bool(smv), exposure["props"]["StaticMotor"])
 
 
+def process_locations_row_by_row(lookup, locs):
+    """Reference row-wise lookup of the locations"""
+    keys = []
+    for (_, record), coverage_type in itertools.product(locs.iterrows(), lookup._coverage_types):
+        ret = lookup.process_location(record, coverage_type)
+        if ret is not None:
+            keys.append(ret)
+    return pd.DataFrame.from_records(keys, columns=['loc_id', 'peril_id', 'coverage_type', 'model_data', 'status',
+                                                    'message'])
+
+
+class ProcessLocationsTests(RFBaseTestCase):
+    """This test ensures that the columnar lookup of a portfolio returns the keys and errors of the row-wise lookup
+    """
+    OED_VALUES = {
+        'locperilscovered': ['AA1', 'AA1', 'AA1', 'XHL', 'QQ1', None],
+        'buildingtiv': [0, 1000.0, float('nan')],
+        'contentstiv': [0, 500.0],
+        'bitiv': [0, 100.0],
+        'othertiv': [0, 0, 0, 10.0],
+        'constructioncode': [5000, 5000, 5000, 5100, 5300, 5850, 5900, 5960, float('nan')],
+        'occupancycode': [1000, 1050, 1100, 1150, 1200, 1000, 1100, 1300, 0, 'a', None],
+        'countrycode': ['AU', 'au', 'NZ', None],
+        'geogscheme1': ['GNAF', 'ICA', 'CRO', 'PC4', 'XXX', None],
+        'geogname1': ['GANSW123456789', 'GANSW000000000', '', 3, 60, 2000, '2000', 4.0, None],
+        'geogscheme2': ['CRO', 'ICA', None],
+        'geogname2': [5, 0, 'a'],
+        'postalcode': [2000, 200, 9999, float('nan'), '2615'],
+        'latitude': [-33.8688, -5.0, 0, float('nan'), float('nan')],
+        'longitude': [151.2093, 170.0, 0, float('nan'), float('nan')],
+        'areacode': ['NSW', 'qld', 'XX', None],
+        'yearbuilt': [1990, 3000, -5, 'a', float('nan')],
+        'staticmotorvehicle': [1, 'true', 'no', 'a', None],
+    }
+    # the rows of an all numeric frame are upcast to float (no location is covered)
+    NUMERIC_OED_VALUES = {
+        'locperilscovered': [8192.0],
+        'buildingtiv': [0, 1000.0, float('nan')],
+        'contentstiv': [0, 500.0],
+        'bitiv': [0, 100.0],
+        'othertiv': [0, 0, 0, 10.0],
+        'constructioncode': [5000, 5850, 5900, 5960],
+        'occupancycode': [1000, 1100, 1300],
+        'postalcode': [2000, 200, 9999, float('nan')],
+        'latitude': [-33.8688, -5.0, 0],
+        'longitude': [151.2093, 170.0, 0],
+        'yearbuilt': [1990, 3000, float('nan')],
+        'staticmotorvehicle': [0, 1],
+    }
+
+    def create_locations(self, values, num_locs):
+        rng = random.Random(1)
+        locs = pd.DataFrame(dict((column, [rng.choice(choices) for _ in range(num_locs)])
+                                 for column, choices in values.items()))
+        locs.insert(0, 'loc_id', range(1, num_locs + 1))
+        return locs
+
+    @parameterized.expand([["mixed", OED_VALUES, 10], ["numeric", NUMERIC_OED_VALUES, 1]])
+    def test_same_keys_as_row_by_row(self, _, values, num_messages):
+        lookup = HailAUSKeysLookup(keys_data_directory=None, model_name="hailAus")
+        lookup._supported_gnaf = {'GANSW123456789'}
+        locs = self.create_locations(values, 2000)
+        expected = process_locations_row_by_row(lookup, locs)
+        keys = lookup.process_locations(locs)
+        self.assertGreater(len(set(expected["message"])), num_messages)
+        pd.testing.assert_frame_equal(expected, keys, check_dtype=False)
+
+    def test_parallel_lookup(self):
+        lookup = HailAUSKeysLookup(keys_data_directory=None, model_name="hailAus")
+        lookup._supported_gnaf = {'GANSW123456789'}
+        locs = self.create_locations(self.OED_VALUES, 1000)
+        keys = lookup._process_locations_parallel(locs, 2, 150)
+        pd.testing.assert_frame_equal(lookup.process_locations(locs), keys)
+
+    def test_missing_columns(self):
+        lookup = HailAUSKeysLookup(keys_data_directory=None, model_name="hailAus")
+        locs = pd.DataFrame({'loc_id': [1, 2, 3], 'buildingtiv': [1.0, 1.0, 0], 'contentstiv': [0, 1.0, 1.0],
+                             'bitiv': 0, 'othertiv': 0, 'locperilscovered': 'AA1', 'postalcode': [2000, 1, 2000]})
+        pd.testing.assert_frame_equal(process_locations_row_by_row(lookup, locs), lookup.process_locations(locs),
+                                      check_dtype=False)
+        self.assertEqual(0, len(lookup.process_locations(locs[:0])))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+import io
+import os
+import sqlite3
+import threading
+import numpy as np
+from backports.tempfile import TemporaryDirectory
+from parameterized import parameterized
+
+from tests.unit.RFBaseTest import RFBaseTestCase
+from tests.unit.GulcalcToBinTests import create_partial_loss_dbs
+from complex_model.LossTransport import create_loss_pipe, close_loss_pipe, iter_live_losses, write_live_losses, \
+    generate_live_losses, LIVE_LOSS_RECORD_DTYPE
+from complex_model.GulcalcToBin import gulcalc_sqlite_fp_to_bin, gulcalc_live_to_bins
+
+
+def create_loss_db(working_dir, chunks):
+    """Writes the live losses into a single oasis_loss_0.db partial loss registered in the event_batches table"""
+    db_fp = os.path.join(working_dir, "riskfrontiersdbAUS_v2_6.db")
+    con = sqlite3.connect(db_fp)
+    con.execute("CREATE TABLE event_batches (batch_id INTEGER);")
+    con.execute("INSERT INTO event_batches VALUES (0);")
+    con.commit()
+    con.close()
+    con = sqlite3.connect(os.path.join(working_dir, "oasis_loss_0.db"))
+    con.execute("CREATE TABLE oasis_loss (event_id INTEGER, loc_id INTEGER, sample_id INTEGER, loss REAL);")
+    for records in chunks:
+        con.executemany("INSERT INTO oasis_loss VALUES (?, ?, ?, ?);", records.tolist())
+    con.commit()
+    con.close()
+    return db_fp
+
+
+class LossTransportTests(RFBaseTestCase):
+    """This contains tests for the live loss transport between the engine and GulcalcToBin
+    """
+    @parameterized.expand([[None], [0], [5e5]])
+    def test_live_stream_is_identical(self, loss_threshold):
+        chunks = list(generate_live_losses(num_events=6, num_locs=4, num_samples=5, zero_loss_fraction=0.3))
+        with TemporaryDirectory() as working_dir:
+            db_fp = create_loss_db(working_dir, chunks)
+            expected = io.BytesIO()
+            gulcalc_sqlite_fp_to_bin(working_dir, db_fp, expected, 5, loss_threshold=loss_threshold)
+
+        with TemporaryDirectory() as working_dir:
+            db_fp = os.path.join(working_dir, "riskfrontiersdbAUS_v2_6.db")
+            fifo_fp = os.path.join(working_dir, "oasis_loss.fifo")
+            fd = create_loss_pipe(fifo_fp)
+            producer = threading.Thread(target=write_live_losses, args=(fifo_fp, chunks))
+            producer.start()
+            result = io.BytesIO()
+            rc = gulcalc_live_to_bins(working_dir, db_fp, fd, [(result, (2, 1))], 5, loss_threshold=loss_threshold)
+            producer.join()
+            os.close(fd)
+            self.assertLess(0, rc)
+            self.assertEqual(expected.getvalue(), result.getvalue())
+
+    def test_fallback_to_partial_losses(self):
+        with TemporaryDirectory() as working_dir:
+            db_fp = create_partial_loss_dbs(working_dir, 3)
+            expected = io.BytesIO()
+            gulcalc_sqlite_fp_to_bin(working_dir, db_fp, expected, 2)
+
+            # the engine ignored the pipe, the stream is ended once it exited
+            fifo_fp = os.path.join(working_dir, "oasis_loss.fifo")
+            fd = create_loss_pipe(fifo_fp)
+            state = {"waited": False}
+
+            def wait_for_engine():
+                state["waited"] = True
+
+            close_loss_pipe(fifo_fp)
+            result = io.BytesIO()
+            gulcalc_live_to_bins(working_dir, db_fp, fd, [(result, (2, 1))], 2, wait_for_engine=wait_for_engine)
+            os.close(fd)
+            self.assertTrue(state["waited"])
+            self.assertEqual(expected.getvalue(), result.getvalue())
+
+    def test_engine_failure_is_raised(self):
+        with TemporaryDirectory() as working_dir:
+            db_fp = create_partial_loss_dbs(working_dir, 1)
+            fifo_fp = os.path.join(working_dir, "oasis_loss.fifo")
+            fd = create_loss_pipe(fifo_fp)
+
+            def wait_for_engine():
+                raise RuntimeError("engine failed")
+
+            close_loss_pipe(fifo_fp)
+            self.assertRaises(RuntimeError, gulcalc_live_to_bins, working_dir, db_fp, fd, [(io.BytesIO(), (2, 1))],
+                              2, wait_for_engine=wait_for_engine)
+            os.close(fd)
+
+    def test_truncated_record_before_end_of_stream(self):
+        with TemporaryDirectory() as working_dir:
+            fifo_fp = os.path.join(working_dir, "oasis_loss.fifo")
+            fd = create_loss_pipe(fifo_fp)
+            records = np.array([(1, 2, 1, 10.5)], dtype=LIVE_LOSS_RECORD_DTYPE)
+            with open(fifo_fp, "wb", buffering=0) as fifo:
+                fifo.write(records.tobytes() + b"\x01\x02\x03\x04\x05")
+            close_loss_pipe(fifo_fp)
+            # the stream still ends, the engine failure is reported by wait_for_engine
+            received = np.concatenate(list(iter_live_losses(fd)))
+            os.close(fd)
+            self.assertEqual(records.tolist(), received[:1].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,15 @@
 import unittest
+import json
 import os
+import random
+import shutil
 from backports.tempfile import TemporaryDirectory
 import pandas as pd
 import sqlite3
 
 from tests.unit.RFBaseTest import RFBaseTestCase
-from complex_model.OasisToRF import create_rf_input, DEFAULT_DB
+from complex_model.OasisToRF import create_rf_input, create_rf_input_from_csv, DEFAULT_DB, RF_DEFAULT_ITEM, \
+    RF_DEFAULT_COVERAGE
 
 
 TEST_DIR = os.path.dirname(__file__)
@@ -13,6 +17,51 @@ TEST_INPUT_DIR = os.path.join(TEST_DIR, 'data', 'input')
 TEST_MODEL_DATA_DIR = os.path.join(TEST_DIR, 'data', 'model_data')
 
 
+# reference GNAF enrichment of u_exposure_tmp through rf_address
+LEGACY_ADDRESS_FILL_SQL = """SELECT a.loc_id,
+                CASE WHEN a.latitude IS NULL OR a.latitude = 0 THEN b.latitude ELSE a.latitude END latitude,
+                CASE WHEN a.longitude IS NULL OR a.longitude = 0 THEN b.longitude ELSE a.longitude END longitude,
+                1 address_type, a.address_id, a.best_res, lower(a.country_code) country_code,
+                CASE WHEN a.[state] IS NULL THEN b.[state] ELSE a.[state] END [state],
+                2 zone_type, CASE WHEN a.zone_id IS NULL THEN b.cresta ELSE a.zone_id END zone_id,
+                4 catchment_type, CASE WHEN a.catchment_id IS NULL THEN b.catchment_id ELSE a.catchment_id END,
+                3 lrg_type, CASE WHEN a.lrg_id IS NULL THEN b.ica_zone ELSE a.lrg_id END lrg_id,
+                1 med_type, CASE WHEN a.med_id IS NULL OR a.med_id = 0 THEN b.postcode ELSE a.med_id END med_id,
+                a.fine_type, a.fine_id, a.lob_id, a.props, a.modelled, a.origin_file_line
+        FROM u_exposure_tmp a INNER JOIN rf_address b ON a.address_id = b.address_id
+        WHERE NOT a.address_id IS NULL AND lower(country_code) = 'au' AND
+            (a.latitude = 0 OR a.latitude IS NULL OR a.longitude = 0 or a.longitude IS NULL)
+        UNION ALL SELECT * FROM u_exposure_tmp WHERE NOT (NOT address_id IS NULL AND lower(country_code) = 'au' AND
+            (latitude = 0 OR latitude IS NULL OR longitude = 0 or longitude IS NULL));"""
+
+
+def legacy_rf_rows(item_source, coverage_source):
+    """Reference row by row conversion of the oasis items and coverages into RF exposure and coverage rows"""
+    items = []
+    coverages = []
+    for line_id in range(0, len(item_source)):
+        item_row = item_source.iloc[line_id]
+        coverage_row = coverage_source.iloc[line_id]
+        rf_item = RF_DEFAULT_ITEM.copy()
+        model_data = json.loads(item_row['model_data'])
+        for key in rf_item.keys():
+            if key in model_data and model_data[key] is not None:
+                if key.lower() == "props":
+                    rf_item[key] = json.dumps(model_data[key])
+                else:
+                    rf_item[key] = model_data[key]
+        rf_item['loc_id'] = str(item_row['item_id'])
+        rf_coverage = RF_DEFAULT_COVERAGE.copy()
+        rf_coverage['cover_id'] = int(model_data['cover_id'])
+        rf_coverage['value'] = float(coverage_row['tiv'])
+        rf_coverage['loc_id'] = rf_item['loc_id']
+        rf_item['origin_file_line'] = line_id + 1
+        rf_coverage['origin_file_line'] = line_id + 1
+        items.append(tuple(rf_item.values()))
+        coverages.append(tuple(rf_coverage.values()))
+    return items, coverages
+
+
 class CreateDatabaseTests(RFBaseTestCase):
     """This contains tests for the RF inpu database creation logic
     """
@@ -65,6 +114,150 @@ class CreateDatabaseTests(RFBaseTestCase):
                     None, None, 1, '{"YearBuilt": 0}', None, 1)
         self.__create_rf_input_generic(expected, 'ica_zone')
 
+    def test_template_tables_are_copied(self):
+        items_file = os.path.join(TEST_INPUT_DIR, 'address', 'complex_items.csv')
+        with open(items_file, 'r') as f:
+            items_pd = pd.read_csv(f)
+        coverages_file = os.path.join(TEST_INPUT_DIR, 'address', 'coverages.csv')
+        with open(coverages_file, 'r') as f:
+            coverages_pd = pd.read_csv(f)
+        with TemporaryDirectory() as tmp_dir:
+            sqlite_fp = os.path.join(tmp_dir, DEFAULT_DB)
+            create_rf_input(items_pd, coverages_pd, sqlite_fp, TEST_MODEL_DATA_DIR)
+            con = sqlite3.connect(sqlite_fp)
+            con.execute("ATTACH DATABASE ? AS template;", (os.path.join(TEST_MODEL_DATA_DIR, DEFAULT_DB),))
+            template_schema = con.execute("SELECT type, name, sql FROM template.sqlite_master").fetchall()
+            schema = con.execute("SELECT type, name, sql FROM main.sqlite_master").fetchall()
+            self.assertTrue(set(template_schema).issubset(set(schema)))
+            for obj_type, name, _ in template_schema:
+                if obj_type == "table" and not name == "rf_address":
+                    self.assertEqual(con.execute("SELECT * FROM template.[" + name + "]").fetchall(),
+                                     con.execute("SELECT * FROM main.[" + name + "]").fetchall())
+            # only the referenced addresses are copied
+            self.assertEqual(con.execute("SELECT * FROM template.rf_address WHERE address_id IN "
+                                         "(SELECT address_id FROM u_exposure)").fetchall(),
+                             con.execute("SELECT * FROM main.rf_address").fetchall())
+            con.close()
+
+    def test_rf_input_is_identical_to_row_by_row(self):
+        rng = random.Random(0)
+        model_data = []
+        for i in range(200):
+            item = {"lob_id": rng.choice([1, 2, None]), "cover_id": rng.choice([1, 2, 3, "4", 5.0]),
+                    "loc_id": str(i), "country_code": rng.choice(["au", "AU", "nz", None]),
+                    "address_id": rng.choice(["GAACT714845933", None, "GANSW123456789"]),
+                    "latitude": rng.choice([None, 0, -35.2 + rng.random()]),
+                    "longitude": rng.choice([None, 0, 149.0 + rng.random()]),
+                    "med_id": rng.choice([None, 2615]), "best_res": rng.choice([0, 1, 7]),
+                    "modelled": rng.choice([True, False, None]), "origin_file_line": 99,
+                    "props": rng.choice([None, {"YearBuilt": rng.randint(1900, 2020)}, {}])}
+            for key in list(item.keys()):
+                if key not in ("cover_id",) and rng.random() < 0.2:
+                    del item[key]
+            model_data.append(json.dumps(item))
+        items_pd = pd.DataFrame({"item_id": range(1, 201), "coverage_id": range(1, 201), "model_data": model_data,
+                                 "group_id": 1})
+        coverages_pd = pd.DataFrame({"coverage_id": range(1, 201),
+                                     "tiv": [rng.choice([0, 1000000, 2.5e5]) for _ in range(200)]})
+        expected_items, expected_coverages = legacy_rf_rows(items_pd, coverages_pd)
+        with TemporaryDirectory() as tmp_dir:
+            # an address found twice and an address with other coordinates
+            shutil.copyfile(os.path.join(TEST_MODEL_DATA_DIR, DEFAULT_DB), os.path.join(tmp_dir, DEFAULT_DB))
+            con = sqlite3.connect(os.path.join(tmp_dir, DEFAULT_DB))
+            con.execute("INSERT INTO rf_address SELECT * FROM rf_address;")
+            con.execute("INSERT INTO rf_address VALUES ('GANSW123456789', -33.8, 151.2, '2000', 12, 5, 'NSW', '', 7, "
+                        "'');")
+            con.commit()
+            con.close()
+            sqlite_fp = os.path.join(tmp_dir, "rf_input.db")
+            self.assertEqual(200, create_rf_input(items_pd, coverages_pd, sqlite_fp, tmp_dir))
+            con = sqlite3.connect(sqlite_fp)
+            con.execute("CREATE TABLE u_exposure_tmp AS SELECT * FROM u_exposure WHERE 0;")
+            con.execute("CREATE TABLE expected_exposure AS SELECT * FROM u_exposure WHERE 0;")
+            con.execute("CREATE TABLE expected_coverage AS SELECT * FROM u_coverage WHERE 0;")
+            con.executemany("INSERT INTO u_exposure_tmp VALUES (" + ",".join("?" * len(RF_DEFAULT_ITEM)) + ");",
+                            expected_items)
+            con.execute("INSERT INTO expected_exposure " + LEGACY_ADDRESS_FILL_SQL)
+            con.executemany("INSERT INTO expected_coverage VALUES (" + ",".join("?" * len(RF_DEFAULT_COVERAGE))
+                            + ");", expected_coverages)
+            self.assertEqual(sorted(con.execute("SELECT * FROM expected_exposure").fetchall(), key=repr),
+                             sorted(con.execute("SELECT * FROM u_exposure").fetchall(), key=repr))
+            self.assertEqual(con.execute("SELECT * FROM expected_coverage ORDER BY rowid").fetchall(),
+                             con.execute("SELECT * FROM u_coverage ORDER BY rowid").fetchall())
+            con.close()
+
+    def test_chunked_build_is_identical(self):
+        items_pd = pd.DataFrame({"item_id": range(1, 26), "coverage_id": range(1, 26), "group_id": 1,
+                                 "model_data": [json.dumps({"cover_id": 1 + i % 3, "lob_id": 1, "country_code": "au",
+                                                            "address_id": "GAACT714845933" if i % 2 else None,
+                                                            "props": {"YearBuilt": 1990 + i}})
+                                                for i in range(25)]})
+        coverages_pd = pd.DataFrame({"coverage_id": range(1, 26), "tiv": [1000.0 * i for i in range(25)]})
+        with TemporaryDirectory() as tmp_dir:
+            items_fp = os.path.join(tmp_dir, "complex_items.csv")
+            coverages_fp = os.path.join(tmp_dir, "coverages.csv")
+            items_pd.to_csv(items_fp, index=False)
+            coverages_pd.to_csv(coverages_fp, index=False)
+            expected_fp = os.path.join(tmp_dir, "expected.db")
+            self.assertEqual(25, create_rf_input(items_pd, coverages_pd, expected_fp, TEST_MODEL_DATA_DIR))
+            sqlite_fp = os.path.join(tmp_dir, DEFAULT_DB)
+            self.assertEqual(25, create_rf_input_from_csv(items_fp, coverages_fp, sqlite_fp, TEST_MODEL_DATA_DIR,
+                                                          chunk_size=7))
+            con = sqlite3.connect(sqlite_fp)
+            con.execute("ATTACH DATABASE ? AS expected;", (expected_fp,))
+            for table in ["u_exposure", "u_coverage"]:
+                self.assertEqual(con.execute("SELECT * FROM expected." + table + " ORDER BY rowid").fetchall(),
+                                 con.execute("SELECT * FROM main." + table + " ORDER BY rowid").fetchall())
+            con.close()
+
+            coverages_pd[:24].to_csv(coverages_fp, index=False)
+            self.assertRaises(Exception, create_rf_input_from_csv, items_fp, coverages_fp, sqlite_fp,
+                              TEST_MODEL_DATA_DIR, 7)
+
+            # comma separated objects in model_data would misalign the rows of their chunk
+            coverages_pd.to_csv(coverages_fp, index=False)
+            items_pd.loc[9, "model_data"] = '{"cover_id": 1}, {"cover_id": 2}'
+            items_pd.to_csv(items_fp, index=False)
+            with self.assertRaisesRegex(Exception, "starting at line 8 "):
+                create_rf_input_from_csv(items_fp, coverages_fp, sqlite_fp, TEST_MODEL_DATA_DIR, 7)
+
+    def test_fill_resolution_from_lat_long(self):
+        # two overlapping catchments, the lowest id wins on the overlap and on the boundaries
+        squares = [(2, 149.0, -35.5), (1, 149.25, -35.5)]
+        features = [{"type": "Feature", "properties": {"catchment_id": catchment_id},
+                     "geometry": {"type": "Polygon",
+                                  "coordinates": [[[lon, lat], [lon + 0.5, lat], [lon + 0.5, lat + 0.5],
+                                                   [lon, lat + 0.5], [lon, lat]]]}}
+                    for catchment_id, lon, lat in squares]
+        points = [(149.1, -35.2, None), (149.3, -35.2, None), (149.6, -35.2, None), (149.75, -35.2, None),
+                  (150.5, -35.2, None), (149.1, -35.2, 9), (None, None, None)]
+        items_pd = pd.DataFrame({"item_id": range(1, 8), "coverage_id": range(1, 8), "group_id": 1,
+                                 "model_data": [json.dumps({"cover_id": 1, "lob_id": 1, "country_code": "au",
+                                                            "longitude": lon, "latitude": lat,
+                                                            "catchment_id": catchment_id})
+                                                for lon, lat, catchment_id in points]})
+        coverages_pd = pd.DataFrame({"coverage_id": range(1, 8), "tiv": 1000.0})
+        with TemporaryDirectory() as tmp_dir:
+            boundary_fp = os.path.join(tmp_dir, "catchments.json")
+            with open(boundary_fp, "w") as f:
+                json.dump({"type": "FeatureCollection", "features": features}, f)
+            sqlite_fp = os.path.join(tmp_dir, "rf_input.db")
+            create_rf_input(items_pd, coverages_pd, sqlite_fp, TEST_MODEL_DATA_DIR,
+                            boundary_layers={"catchment_id": (boundary_fp, "catchment_id")})
+            con = sqlite3.connect(sqlite_fp)
+            self.assertEqual([(2, 4), (1, 4), (1, 4), (1, 4), (None, None), (9, None), (None, None)],
+                             con.execute("SELECT catchment_id, catchment_type FROM u_exposure "
+                                         "ORDER BY rowid").fetchall())
+            self.assertEqual([(None,)] * 7, con.execute("SELECT zone_id FROM u_exposure").fetchall())
+            con.close()
+
+            # without boundary layers the resolutions are left as they are
+            create_rf_input(items_pd, coverages_pd, sqlite_fp, TEST_MODEL_DATA_DIR)
+            con = sqlite3.connect(sqlite_fp)
+            self.assertEqual([None] * 5 + [9, None],
+                             [row[0] for row in con.execute("SELECT catchment_id FROM u_exposure ORDER BY rowid")])
+            con.close()
+
 
 if __name__ == '__main__':
     unittest.main()
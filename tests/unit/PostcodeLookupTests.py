@@ -1,21 +1,30 @@
 import unittest
 import os
+import multiprocessing
+import numpy as np
 import pandas as pd
 from parameterized import parameterized
+from backports.tempfile import TemporaryDirectory
 
 from tests.unit.RFBaseTest import RFBaseTestCase
+from tests.unit.PostcodeSnapshotTests import create_keys_data
 from complex_model import PostcodeLookup
+from complex_model.PostcodeLookup import get_postcode_data, POSTCODE_NOT_FOUND
 
 TEST_DIR = os.path.dirname(__file__)
 TEST_KEYS_DATA_DIR = os.path.join(TEST_DIR, 'data', 'keys_data')
 TEST_INPUT_DIR = os.path.join(TEST_DIR, 'data', 'input', 'postcode_lookup')
-PL = PostcodeLookup(TEST_KEYS_DATA_DIR)
+# the keys data is not distributed with the repository
+PL = PostcodeLookup(TEST_KEYS_DATA_DIR) if os.path.isdir(TEST_KEYS_DATA_DIR) else None
+POINTS = [(132.5, -34.5), (132.4, -33.6), (134.0, -33.5), (133.5, -34.0), (0, 0)]
+FORKED_LOOKUP = None
 
 locations_file = os.path.join(TEST_INPUT_DIR, 'locations.csv')
 with open(locations_file, 'r') as f:
     locations = pd.read_csv(f)
 
 
+@unittest.skipIf(PL is None, "keys data not available")
 class PostcodeLookupTests(RFBaseTestCase):
     """This test case provides validation for the postcode lookup method
     """
@@ -38,6 +47,95 @@ class PostcodeLookupTests(RFBaseTestCase):
         looked_postcode = PL.get_postcode(None, None)
         self.assertEqual(None, looked_postcode)
 
+    def test_cell_candidates(self):
+        # the boundaries clipped to the cells give the same postcodes as the whole boundaries
+        for _, test_loc in locations.iterrows():
+            longitude, latitude = test_loc['longitude'], test_loc['latitude']
+            quad = PL._data.quadtree.Lookup(latitude, longitude)
+            postcodes = PL._data.get_cell_postcodes(quad.Node).tolist()
+            self.assertEqual(PL._lookup_postcode_in_boundaries(postcodes, longitude, latitude),
+                             PL._lookup_postcode(longitude, latitude), f"failed for {latitude},{longitude}")
+            for postcode, geometry in PL._get_cell_candidates(quad):
+                self.assertIn(postcode, postcodes)
+
+    def test_get_postcodes(self):
+        # duplicated coordinates and missing coordinates
+        longitudes = locations['longitude'].tolist() * 2 + [float('nan'), 151.2093]
+        latitudes = locations['latitude'].tolist() * 2 + [-33.8688, float('nan')]
+        expected = [PL.get_postcode(lon, lat) for lon, lat in zip(longitudes[:-2], latitudes[:-2])] + [None, None]
+        expected = [POSTCODE_NOT_FOUND if postcode is None else postcode for postcode in expected]
+        duplicates = PL.cache_info()["duplicates"]
+        self.assertEqual(expected, PL.get_postcodes(longitudes, latitudes).tolist())
+        self.assertEqual(len(locations), PL.cache_info()["duplicates"] - duplicates)
+
+
+def get_forked_postcode(point):
+    return FORKED_LOOKUP.get_postcode(*point)
+
+
+class PostcodeDataTests(RFBaseTestCase):
+    """This contains tests for the postcode data shared by the postcode lookups of a process
+    """
+    def test_get_postcode_cache(self):
+        lookup = PostcodeLookup(cache_size=2)
+        for lon, lat in [(0, 0), (1, 1), (0, 0), (2, 2), (1, 1), (0, 0)]:
+            self.assertEqual(None, lookup.get_postcode(lon, lat))
+        cache_info = lookup.cache_info()
+        self.assertEqual(1, cache_info["hits"])
+        self.assertEqual(5, cache_info["misses"])
+        self.assertEqual(2, cache_info["size"])
+        self.assertAlmostEqual(1 / 6, cache_info["hit_rate"])
+
+    def test_data_is_loaded_once(self):
+        with TemporaryDirectory() as tmp_dir:
+            create_keys_data(tmp_dir)
+            snapshot_dir = os.path.join(tmp_dir, "snapshot")
+            first = PostcodeLookup(tmp_dir, snapshot_dir=snapshot_dir)
+            second = PostcodeLookup(os.path.join(tmp_dir, "."), snapshot_dir=snapshot_dir)
+            self.assertIs(first._data, second._data)
+            self.assertIs(first._data, get_postcode_data(tmp_dir, snapshot_dir))
+            self.assertEqual([first.get_postcode(lon, lat) for lon, lat in POINTS],
+                             [second.get_postcode(lon, lat) for lon, lat in POINTS])
+            data = first._data
+            self.assertEqual([2000, 2001], data.get_cell_postcodes(data.quadtree.Lookup(-33.5, 132.5).Node).tolist())
+            self.assertTrue(first._data.quadtree._lat.readonly)
+
+            # a new version of the keys data is loaded again
+            with open(os.path.join(tmp_dir, "cellid_to_postcode.csv"), "a") as f:
+                f.write("D,2000\n")
+            os.utime(os.path.join(tmp_dir, "cellid_to_postcode.csv"),
+                     ns=(0, os.stat(os.path.join(tmp_dir, "cellid_to_postcode.csv")).st_mtime_ns + 10**9))
+            third = PostcodeLookup(tmp_dir, snapshot_dir=snapshot_dir)
+            self.assertIsNot(first._data, third._data)
+            node = third._data.quadtree.Lookup(-34.5, 134.0).Node
+            self.assertEqual([2001, 2000], third._data.get_cell_postcodes(node).tolist())
+            self.assertEqual([2001], data.get_cell_postcodes(node).tolist())
+
+    def test_forked_lookup(self):
+        global FORKED_LOOKUP
+        with TemporaryDirectory() as tmp_dir:
+            create_keys_data(tmp_dir)
+            FORKED_LOOKUP = PostcodeLookup(tmp_dir, snapshot_dir=os.path.join(tmp_dir, "snapshot"))
+            with multiprocessing.get_context("fork").Pool(2) as pool:
+                self.assertEqual([2000, 2000, 2001, 2001, None], pool.map(get_forked_postcode, POINTS))
+
+    def test_get_postcodes(self):
+        with TemporaryDirectory() as tmp_dir:
+            create_keys_data(tmp_dir)
+            lookup = PostcodeLookup(tmp_dir, snapshot_dir=os.path.join(tmp_dir, "snapshot"))
+            rng = np.random.default_rng(1)
+            # points of every cell, on the edges of the cells and the boundaries, outside of the grid and missing
+            longitudes = np.concatenate([rng.uniform(130.8, 135.8, 2000), [133.27990092, 133.28, 132.3, 0, np.nan, 1]])
+            latitudes = np.concatenate([rng.uniform(-36.6, -31.6, 2000), [-34.12151598, -34.0, -33.6, 0, -34, np.nan]])
+            expected = [lookup.get_postcode(lon, lat) for lon, lat in zip(longitudes[:-2], latitudes[:-2])] + [None] * 2
+            postcodes = lookup.get_postcodes(longitudes, latitudes)
+            self.assertEqual(np.int64, postcodes.dtype)
+            self.assertEqual([POSTCODE_NOT_FOUND if postcode is None else postcode for postcode in expected],
+                             postcodes.tolist())
+            self.assertEqual({POSTCODE_NOT_FOUND, 2000, 2001}, set(postcodes.tolist()))
+            self.assertEqual([], PostcodeLookup().get_postcodes([], []).tolist())
+            self.assertEqual([POSTCODE_NOT_FOUND], PostcodeLookup().get_postcodes([133.5], [-34.0]).tolist())
+
 
 if __name__ == '__main__':
     unittest.main()
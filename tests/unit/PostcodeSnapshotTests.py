@@ -0,0 +1,116 @@
+import unittest
+import os
+import json
+from backports.tempfile import TemporaryDirectory
+
+from tests.unit.RFBaseTest import RFBaseTestCase
+from complex_model.PostcodeSnapshot import PostcodeSnapshot, PostcodeSnapshotError, get_postcode_snapshot_fp, \
+    read_postcode_sources
+from complex_model import PostcodeLookup
+
+# a base cell divided in 4 cells, 2 postcodes split at longitude 133.28 and an island of 2001 inside 2000
+LATITUDE = -34.12151598
+LONGITUDE = 133.27990092
+POSTCODES = [(2000, [[[132.0, -35.0], [133.28, -35.0], [133.28, -33.0], [132.0, -33.0], [132.0, -35.0]]]),
+             (2001, [[[133.28, -35.0], [134.5, -35.0], [134.5, -33.0], [133.28, -33.0], [133.28, -35.0]]]),
+             (2001, [[[132.3, -33.7], [132.5, -33.7], [132.5, -33.5], [132.3, -33.5], [132.3, -33.7]]])]
+
+
+def create_keys_data(keys_dir):
+    with open(os.path.join(keys_dir, "postcode_grid.csv"), "w") as f:
+        f.write("cellid,latitude,longitude,size\n")
+        for cell_id, lat, lon in [("A", 1, -1), ("B", -1, -1), ("C", 1, 1), ("D", -1, 1)]:
+            f.write("{0},{1},{2},{3}\n".format(cell_id, LATITUDE + lat * 1.28, LONGITUDE + lon * 1.28, 2.56))
+    with open(os.path.join(keys_dir, "cellid_to_postcode.csv"), "w") as f:
+        f.write("cellid,postcode\nA,2000\nA,2001\nB,2000\nC,2001\nD,2001\n")
+    with open(os.path.join(keys_dir, "postcode_boundaries.json"), "w") as f:
+        json.dump({"type": "FeatureCollection",
+                   "features": [{"type": "Feature", "properties": {"postcode": postcode},
+                                 "geometry": {"type": "Polygon", "coordinates": coordinates}}
+                                for postcode, coordinates in POSTCODES]}, f)
+
+
+class PostcodeSnapshotTests(RFBaseTestCase):
+    """This contains tests for the memory mapped snapshot of the postcode lookup data
+    """
+    def test_snapshot(self):
+        with TemporaryDirectory() as tmp_dir:
+            create_keys_data(tmp_dir)
+            snapshot_dir = os.path.join(tmp_dir, "snapshot")
+            snapshot = PostcodeSnapshot.load(tmp_dir, snapshot_dir)
+            self.assertTrue(os.path.isfile(get_postcode_snapshot_fp(snapshot_dir, tmp_dir)))
+
+            quadtree, cellid_to_postcode, postcodes, geometries = read_postcode_sources(tmp_dir)
+            self.assertEqual(cellid_to_postcode, snapshot.get_cellid_to_postcode())
+            boundaries = snapshot.get_postcode_boundaries()
+            self.assertEqual([2000, 2001], sorted(boundaries.keys()))
+            self.assertEqual([geometry.wkt for geometry in geometries],
+                             [geometry.wkt for geometry in boundaries[2000] + boundaries[2001]])
+            tree = snapshot.get_quadtree()
+            for lat, lon in [(-34.5, 132.5), (-33.5, 132.5), (-34.5, 134.0), (-33.5, 134.0), (-34.12, 133.28), (0, 0)]:
+                expected, quad = quadtree.Lookup(lat, lon), tree.Lookup(lat, lon)
+                self.assertEqual(expected and (expected.CellID, expected.Size, expected.WasLoaded),
+                                 quad and (quad.CellID, quad.Size, quad.WasLoaded))
+            self.assertEqual(quadtree.lookup_many([-34.5, 0], [134.0, 0]).tolist(),
+                             tree.lookup_many([-34.5, 0], [134.0, 0]).tolist())
+
+    def test_lookup(self):
+        with TemporaryDirectory() as tmp_dir:
+            create_keys_data(tmp_dir)
+            lookup = PostcodeLookup(tmp_dir, snapshot_dir=os.path.join(tmp_dir, "snapshot"))
+            self.assertEqual([2000, 2000, 2001, 2001, None],
+                             [lookup.get_postcode(lon, lat) for lon, lat in
+                              [(132.5, -34.5), (132.4, -33.6), (134.0, -33.5), (133.5, -34.0), (0, 0)]])
+
+    def test_snapshot_is_rebuilt_when_sources_change(self):
+        with TemporaryDirectory() as tmp_dir:
+            create_keys_data(tmp_dir)
+            snapshot_dir = os.path.join(tmp_dir, "snapshot")
+            PostcodeSnapshot.load(tmp_dir, snapshot_dir)
+            snapshot_fp = get_postcode_snapshot_fp(snapshot_dir, tmp_dir)
+            mtime = os.stat(snapshot_fp).st_mtime_ns
+            PostcodeSnapshot.load(tmp_dir, snapshot_dir)
+            self.assertEqual(mtime, os.stat(snapshot_fp).st_mtime_ns)
+
+            with open(os.path.join(tmp_dir, "cellid_to_postcode.csv"), "a") as f:
+                f.write("D,2000\n")
+            self.assertRaises(PostcodeSnapshotError, PostcodeSnapshot.open, snapshot_fp,
+                              {"cellid_to_postcode.csv": "", "postcode_grid.csv": "", "postcode_boundaries.json": ""})
+            self.assertEqual([2001, 2000], PostcodeSnapshot.load(tmp_dir, snapshot_dir).get_cellid_to_postcode()["D"])
+
+    def test_sources_are_only_hashed_when_their_signature_changes(self):
+        with TemporaryDirectory() as tmp_dir:
+            create_keys_data(tmp_dir)
+            snapshot_dir = os.path.join(tmp_dir, "snapshot")
+            PostcodeSnapshot.load(tmp_dir, snapshot_dir)
+            snapshot_fp = get_postcode_snapshot_fp(snapshot_dir, tmp_dir)
+            mtime = os.stat(snapshot_fp).st_mtime_ns
+
+            # touched sources with the same content are hashed again and the snapshot is kept
+            cellid_fp = os.path.join(tmp_dir, "cellid_to_postcode.csv")
+            stat = os.stat(cellid_fp)
+            os.utime(cellid_fp, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            self.assertEqual([2001], PostcodeSnapshot.load(tmp_dir, snapshot_dir).get_cellid_to_postcode()["D"])
+            self.assertEqual(mtime, os.stat(snapshot_fp).st_mtime_ns)
+
+            # sources with the size and modification time recorded in the snapshot are not hashed
+            with open(cellid_fp, "w") as f:
+                f.write("cellid,postcode\nA,2000\nA,2001\nB,2000\nC,2001\nD,2000\n")
+            os.utime(cellid_fp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            self.assertEqual([2001], PostcodeSnapshot.load(tmp_dir, snapshot_dir).get_cellid_to_postcode()["D"])
+
+    def test_invalid_snapshot(self):
+        with TemporaryDirectory() as tmp_dir:
+            create_keys_data(tmp_dir)
+            snapshot_dir = os.path.join(tmp_dir, "snapshot")
+            os.makedirs(snapshot_dir)
+            with open(get_postcode_snapshot_fp(snapshot_dir, tmp_dir), "wb") as f:
+                f.write(b"RFPCSNAP")
+            self.assertRaises(PostcodeSnapshotError, PostcodeSnapshot.open,
+                              get_postcode_snapshot_fp(snapshot_dir, tmp_dir))
+            self.assertEqual(["A", "B", "C", "D"],
+                             sorted(PostcodeSnapshot.load(tmp_dir, snapshot_dir).get_cellid_to_postcode().keys()))
+
+
+if __name__ == '__main__':
+    unittest.main()
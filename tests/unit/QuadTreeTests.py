@@ -0,0 +1,72 @@
+import unittest
+import random
+import numpy as np
+from parameterized import parameterized
+
+from tests.unit.RFBaseTest import RFBaseTestCase
+from complex_model.QuadTree import QuadTree
+
+MIN_LAT = -44.36151598
+MIN_LONG = 115.35990092
+BASE_SIZE = 2.56
+
+
+def create_tree(coarse_first):
+    """Quad tree of 2x2 base cells, the first one divided 3 times and loaded at several levels"""
+    qt = QuadTree(2, 2, MIN_LAT, MIN_LONG, BASE_SIZE)
+    cells = [("b0-1-", MIN_LAT, MIN_LONG + 2 * BASE_SIZE, BASE_SIZE),
+             ("C", MIN_LAT + BASE_SIZE / 2, MIN_LONG + BASE_SIZE / 2, BASE_SIZE / 2),
+             ("F1", MIN_LAT - BASE_SIZE * 3 / 4, MIN_LONG - BASE_SIZE * 3 / 4, BASE_SIZE / 4),
+             ("F2", MIN_LAT - BASE_SIZE * 7 / 8, MIN_LONG - BASE_SIZE / 8, BASE_SIZE / 8)]
+    for cell_id, lat, lon, size in (cells if coarse_first else reversed(cells)):
+        qt.Load(cell_id, lat, lon, size)
+    return qt
+
+
+class QuadTreeTests(RFBaseTestCase):
+    """This contains tests for the array backed quad tree of the postcode lookup
+    """
+    @parameterized.expand([[True], [False]])
+    def test_lookup(self, coarse_first):
+        qt = create_tree(coarse_first)
+        self.assertTrue(qt.PostLoadTest())
+
+        quad = qt.Lookup(MIN_LAT + 0.1, MIN_LONG + 2 * BASE_SIZE + 0.1)
+        self.assertEqual(("b0-1-", BASE_SIZE, True, True), (quad.CellID, quad.Size, quad.IsLeaf, quad.WasLoaded))
+        quad = qt.Lookup(MIN_LAT + 0.1, MIN_LONG + 0.1)
+        self.assertEqual(("C", BASE_SIZE / 2, True), (quad.CellID, quad.Size, quad.WasLoaded))
+        quad = qt.Lookup(MIN_LAT - BASE_SIZE + 0.01, MIN_LONG - BASE_SIZE + 0.01)
+        self.assertEqual(("F1", BASE_SIZE / 4), (quad.CellID, quad.Size))
+        quad = qt.Lookup(MIN_LAT - BASE_SIZE + 0.01, MIN_LONG - 0.01)
+        self.assertEqual(("F2", BASE_SIZE / 8), (quad.CellID, quad.Size))
+        quad = qt.Lookup(MIN_LAT - 0.1, MIN_LONG - 0.1)
+        self.assertEqual(("b0-0-0110", BASE_SIZE / 4, False), (quad.CellID, quad.Size, quad.WasLoaded))
+        quad = qt.Lookup(MIN_LAT - 0.1, MIN_LONG + 0.1)
+        self.assertEqual(("b0-0-11", BASE_SIZE / 2, False), (quad.CellID, quad.Size, quad.WasLoaded))
+        quad = qt.Lookup(MIN_LAT + 2 * BASE_SIZE, MIN_LONG)
+        self.assertEqual(("b1-0-", BASE_SIZE, True, False), (quad.CellID, quad.Size, quad.IsLeaf, quad.WasLoaded))
+        self.assertIsNone(qt.Lookup(MIN_LAT - 4 * BASE_SIZE, MIN_LONG))
+        self.assertIsNone(qt.Lookup(MIN_LAT, MIN_LONG + 4 * BASE_SIZE))
+
+    @parameterized.expand([[True], [False]])
+    def test_lookup_many(self, coarse_first):
+        qt = create_tree(coarse_first)
+        rng = random.Random(1)
+        lats = [rng.uniform(MIN_LAT - 2 * BASE_SIZE, MIN_LAT + 4 * BASE_SIZE) for _ in range(2000)] + [np.nan]
+        longs = [rng.uniform(MIN_LONG - 2 * BASE_SIZE, MIN_LONG + 4 * BASE_SIZE) for _ in range(2000)] + [MIN_LONG]
+        expected = []
+        for lat, lon in zip(lats, longs):
+            quad = None if np.isnan(lat) else qt.Lookup(lat, lon)
+            expected.append(None if quad is None else quad.CellID)
+        nodes = qt.lookup_many(lats, longs)
+        self.assertEqual(expected, [None if node < 0 else qt.get_cell_id(node) for node in nodes])
+        self.assertGreater(expected.count(None), 0)
+
+    def test_load_errors(self):
+        qt = QuadTree(2, 2, MIN_LAT, MIN_LONG, BASE_SIZE)
+        self.assertRaises(IndexError, qt.Load, "A", MIN_LAT + 10 * BASE_SIZE, MIN_LONG, BASE_SIZE)
+        self.assertRaises(ValueError, qt.Load, "A", MIN_LAT, MIN_LONG, BASE_SIZE / 3)
+
+
+if __name__ == '__main__':
+    unittest.main()